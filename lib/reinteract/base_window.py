@@ -21,6 +21,7 @@ from library_editor import LibraryEditor
 from notebook import Notebook, NotebookFile
 from worksheet_editor import WorksheetEditor
 from preferences_dialog import show_preferences
+import profile_result
 import reunicode
 
 if global_settings.main_menu_mode:
@@ -100,6 +101,8 @@ class BaseWindow:
             ('about',   gtk.STOCK_ABOUT,     None,         None,              None, self.on_about),
             ('calculate', gtk.STOCK_REFRESH, "Ca_lculate", '<control>Return', None,  self.on_calculate),
             ('calculate-to-line', gtk.STOCK_REDO, "Calculate to Line", '<shift>Return', None, self.on_calculate),
+            ('profile-statement', None,      "_Profile Statement", None,      None,  self.on_profile_statement),
+            ('profile-statement-sampling', None, "Profile Statement (Sampling)", None, None, self.on_profile_statement),
             ('break',   gtk.STOCK_CANCEL,    "_Break",     '<control>Break',  None,  self.on_break),
             ('preferences', gtk.STOCK_PREFERENCES, "Prefere_nces",     None,  None,  self.on_preferences),
         ])
@@ -252,6 +255,14 @@ class BaseWindow:
         if self.current_editor and self.current_editor.needs_calculate:
             self.current_editor.calculate(end_at_insert=end_at_insert)
 
+    def on_profile_statement(self, action):
+        if action.get_name() == 'profile-statement-sampling':
+            mode = profile_result.SAMPLING
+        else:
+            mode = profile_result.DETERMINISTIC
+        if self.current_editor and self.current_editor.can_profile:
+            self.current_editor.profile_statement(mode)
+
     def on_break(self, action):
         if self.current_editor:
             self.current_editor.buf.worksheet.interrupt()
@@ -299,6 +310,8 @@ class BaseWindow:
     def update_sensitivity(self):
         self._set_action_sensitive('calculate', self.current_editor is not None and self.current_editor.needs_calculate)
         self._set_action_sensitive('calculate-to-line', self.current_editor is not None and self.current_editor.needs_calculate)
+        self._set_action_sensitive('profile-statement', self.current_editor is not None and self.current_editor.can_profile)
+        self._set_action_sensitive('profile-statement-sampling', self.current_editor is not None and self.current_editor.can_profile)
         self._set_action_sensitive('break', self.current_editor is not None and self.current_editor.state == NotebookFile.EXECUTING)
 
         # This seems more annoying than useful. gedit doesn't desensitize save
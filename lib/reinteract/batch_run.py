@@ -0,0 +1,318 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import gobject
+import json
+from optparse import OptionParser
+import os
+import stdout_capture
+import sys
+import time
+
+from chunks import StatementChunk
+from notebook import Notebook, NotebookFile, HelpResult, WorksheetFile
+from output_result import OutputResult
+import reunicode
+from statement import Statement, WarningResult
+from worksheet import Worksheet
+
+#
+# Running worksheets without the user interface, for reinteract-run. Each
+# worksheet is loaded into a Worksheet, calculated, and reported on; nothing
+# is saved back to the worksheet files. With --jobs, the worksheets are run in
+# a pool of worker processes, each of which keeps a Notebook for each notebook
+# folder it has run worksheets from.
+#
+
+_STATE_NAMES = {
+    Statement.NEW: 'new',
+    Statement.COMPILE_SUCCESS: 'not-executed',
+    Statement.COMPILE_ERROR: 'compile-error',
+    Statement.EXECUTING: 'executing',
+    Statement.EXECUTE_SUCCESS: 'success',
+    Statement.EXECUTE_ERROR: 'error',
+    Statement.INTERRUPTED: 'interrupted',
+}
+
+# Notebooks already opened in this process, by folder
+_notebooks = {}
+
+def find_worksheets(path):
+    """Find the worksheets to run for a path given on the command line
+
+    @param path: a worksheet file, or a notebook folder to run all the worksheets of
+    @returns: a list of (notebook_folder, filename) where filename is relative to the folder
+
+    """
+
+    absolute = os.path.abspath(path)
+    if os.path.isdir(absolute):
+        notebook = Notebook(absolute)
+        relatives = sorted(relative for relative, file in notebook.files.iteritems()
+                           if isinstance(file, WorksheetFile))
+        return [(absolute, relative) for relative in relatives]
+
+    # Look for the notebook containing the file; as when opening a file in the
+    # user interface, a folder without an index.rnb can serve as the notebook
+    folder = os.path.dirname(absolute)
+    while not os.path.exists(os.path.join(folder, "index.rnb")):
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            folder = os.path.dirname(absolute)
+            break
+        folder = parent
+
+    return [(folder, absolute[len(folder) + 1:])]
+
+def _format_result(result):
+    if isinstance(result, basestring):
+        return result
+    elif isinstance(result, OutputResult):
+        lines = []
+        page = 0
+        while True:
+            page_lines = result.read_page(page)
+            if not page_lines:
+                break
+            lines.extend(page_lines)
+            page += 1
+        return u"\n".join(lines)
+    elif isinstance(result, HelpResult):
+        return u"<help on %s>" % result.arg
+    elif isinstance(result, WarningResult):
+        return u"WARNING: %s" % result.message
+    else:
+        return u"<%s>" % type(result).__name__
+
+def run_worksheet(folder, filename, statement_timeout=None, timeout=None):
+    """Load a worksheet and calculate it
+
+    @param folder: folder of the notebook the worksheet is in
+    @param filename: the worksheet file, relative to folder
+    @param statement_timeout: if not None, statements taking longer than this many seconds are interrupted
+    @param timeout: if not None, the calculation is interrupted after this many seconds
+    @returns: a report on the calculation, as a dictionary that can be written out as JSON
+
+    """
+
+    notebook = _notebooks.get(folder)
+    if notebook is None:
+        notebook = _notebooks[folder] = Notebook(folder)
+
+    report = {
+        'notebook': folder,
+        'file': filename,
+        'state': 'error',
+        'error': None,
+        'time': 0,
+        'statements': [],
+    }
+
+    worksheet = Worksheet(notebook)
+    try:
+        try:
+            worksheet.load(os.path.join(folder, filename))
+        except (IOError, reunicode.ConversionError), e:
+            report['error'] = str(e)
+            return report
+
+        worksheet.statement_timeout = statement_timeout
+        worksheet.execution_timeout = timeout
+
+        start = time.time()
+        worksheet.calculate(wait=True)
+        report['time'] = time.time() - start
+
+        if worksheet.state == NotebookFile.EXECUTE_SUCCESS:
+            report['state'] = 'success'
+
+        for chunk in worksheet.iterate_chunks():
+            if not isinstance(chunk, StatementChunk) or chunk.statement is None:
+                continue
+
+            statement = chunk.statement
+            metrics = statement.metrics
+            if chunk.results is not None:
+                results = [_format_result(result) for result in chunk.results]
+            else:
+                results = []
+
+            report['statements'].append({
+                'line': chunk.start + 1,
+                'state': _STATE_NAMES[statement.state],
+                'results': results,
+                'error': chunk.error_message,
+                'error_line': chunk.error_line,
+                'compile_time': metrics.compile_time,
+                'execute_time': metrics.execute_time,
+                'cpu_time': metrics.cpu_time,
+            })
+    finally:
+        worksheet.close()
+
+    return report
+
+def format_text(report):
+    """Format the report from run_worksheet() as text
+
+    @param report: the report
+    @returns: the text, as a unicode string ending in a newline
+
+    """
+
+    lines = [u"%s: %s (%.3fs)" % (os.path.join(report['notebook'], report['file']),
+                                   report['state'], report['time'])]
+    if report['error'] is not None:
+        lines.append(u"    " + report['error'])
+
+    for s in report['statements']:
+        if s['execute_time'] is not None:
+            lines.append(u"  line %d: %s (%.3fs)" % (s['line'], s['state'], s['execute_time']))
+        else:
+            lines.append(u"  line %d: %s" % (s['line'], s['state']))
+        for text in s['results']:
+            lines.extend(u"    " + line for line in text.split(u"\n"))
+        if s['error'] is not None:
+            lines.extend(u"    " + line for line in s['error'].split(u"\n"))
+
+    return u"\n".join(lines) + u"\n"
+
+def _init_process():
+    # Called in each process that runs worksheets
+    gobject.threads_init()
+    stdout_capture.init()
+
+def _run_job(job):
+    # Called in the worker processes when running worksheets in parallel
+    folder, filename, statement_timeout, timeout = job
+    return run_worksheet(folder, filename, statement_timeout, timeout)
+
+def main():
+    parser = OptionParser(usage="%prog [options] WORKSHEET_OR_NOTEBOOK...")
+    parser.add_option("-f", "--format", choices=("text", "json"), default="text",
+                      help="the format of the report (text or json)")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="write the report to FILE rather than standard output")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="the number of worksheets to run at once, each in a separate process")
+    parser.add_option("--statement-timeout", type="float", metavar="SECONDS",
+                      help="interrupt statements that run for longer than SECONDS")
+    parser.add_option("--timeout", type="float", metavar="SECONDS",
+                      help="interrupt each worksheet after SECONDS")
+
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        parser.error("no worksheets or notebooks given")
+
+    jobs = []
+    for arg in args:
+        if not os.path.exists(arg):
+            parser.error("'%s' does not exist" % arg)
+        for folder, filename in find_worksheets(arg):
+            jobs.append((folder, filename, options.statement_timeout, options.timeout))
+
+    # The report is written to the real stdout, not the one that captures
+    # the output of statements
+    if options.output is not None:
+        out = open(options.output, "w")
+    else:
+        out = sys.stdout
+
+    if options.jobs > 1 and len(jobs) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(options.jobs, len(jobs)), _init_process)
+        reports = pool.imap(_run_job, jobs)
+    else:
+        pool = None
+        _init_process()
+        reports = (_run_job(job) for job in jobs)
+
+    success = True
+    all_reports = []
+    try:
+        for report in reports:
+            if report['state'] != 'success':
+                success = False
+            if options.format == "json":
+                all_reports.append(report)
+            else:
+                out.write(format_text(report).encode("UTF-8"))
+                out.flush()
+
+        if options.format == "json":
+            json.dump(all_reports, out, indent=2)
+            out.write("\n")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if out is not sys.stdout:
+            out.close()
+
+    if not success:
+        sys.exit(1)
+
+######################################################################
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+
+    from test_utils import assert_equals
+
+    _init_process()
+
+    folder = tempfile.mkdtemp("", "reinteract_notebook.")
+
+    def write_file(name, contents):
+        absname = os.path.join(folder, name)
+        dirname = os.path.dirname(absname)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        f = open(absname, "w")
+        f.write(contents)
+        f.close()
+
+    try:
+        write_file("index.rnb", "[Notebook]\n")
+        write_file("a.rws", "a = 1\n# A comment\na + 1\nprint 'x'")
+        write_file("sub/b.rws", "b\n")
+        write_file("lib.py", "")
+
+        assert_equals(find_worksheets(folder), [(folder, "a.rws"), (folder, "sub/b.rws")])
+        assert_equals(find_worksheets(os.path.join(folder, "sub/b.rws")), [(folder, "sub/b.rws")])
+
+        report = run_worksheet(folder, "a.rws")
+        assert_equals(report['state'], 'success')
+        assert_equals([s['line'] for s in report['statements']], [1, 3, 4])
+        assert_equals([s['results'] for s in report['statements']], [[], ['2'], ['x']])
+        assert report['statements'][1]['execute_time'] is not None
+
+        text = format_text(report)
+        assert text.startswith(os.path.join(folder, "a.rws") + ": success (")
+        assert u"  line 3: success (" in text
+        assert u"\n    2\n" in text
+
+        report = run_worksheet(folder, "sub/b.rws")
+        assert_equals(report['state'], 'error')
+        assert_equals(report['statements'][0]['state'], 'error')
+        assert "NameError" in format_text(report)
+
+        report = run_worksheet(folder, "missing.rws")
+        assert_equals(report['state'], 'error')
+        assert report['error'] is not None
+
+        write_file("slow.rws", "import time\ntime.sleep(5)")
+        report = run_worksheet(folder, "slow.rws", statement_timeout=0.2)
+        assert_equals(report['statements'][1]['state'], 'interrupted')
+        assert_equals(report['statements'][1]['error'], "Timed out after 0.2 seconds")
+
+        # The report can be written as JSON
+        json.loads(json.dumps(report))
+    finally:
+        shutil.rmtree(folder)
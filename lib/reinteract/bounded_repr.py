@@ -0,0 +1,210 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import sys
+
+#
+# The result of an expression statement is shown as its repr, but the repr of
+# a big container can take a long time to compute and be much longer than
+# anyone would read. bounded_repr() computes the repr of the builtin containers
+# itself, stopping at limits on the nesting depth, the number of items of each
+# container, the length of strings and the total length, so the full repr is
+# never built. For small values, the result is the same as repr().
+#
+# Objects of other types (including subclasses of the builtin containers, which
+# might override __repr__) are formatted with repr() and then truncated.
+#
+
+#: maximum length of the result, in characters
+MAX_LENGTH = 10000
+#: containers nested deeper than this are shown as [...]
+MAX_DEPTH = 6
+#: maximum number of items shown for each container
+MAX_ITEMS = 100
+#: maximum number of characters shown for each string
+MAX_STRING = 1000
+
+class _Truncated(Exception):
+    pass
+
+class _BoundedRepr(object):
+    def __init__(self, max_length, max_depth, max_items, max_string):
+        self.max_length = max_length
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.max_string = max_string
+
+        self.pieces = []
+        self.length = 0
+        # ids of the containers being formatted, to detect recursion
+        self.active = set()
+
+    def write(self, s):
+        if self.length + len(s) > self.max_length:
+            self.pieces.append(s[0:self.max_length - self.length])
+            self.length = self.max_length
+            raise _Truncated()
+
+        self.pieces.append(s)
+        self.length += len(s)
+
+    def __write_items(self, items, write_item):
+        for i, item in enumerate(items):
+            if i > 0:
+                self.write(", ")
+            if i == self.max_items:
+                self.write("...")
+                break
+            write_item(item)
+
+    def __write_sequence(self, value, depth, open, close):
+        self.write(open)
+        self.__write_items(value, lambda item: self.format(item, depth + 1))
+        # A tuple with one item needs a trailing comma
+        if type(value) is tuple and len(value) == 1:
+            self.write(",")
+        self.write(close)
+
+    def __write_dict(self, value, depth):
+        def write_item((k, v)):
+            self.format(k, depth + 1)
+            self.write(": ")
+            self.format(v, depth + 1)
+
+        self.write("{")
+        self.__write_items(value.iteritems(), write_item)
+        self.write("}")
+
+    def __write_string(self, value):
+        if len(value) > self.max_string:
+            r = repr(value[0:self.max_string])
+            # Keep the closing quote
+            self.write(r[0:-1] + "..." + r[-1])
+        else:
+            self.write(repr(value))
+
+    def __write_ndarray(self, value):
+        # numpy summarizes big numeric arrays itself, but an object array
+        # shows every element
+        if value.dtype.hasobject and value.size > self.max_items:
+            self.write("<%s.%s shape=%r dtype=object>" % (type(value).__module__, type(value).__name__, value.shape))
+        else:
+            self.write(repr(value))
+
+    def format(self, value, depth=0):
+        t = type(value)
+
+        if t in (str, unicode):
+            self.__write_string(value)
+            return
+
+        if t is _get_ndarray_type():
+            self.__write_ndarray(value)
+            return
+
+        if not t in (list, tuple, dict, set, frozenset):
+            self.write(repr(value))
+            return
+
+        if id(value) in self.active or depth >= self.max_depth:
+            if t is list:
+                self.write("[...]")
+            elif t is tuple:
+                self.write("(...)")
+            elif t is dict:
+                self.write("{...}")
+            else:
+                self.write("%s([...])" % t.__name__)
+            return
+
+        self.active.add(id(value))
+        try:
+            if t is list:
+                self.__write_sequence(value, depth, "[", "]")
+            elif t is tuple:
+                self.__write_sequence(value, depth, "(", ")")
+            elif t is dict:
+                self.__write_dict(value, depth)
+            else:
+                self.__write_sequence(value, depth, "%s([" % t.__name__, "])")
+        finally:
+            self.active.remove(id(value))
+
+def _get_ndarray_type():
+    # We don't want to import numpy if the worksheet hasn't
+    numpy = sys.modules.get('numpy')
+    if numpy is None:
+        return None
+
+    return numpy.ndarray
+
+def bounded_repr(value, max_length=MAX_LENGTH, max_depth=MAX_DEPTH, max_items=MAX_ITEMS, max_string=MAX_STRING):
+    """Return the repr of a value, shortened if it is long
+
+    @param value: the value
+    @param max_length: maximum length of the result; if longer, the result is cut off and ends with '...'
+    @param max_depth: containers nested deeper than this are shown as [...]
+    @param max_items: maximum number of items shown for each list, tuple, dict or set
+    @param max_string: maximum number of characters shown for each string
+    @returns: the repr, as a str (or a unicode, if repr() of some object returned one)
+
+    """
+
+    r = _BoundedRepr(max_length, max_depth, max_items, max_string)
+    try:
+        r.format(value)
+    except _Truncated:
+        r.pieces.append("...")
+
+    return "".join(r.pieces)
+
+######################################################################
+
+if __name__ == '__main__':
+    from test_utils import assert_equals
+
+    # Small values are the same as repr()
+    for value in [1, 1.5, 'a', u'\u00e9', None, (), (1,), (1, 2), [], [1, [2, 3]],
+                  {}, {1: 'a', 'b': [2]}, set(), set([1]), frozenset([1]), object]:
+        assert_equals(bounded_repr(value), repr(value))
+
+    assert_equals(bounded_repr(range(10), max_items=3), "[0, 1, 2, ...]")
+    assert_equals(bounded_repr(dict.fromkeys([1]), max_items=0), "{...}")
+    assert_equals(bounded_repr([[[1]]], max_depth=2), "[[[...]]]")
+    assert_equals(bounded_repr('a' * 10, max_string=3), "'aaa...'")
+    assert_equals(bounded_repr(u'a' * 10, max_string=3), "u'aaa...'")
+    assert_equals(bounded_repr(range(1000), max_length=10), "[0, 1, 2, ...")
+
+    l = [1]
+    l.append(l)
+    assert_equals(bounded_repr(l), repr(l))
+    d = {}
+    d[1] = d
+    assert_equals(bounded_repr(d), repr(d))
+
+    # Subclasses may have their own repr
+    class MyList(list):
+        def __repr__(self):
+            return "MyList"
+    assert_equals(bounded_repr([MyList()]), "[MyList]")
+
+    # The full repr of a big container is never built
+    class Unrepresentable(object):
+        def __repr__(self):
+            raise AssertionError("repr() called")
+    assert_equals(bounded_repr([1, Unrepresentable()], max_items=1), "[1, ...]")
+
+    try:
+        import numpy
+
+        a = numpy.arange(10)
+        assert_equals(bounded_repr(a), repr(a))
+        a = numpy.array([None] * 1000, dtype=object)
+        assert_equals(bounded_repr(a), "<numpy.ndarray shape=(1000,) dtype=object>")
+    except ImportError:
+        pass
@@ -0,0 +1,296 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+# Once a scope would have to look through this many parent scopes to
+# resolve a name, we flatten it into a single dictionary instead.
+_MAX_DEPTH = 16
+
+class ChainedScope(dict):
+    """
+
+    Dictionary used as the scope of a statement that stores only the names that
+    the statement binds itself; other names are looked up in the parent scopes.
+
+    Because the class is a subclass of dict, names bound by the statement itself
+    are found at C speed when the scope is used as the locals of an exec; only
+    lookups that fall through to a parent scope go through __missing__. Names
+    deleted by the statement are tracked separately in self.deleted so that they
+    hide the values in the parent scopes.
+
+    A ChainedScope can't be used as the globals of an exec unless it is
+    flat (has no parents) since lookups of global variables bypass __missing__.
+
+    A scope should not be modified once the statement that owns it has finished
+    executing, since child scopes refer to it; seal() should be called at that
+    point.
+
+    """
+
+    def __init__(self, parent=None, flatten=False):
+        """Initialize the ChainedScope object
+
+        @param parent: the scope to look up names in that aren't bound in this scope. Can be
+           another ChainedScope, a plain dictionary, or None
+        @param flatten: if True, all names in the parent scopes are copied into this scope,
+           rather than being looked up as needed. This will also be done if the chain of
+           parent scopes gets too long.
+
+        """
+        dict.__init__(self)
+
+        #: names deleted in this scope that may exist in parent scopes
+        self.deleted = set()
+
+        if parent is None:
+            self.__chain = ()
+            self.__base = None
+        elif isinstance(parent, ChainedScope):
+            self.__chain = (parent,) + parent.__chain
+            self.__base = parent.__base
+        else:
+            self.__chain = ()
+            self.__base = parent
+
+        # For a flattened scope, we can't distinguish the names bound in the
+        # scope from the names copied from the parents, so until seal() is
+        # called, we remember the parent to compare against.
+        self.__flattened_parent = None
+        self.__local = None
+
+        if flatten or len(self.__chain) > _MAX_DEPTH:
+            dict.update(self, self.__flatten_parents())
+            self.__flattened_parent = parent
+            self.__chain = ()
+            self.__base = None
+
+    def __flatten_parents(self):
+        if self.__base is not None:
+            result = dict(self.__base)
+        else:
+            result = {}
+
+        for scope in reversed(self.__chain):
+            for name in scope.deleted:
+                result.pop(name, None)
+            dict.update(result, scope)
+
+        return result
+
+    def __lookup(self, name):
+        # Look up a name not bound in this scope, returning a (found, value) tuple
+        if name in self.deleted:
+            return False, None
+
+        for scope in self.__chain:
+            if dict.__contains__(scope, name):
+                return True, dict.__getitem__(scope, name)
+            if name in scope.deleted:
+                return False, None
+
+        if self.__base is not None and name in self.__base:
+            return True, self.__base[name]
+
+        return False, None
+
+    def __missing__(self, name):
+        found, value = self.__lookup(name)
+        if not found:
+            raise KeyError(name)
+
+        return value
+
+    def __delitem__(self, name):
+        visible_in_parent, _ = self.__lookup(name)
+        if dict.__contains__(self, name):
+            dict.__delitem__(self, name)
+        elif not visible_in_parent:
+            raise KeyError(name)
+
+        if visible_in_parent:
+            self.deleted.add(name)
+        if self.__local is not None:
+            self.__local.pop(name, None)
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or self.__lookup(name)[0]
+
+    has_key = __contains__
+
+    def get(self, name, default=None):
+        if dict.__contains__(self, name):
+            return dict.__getitem__(self, name)
+
+        found, value = self.__lookup(name)
+        if found:
+            return value
+        else:
+            return default
+
+    def flatten(self):
+        """Return a new plain dictionary holding all the names visible in the scope"""
+
+        result = self.__flatten_parents()
+        for name in self.deleted:
+            result.pop(name, None)
+        dict.update(result, self)
+
+        return result
+
+    copy = flatten
+
+    def seal(self):
+        """Indicate that no further changes will be made to the scope."""
+
+        parent = self.__flattened_parent
+        if parent is None:
+            return
+
+        self.__flattened_parent = None
+        self.__local = {}
+        self.deleted = set()
+        for name, value in dict.iteritems(self):
+            # exec adds __builtins__ to a scope used as globals
+            if name == '__builtins__':
+                continue
+            # get() is fine here since we are comparing identity
+            if parent.get(name, self) is not value:
+                self.__local[name] = value
+        for name in parent.iterkeys():
+            if not dict.__contains__(self, name):
+                self.deleted.add(name)
+
+    def local_items(self):
+        """Return a list of (name, value) pairs for the names bound in this scope itself
+
+        If the scope has been flattened, this is only accurate after seal() has been called.
+
+        """
+
+        if self.__local is not None:
+            return self.__local.items()
+        else:
+            return dict.items(self)
+
+    def rebase(self, parent):
+        """Create a copy of the scope on top of a different parent
+
+        The new scope has the names bound and deleted in this scope, looking up
+        other names in parent. This is used when the scope of a parent statement
+        changes, but the names that the statement uses have not changed, so the
+        statement doesn't need to be reexecuted.
+
+        @param parent: the parent of the new scope
+
+        """
+
+        scope = ChainedScope(parent)
+        for name in self.deleted:
+            if name in scope:
+                del scope[name]
+        for name, value in self.local_items():
+            dict.__setitem__(scope, name, value)
+        scope.seal()
+
+        return scope
+
+    def get_depth(self):
+        """Return the number of parent scopes that are searched when looking up a name"""
+
+        return len(self.__chain)
+
+    def keys(self):
+        return self.flatten().keys()
+
+    def values(self):
+        return self.flatten().values()
+
+    def items(self):
+        return self.flatten().items()
+
+    def iterkeys(self):
+        return self.flatten().iterkeys()
+
+    def itervalues(self):
+        return self.flatten().itervalues()
+
+    def iteritems(self):
+        return self.flatten().iteritems()
+
+    __iter__ = iterkeys
+
+    def __len__(self):
+        return len(self.flatten())
+
+    def __repr__(self):
+        return "ChainedScope(%r)" % (self.flatten(),)
+
+######################################################################
+
+if __name__ == '__main__':
+    from test_utils import assert_equals
+
+    root = { 'a': 1, 'b': 2 }
+
+    s1 = ChainedScope(root)
+    s1['a'] = 3
+    assert_equals(s1['a'], 3)
+    assert_equals(s1['b'], 2)
+    assert_equals(root['a'], 1)
+    assert_equals(s1.local_items(), [('a', 3)])
+    assert_equals(sorted(s1.keys()), ['a', 'b'])
+
+    # Deleting a name from the parent hides it
+    s2 = ChainedScope(s1)
+    del s2['b']
+    assert 'b' not in s2
+    assert_equals(s2.get('b'), None)
+    assert_equals(sorted(s2.items()), [('a', 3)])
+    assert_equals(s1['b'], 2)
+
+    # And it can be rebound after
+    s3 = ChainedScope(s2)
+    s3['b'] = 4
+    assert_equals(s3['b'], 4)
+    try:
+        del s3['c']
+        raise AssertionError("Deleting a nonexistent name should raise KeyError")
+    except KeyError:
+        pass
+
+    # Using the scope as the locals of an exec
+    s4 = ChainedScope(s3)
+    exec "c = a + b\ndel a" in {}, s4
+    assert_equals(s4.flatten(), { 'b': 4, 'c': 7 })
+    assert_equals(s3.flatten(), { 'a': 3, 'b': 4 })
+
+    # A long chain gets flattened
+    scope = root
+    for i in xrange(0, _MAX_DEPTH * 2):
+        scope = ChainedScope(scope)
+        scope['x%d' % i] = i
+        assert scope.get_depth() <= _MAX_DEPTH
+    assert_equals(scope['x0'], 0)
+    assert_equals(len(scope), 2 + _MAX_DEPTH * 2)
+
+    # A flat scope can be the globals of an exec
+    flat = ChainedScope(s3, flatten=True)
+    exec "def f(): return a + b\nd = f()\ndel a" in flat, flat
+    assert_equals(flat['d'], 7)
+    assert_equals(flat.get_depth(), 0)
+    flat.seal()
+    assert_equals(sorted(name for name, _ in flat.local_items()), ['d', 'f'])
+    assert_equals(flat.deleted, set(['a']))
+
+    # Rebasing a scope onto a new parent
+    s5 = ChainedScope(root)
+    s5['b'] = 5
+    rebased = s4.rebase(s5)
+    assert_equals(rebased.flatten(), { 'b': 5, 'c': 7 })
+    rebased = flat.rebase(s5)
+    assert_equals(sorted(rebased.keys()), ['b', 'd', 'f'])
+    assert_equals(rebased['b'], 5)
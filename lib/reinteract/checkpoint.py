@@ -0,0 +1,307 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import cPickle
+import errno
+import hashlib
+import os
+import re
+import sys
+import tempfile
+
+# Bump this when the format of the checkpoint entries changes
+_CHECKPOINT_VERSION = 1
+
+# Files belonging to the entry for a key are named <key>.pickle and <key>.<n>.npy
+_ENTRY_FILE_RE = re.compile(r'^([0-9a-f]{40})\.(?:pickle|\d+\.npy)$')
+
+def make_key(previous_key, text):
+    """Compute the checkpoint key for a statement
+
+    The key is a hash of the text of the statement and the texts of all the
+    statements before it in the worksheet, so it changes when any previous
+    statement changes. (The features imported from __future__ are determined
+    by the previous statements, so they don't need to be included separately.)
+
+    @param previous_key: the key of the previous statement in the worksheet, or None
+    @param text: the text of the statement
+    @returns: the key, as a string of hex digits
+
+    """
+
+    if isinstance(text, unicode):
+        text = text.encode("UTF-8")
+
+    h = hashlib.sha1()
+    h.update(repr((_CHECKPOINT_VERSION, previous_key, text)))
+
+    return h.hexdigest()
+
+def get_directory(filename):
+    """Return the directory where the checkpoint for a worksheet file is stored
+
+    @param filename: the filename of the worksheet
+
+    """
+
+    folder, basename = os.path.split(os.path.abspath(filename))
+    return os.path.join(folder, ".cache", "checkpoints", basename)
+
+def _get_numpy_array_type():
+    # We never import numpy ourselves; if the worksheet hasn't imported it,
+    # there can't be any arrays to save
+    numpy = sys.modules.get('numpy')
+    if numpy is None:
+        return None
+
+    return numpy.ndarray
+
+class Checkpoint(object):
+    """
+
+    Saved state of a worksheet's statements, so that the results of executing a
+    worksheet survive closing and reopening it. For each statement that executed
+    successfully, the entry stores the results and the names the statement bound
+    and deleted; an entry is keyed by the text of the statement and of all the
+    statements before it (see make_key()).
+
+    The values are pickled; numpy arrays are stored separately in numpy's native
+    format and are memory-mapped copy-on-write when loaded, so a large array is
+    only read from disk as it is used. If a value can't be pickled, no entry is
+    stored for the statement, and it will be reexecuted when the worksheet is
+    next loaded.
+
+    Unlike a ResultCache, entries are never evicted by size; instead the
+    worksheet calls prune() to remove the entries for statements that are no
+    longer in the worksheet.
+
+    """
+
+    def __init__(self, directory):
+        """Initialize the Checkpoint object
+
+        @param directory: directory to store the entries in. Will be created if it doesn't exist
+
+        """
+
+        self.directory = directory
+
+    def __get_filename(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def __get_array_filename(self, key, n):
+        return os.path.join(self.directory, "%s.%d.npy" % (key, n))
+
+    def has_entry(self, key):
+        """Return True if there is an entry for the key
+
+        @param key: the key to check for
+
+        """
+
+        return os.path.exists(self.__get_filename(key))
+
+    def lookup(self, key):
+        """Look up the entry for a key
+
+        @param key: the key to look up
+        @returns: a tuple of (results, bound, deleted) as passed to store(),
+           or None if there is no entry for the key or it can't be loaded.
+
+        """
+
+        try:
+            f = open(self.__get_filename(key), "rb")
+        except IOError:
+            return None
+
+        def persistent_load(pid):
+            kind, n = pid
+            if kind != 'ndarray':
+                raise cPickle.UnpicklingError("Unknown persistent id %r" % (pid,))
+
+            import numpy
+            filename = self.__get_array_filename(key, n)
+            try:
+                return numpy.load(filename, mmap_mode='c')
+            except ValueError:
+                # Empty arrays can't be memory-mapped
+                return numpy.load(filename)
+
+        try:
+            try:
+                unpickler = cPickle.Unpickler(f)
+                unpickler.persistent_load = persistent_load
+                version, results, bound, deleted = unpickler.load()
+            except Exception:
+                # Corrupt, or refers to a module or class that no longer exists
+                return None
+        finally:
+            f.close()
+
+        if version != _CHECKPOINT_VERSION:
+            return None
+
+        return results, bound, deleted
+
+    def store(self, key, results, bound, deleted):
+        """Store the entry for a statement
+
+        If the entry can't be pickled, nothing is stored. Errors writing the
+        files (for example, if the directory isn't writable) are ignored.
+
+        @param key: the key to store the entry under
+        @param results: list of results from the statement
+        @param bound: list of (name, value) pairs for the names bound by the statement
+        @param deleted: list of names deleted by the statement
+        @returns: True if the entry was stored
+
+        """
+
+        try:
+            os.makedirs(self.directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                return False
+
+        ndarray = _get_numpy_array_type()
+        array_filenames = []
+
+        def persistent_id(obj):
+            if ndarray is None or type(obj) is not ndarray or obj.dtype.hasobject:
+                return None
+
+            import numpy
+            n = len(array_filenames)
+            filename = self.__get_array_filename(key, n)
+            array_filenames.append(filename)
+            numpy.save(filename, obj)
+
+            return ('ndarray', n)
+
+        # Write to a temporary file and rename into place so that a concurrent
+        # reader never sees a partial entry; the arrays are written first so
+        # that they are complete by the time the entry is visible.
+        success = False
+        try:
+            handle, tmpname = tempfile.mkstemp(".tmp", "entry", self.directory)
+        except OSError:
+            return False
+        try:
+            f = os.fdopen(handle, "wb")
+            try:
+                pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = persistent_id
+                pickler.dump((_CHECKPOINT_VERSION, results, bound, deleted))
+            finally:
+                f.close()
+            os.rename(tmpname, self.__get_filename(key))
+            success = True
+        except Exception:
+            pass
+
+        if not success:
+            for filename in [tmpname] + array_filenames:
+                self.__remove(filename)
+
+        return success
+
+    def remove(self, key):
+        """Remove the entry for a key, if there is one
+
+        @param key: the key of the entry to remove
+
+        """
+
+        self.__remove(self.__get_filename(key))
+
+        # Arrays are numbered from 0, with no gaps
+        n = 0
+        while os.path.exists(self.__get_array_filename(key, n)):
+            self.__remove(self.__get_array_filename(key, n))
+            n += 1
+
+    def prune(self, keys):
+        """Remove all entries other than the ones for the given keys
+
+        @param keys: the keys of the entries to keep
+
+        """
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+
+        for name in names:
+            m = _ENTRY_FILE_RE.match(name)
+            if m and m.group(1) not in keys:
+                self.__remove(os.path.join(self.directory, name))
+
+    def __remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+######################################################################
+
+if __name__ == '__main__':
+    import shutil
+
+    from test_utils import assert_equals
+
+    assert_equals(get_directory("/tmp/Notebook/Worksheet.rws"),
+                  "/tmp/Notebook/.cache/checkpoints/Worksheet.rws")
+
+    key1 = make_key(None, u"a = 1")
+    key2 = make_key(key1, u"b = a")
+    key3 = make_key(key2, u"c = b")
+    assert_equals(key1, make_key(None, "a = 1"))
+    assert key2 != make_key(make_key(None, u"a = 2"), u"b = a")
+
+    directory = tempfile.mkdtemp("", "reinteract_checkpoint")
+    try:
+        checkpoint = Checkpoint(os.path.join(directory, "checkpoints"))
+
+        assert_equals(checkpoint.has_entry(key1), False)
+        assert_equals(checkpoint.lookup(key1), None)
+        assert_equals(checkpoint.store(key1, [u'1'], [('a', [1, 2])], ['c']), True)
+        assert_equals(checkpoint.has_entry(key1), True)
+        assert_equals(checkpoint.lookup(key1), ([u'1'], [('a', [1, 2])], ['c']))
+
+        # Things that can't be pickled aren't stored
+        assert_equals(checkpoint.store(key2, [], [('f', lambda x: x)], []), False)
+        assert_equals(checkpoint.lookup(key2), None)
+        assert_equals(os.listdir(checkpoint.directory), [key1 + ".pickle"])
+
+        try:
+            import numpy
+
+            a = numpy.arange(10)
+            assert_equals(checkpoint.store(key2, [], [('a', a), ('e', numpy.zeros(0))], []), True)
+            results, bound, deleted = checkpoint.lookup(key2)
+            assert_equals(bound[0][1].tolist(), range(10))
+            assert_equals(len(bound[1][1]), 0)
+            # Modifying the loaded array doesn't modify the stored one
+            bound[0][1][0] = 100
+            assert_equals(checkpoint.lookup(key2)[1][0][1][0], 0)
+        except ImportError:
+            pass
+
+        assert_equals(checkpoint.store(key3, [], [], []), True)
+        checkpoint.remove(key3)
+        assert_equals(checkpoint.has_entry(key3), False)
+        checkpoint.remove(key3)
+
+        checkpoint.prune(set([key2]))
+        assert_equals(checkpoint.lookup(key1), None)
+        checkpoint.prune(set())
+        assert_equals(os.listdir(checkpoint.directory), [])
+    finally:
+        shutil.rmtree(directory)
@@ -86,6 +86,10 @@ class StatementChunk(Chunk):
         self.statement = None
 
         self.results = None
+        # Last lines of output while the statement is executing, shown in place of the results
+        self.live_output = None
+        # StatementMetrics from the last compilation or execution
+        self.metrics = None
 
         self.error_message = None
         self.error_line = None
@@ -111,6 +115,29 @@ class StatementChunk(Chunk):
 
         return True
 
+    def __get_statement_names(self):
+        if self.statement is not None and \
+                self.statement.state != Statement.NEW and \
+                self.statement.state != Statement.COMPILE_ERROR:
+            return self.statement.reads, self.statement.writes
+        else:
+            # Before compilation, we have to assume that the statement
+            # might read or bind any name in it, or output a value to '_'
+            names = self.tokenized.get_names()
+            if names is None:
+                return None, None
+            return names, names | set(['_'])
+
+    def get_reads(self):
+        """Return the set of names the statement reads, or None if they can't be determined"""
+
+        return self.__get_statement_names()[0]
+
+    def get_writes(self):
+        """Return the set of names the statement binds or deletes, or None if they can't be determined"""
+
+        return self.__get_statement_names()[1]
+
     def mark_for_execute(self):
         if self.statement is not None and not self.needs_execute:
             self.statement.mark_for_execute()
@@ -129,6 +156,10 @@ class StatementChunk(Chunk):
 
     def update_statement(self):
         self.status_changed = True
+        self.metrics = self.statement.metrics
+
+        if self.statement.state != Statement.EXECUTING:
+            self.clear_live_output()
 
         if self.statement.state == Statement.COMPILE_SUCCESS:
             self.needs_compile = False
@@ -166,7 +197,10 @@ class StatementChunk(Chunk):
             self.executing = False
             self.needs_compile = False
             self.needs_execute = True
-            self.error_message = "Interrupted"
+            if self.statement.error_message is not None:
+                self.error_message = self.statement.error_message
+            else:
+                self.error_message = "Interrupted"
             self.error_line = None
             self.error_offset = None
             self.results = None
@@ -175,6 +209,24 @@ class StatementChunk(Chunk):
             # NEW/EXECUTING should not be hit here
             raise AssertionError("Unexpected state in Chunk.update_statement()")
 
+    def set_live_output(self, live_output):
+        """Set the output to show while the statement is executing
+
+        @returns: True if the output changed
+
+        """
+
+        if live_output == self.live_output:
+            return False
+
+        self.live_output = live_output
+        self.results_changed = True
+
+        return True
+
+    def clear_live_output(self):
+        self.set_live_output(None)
+
 class BlankChunk(Chunk):
 
     """
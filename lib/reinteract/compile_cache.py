@@ -0,0 +1,300 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import errno
+import hashlib
+import imp
+import marshal
+import os
+import tempfile
+
+import rewrite
+
+# Maximum number of compiled statements to keep
+DEFAULT_MAX_SIZE = 1000
+
+# Bump this when the format of the values stored by Statement.compile() changes
+_FORMAT_VERSION = 2
+
+# Header of the files in a BytecodeCache; files with a different header were
+# written by a different version of Python or of Reinteract
+_MAGIC = imp.get_magic() + "RWC%d.%d\n" % (rewrite.VERSION, _FORMAT_VERSION)
+
+# Indices into the entries of the linked list
+_PREV = 0
+_NEXT = 1
+_KEY = 2
+_VALUE = 3
+
+class CompileCache(object):
+    """
+
+    Bounded cache of the result of compiling statements. Compiling a statement
+    involves parsing it, rewriting the parse tree, and compiling the result,
+    so when the same text is compiled again (because of undo, or because a
+    change was reverted) it's worth avoiding the work.
+
+    The cache is keyed by the text of the statement and the features imported
+    from __future__, which are the only inputs to compilation. When the cache
+    is full, the least recently used entry is discarded.
+
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        """Initialize the CompileCache object
+
+        @param max_size: maximum number of entries to keep
+
+        """
+
+        self.max_size = max_size
+
+        #: number of lookups that found an entry
+        self.hits = 0
+        #: number of lookups that didn't find an entry
+        self.misses = 0
+
+        self.__entries = {}
+        # Circular doubly linked list of entries, most recently used first
+        self.__root = [None, None, None, None]
+        self.__root[_PREV] = self.__root
+        self.__root[_NEXT] = self.__root
+
+    def __make_key(self, text, future_features):
+        if future_features is not None:
+            future_features = tuple(future_features)
+
+        return (text, future_features)
+
+    def __unlink(self, entry):
+        entry[_PREV][_NEXT] = entry[_NEXT]
+        entry[_NEXT][_PREV] = entry[_PREV]
+
+    def __link_first(self, entry):
+        root = self.__root
+        entry[_PREV] = root
+        entry[_NEXT] = root[_NEXT]
+        root[_NEXT][_PREV] = entry
+        root[_NEXT] = entry
+
+    def lookup(self, text, future_features):
+        """Look up the result of compiling a statement
+
+        @param text: the text of the statement
+        @param future_features: list of features imported from __future__, or None
+        @returns: the value passed to store(), or None if there is no entry
+
+        """
+
+        entry = self.__entries.get(self.__make_key(text, future_features))
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.__unlink(entry)
+        self.__link_first(entry)
+
+        return entry[_VALUE]
+
+    def store(self, text, future_features, value):
+        """Store the result of compiling a statement
+
+        @param text: the text of the statement
+        @param future_features: list of features imported from __future__, or None
+        @param value: the value to store. Must not be modified afterwards.
+
+        """
+
+        key = self.__make_key(text, future_features)
+        entry = self.__entries.get(key)
+        if entry is not None:
+            self.__unlink(entry)
+            entry[_VALUE] = value
+        else:
+            entry = [None, None, key, value]
+            self.__entries[key] = entry
+        self.__link_first(entry)
+
+        while len(self.__entries) > self.max_size:
+            last = self.__root[_PREV]
+            self.__unlink(last)
+            del self.__entries[last[_KEY]]
+
+    def clear(self):
+        """Remove all entries from the cache"""
+
+        self.__entries = {}
+        self.__root[_PREV] = self.__root
+        self.__root[_NEXT] = self.__root
+
+    def __len__(self):
+        return len(self.__entries)
+
+class BytecodeCache(object):
+    """
+
+    On-disk cache of the result of compiling statements, so that the compiled
+    code survives between sessions, in the manner of .pyc files. Each entry is
+    stored in a separate file named after a hash of the text of the statement
+    and the features imported from __future__. The value stored must be
+    marshallable: code objects, strings, numbers, and tuples, lists and
+    frozensets of those.
+
+    Files are marked with the Python bytecode magic number and the version of
+    the Rewriter; files written by a different version are ignored.
+
+    """
+
+    def __init__(self, directory):
+        """Initialize the BytecodeCache object
+
+        @param directory: directory to store the cache files in. Will be created if it doesn't exist
+
+        """
+
+        self.directory = directory
+
+    def __get_filename(self, text, future_features):
+        if isinstance(text, unicode):
+            text = text.encode("UTF-8")
+        if future_features is not None:
+            future_features = tuple(future_features)
+
+        h = hashlib.sha1()
+        h.update(repr((text, future_features)))
+
+        return os.path.join(self.directory, h.hexdigest() + ".rwc"), text, future_features
+
+    def lookup(self, text, future_features):
+        """Look up the result of compiling a statement
+
+        @param text: the text of the statement
+        @param future_features: list of features imported from __future__, or None
+        @returns: the value passed to store(), or None if there is no entry
+
+        """
+
+        filename, text, future_features = self.__get_filename(text, future_features)
+        try:
+            f = open(filename, "rb")
+        except IOError:
+            return None
+
+        try:
+            try:
+                if f.read(len(_MAGIC)) != _MAGIC:
+                    return None
+                stored_text, stored_future_features, value = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                return None
+        finally:
+            f.close()
+
+        # Guard against hash collisions
+        if stored_text != text or stored_future_features != future_features:
+            return None
+
+        return value
+
+    def store(self, text, future_features, value):
+        """Store the result of compiling a statement
+
+        Errors writing the file (for example, if the directory isn't writable)
+        are ignored.
+
+        @param text: the text of the statement
+        @param future_features: list of features imported from __future__, or None
+        @param value: the value to store
+
+        """
+
+        filename, text, future_features = self.__get_filename(text, future_features)
+        try:
+            data = marshal.dumps((text, future_features, value))
+        except ValueError:
+            return
+
+        try:
+            try:
+                os.makedirs(self.directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    return
+
+            # Write to a temporary file and rename into place so that a
+            # concurrent reader never sees a partial file
+            handle, tmpname = tempfile.mkstemp(".tmp", "entry", self.directory)
+            f = os.fdopen(handle, "wb")
+            try:
+                f.write(_MAGIC)
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmpname, filename)
+        except (IOError, OSError):
+            pass
+
+#: cache used for all statements
+compile_cache = CompileCache()
+
+######################################################################
+
+if __name__ == '__main__':
+    from test_utils import assert_equals
+
+    cache = CompileCache(max_size=2)
+    assert_equals(cache.lookup("a", None), None)
+    cache.store("a", None, 1)
+    cache.store("a", ['division'], 2)
+    assert_equals(cache.lookup("a", None), 1)
+    assert_equals(cache.lookup("a", ['division']), 2)
+    assert_equals((cache.hits, cache.misses), (2, 1))
+
+    # "a", None was used least recently, so it is evicted
+    cache.store("b", None, 3)
+    assert_equals(len(cache), 2)
+    assert_equals(cache.lookup("a", None), None)
+    assert_equals(cache.lookup("a", ['division']), 2)
+    assert_equals(cache.lookup("b", None), 3)
+
+    # Storing an existing key replaces the value
+    cache.store("b", None, 4)
+    assert_equals(cache.lookup("b", None), 4)
+    assert_equals(len(cache), 2)
+
+    cache.clear()
+    assert_equals(len(cache), 0)
+    assert_equals(cache.lookup("b", None), None)
+
+    #
+    # Tests of BytecodeCache
+    #
+    import shutil
+
+    directory = tempfile.mkdtemp("", "reinteract_compile_cache")
+    try:
+        cache = BytecodeCache(os.path.join(directory, "bytecode"))
+        code = compile("a = 1", "<test>", "exec")
+        assert_equals(cache.lookup(u"a = 1", None), None)
+        cache.store(u"a = 1", None, (code, [], frozenset(['a'])))
+        assert_equals(cache.lookup(u"a = 1", None), (code, [], frozenset(['a'])))
+        assert_equals(cache.lookup(u"a = 1", ['division']), None)
+
+        # A file with a different header is ignored
+        filename = os.path.join(cache.directory, os.listdir(cache.directory)[0])
+        f = open(filename, "r+b")
+        f.write("XXXX")
+        f.close()
+        assert_equals(cache.lookup(u"a = 1", None), None)
+
+        # Unmarshallable values are silently not stored
+        cache.store(u"b = 1", None, (object(),))
+        assert_equals(cache.lookup(u"b = 1", None), None)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,174 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import copy
+import threading
+import types
+
+#
+# When a statement modifies an object that it got from a previous statement,
+# the object is copied first, so that the result of the previous statement
+# isn't changed (see Rewriter.rewrite_and_compile()). This module decides how
+# each object is copied. By default, copy.copy() is used, but a different
+# strategy can be registered for a type; library modules can register
+# strategies for the types they define:
+#
+#   import reinteract.copy_strategy as copy_strategy
+#   copy_strategy.register(MyType, 'my-type', MyType.clone)
+#
+
+# Strategies, keyed by type or by 'module.Name'
+_strategies = {}
+
+class _LastStrategy(threading.local):
+    # Name of the strategy last used by copy_value() in this thread
+    def __init__(self):
+        self.name = None
+
+_last_strategy = _LastStrategy()
+
+def register(type_, name, copy_func):
+    """Register a strategy for copying objects that a statement modifies
+
+    The strategy is used for objects of the type and its subclasses, unless a
+    strategy is registered for a more specific type.
+
+    @param type_: the type, or a string 'module.Name' naming it, so that a strategy
+       can be registered without importing the module that defines the type
+    @param name: a short name for the strategy, used in reporting which strategy was used
+    @param copy_func: function that takes an object and returns a copy that can be
+       modified without affecting the original. Should raise an exception if that
+       isn't possible.
+
+    """
+
+    _strategies[type_] = (name, copy_func)
+
+def unregister(type_):
+    """Remove the strategy registered for a type
+
+    @param type_: the type or string passed to register()
+
+    """
+
+    _strategies.pop(type_, None)
+
+def lookup(value):
+    """Find the strategy for copying an object
+
+    @param value: the object to copy
+    @returns: a tuple of (name, copy_func)
+
+    """
+
+    for cls in type(value).__mro__:
+        strategy = _strategies.get(cls)
+        if strategy is None:
+            strategy = _strategies.get("%s.%s" % (cls.__module__, cls.__name__))
+        if strategy is not None:
+            return strategy
+
+    # Not reached, since there is a strategy for object
+    return 'copy', copy.copy
+
+def copy_value(value):
+    """Copy an object using the strategy registered for its type
+
+    This is the function used as __reinteract_copy when executing statements.
+
+    @param value: the object to copy
+    @returns: the copy
+
+    """
+
+    name, copy_func = lookup(value)
+    _last_strategy.name = name
+
+    return copy_func(value)
+
+def pop_last_strategy():
+    """Return the name of the strategy last used by copy_value() in this thread and forget it
+
+    @returns: the name of the strategy, or None if copy_value() hasn't been called since
+       the last call to pop_last_strategy()
+
+    """
+
+    name = _last_strategy.name
+    _last_strategy.name = None
+
+    return name
+
+def _share(value):
+    # An object that can't be modified doesn't need to be copied
+    return value
+
+def _copy_ndarray(value):
+    # A read-only array can't be modified in place, so the buffer can be shared
+    if not value.flags.writeable:
+        return value
+
+    return value.copy(order='K')
+
+register(object, 'copy', copy.copy)
+for t in (types.NoneType, bool, int, long, float, complex, str, unicode, tuple, frozenset,
+          types.FunctionType, types.BuiltinFunctionType, type, types.ClassType):
+    register(t, 'shared', _share)
+register('numpy.ndarray', 'ndarray', _copy_ndarray)
+
+######################################################################
+
+if __name__ == '__main__':
+    from test_utils import assert_equals
+
+    l = [[1], 2]
+    c = copy_value(l)
+    assert c is not l and c[0] is l[0]
+    assert_equals(pop_last_strategy(), 'copy')
+    assert_equals(pop_last_strategy(), None)
+
+    t = (1, 2)
+    assert copy_value(t) is t
+    assert_equals(pop_last_strategy(), 'shared')
+
+    # Strategies apply to subclasses, and can be registered by name
+    class MyList(list):
+        pass
+
+    register(list, 'list', lambda l: type(l)(l))
+    assert isinstance(copy_value(MyList([1])), MyList)
+    assert_equals(pop_last_strategy(), 'list')
+    unregister(list)
+
+    register(__name__ + '.MyList', 'my-list', lambda l: MyList(l))
+    copy_value(MyList([1]))
+    assert_equals(pop_last_strategy(), 'my-list')
+    unregister(__name__ + '.MyList')
+    copy_value(MyList([1]))
+    assert_equals(pop_last_strategy(), 'copy')
+
+    # Old-style instances
+    class Old:
+        pass
+
+    o = Old()
+    assert copy_value(o) is not o
+
+    try:
+        import numpy
+
+        a = numpy.arange(10)
+        b = copy_value(a)
+        assert_equals(pop_last_strategy(), 'ndarray')
+        b[0] = 100
+        assert_equals(a[0], 0)
+
+        a.flags.writeable = False
+        assert copy_value(a) is a
+    except ImportError:
+        pass
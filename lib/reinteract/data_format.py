@@ -8,10 +8,14 @@
 
 import re
 import inspect
+import itertools
 import pydoc
+import sys
 import gtk
 from cStringIO import StringIO
 
+from bounded_repr import bounded_repr
+
 #
 # For most objects, we simply call their repr() function, but we handle
 # tuples, lists, and dicts specially. We handle them in one of two ways:
@@ -27,6 +31,12 @@ from cStringIO import StringIO
 #    Lists and Tuples are formatted this way if them items in the sequence
 #    have short, single-line representations.
 #
+# Items are formatted as they are needed, so we stop as soon as we run out
+# of lines; the cost of formatting a huge list is the same as for a short
+# one. The repr() of other objects is limited to what could be shown (see
+# bounded_repr()), and numpy arrays that numpy abbreviates get an extra line
+# summarizing all their values.
+#
     
 # total maximum number of lines
 _MAX_LINES = 17
@@ -40,6 +50,10 @@ _MAX_WRAPPED_ITEM_LINES = 5
 # max line width when line-wrapping
 _MAX_WIDTH = 80
 
+# dictionaries with more items than this are shown unsorted, since sorting
+# would take longer than formatting the few items we show
+_MAX_SORTED_ITEMS = 1000
+
 # Common parameters to the functions below:
 #
 #  open: opening delimeter
@@ -158,8 +172,13 @@ def __format_wrapped(sequence, open, close, nl):
 def __format_dict(obj, nl, object_stack):
     nl = nl + " "
 
+    if len(obj) <= _MAX_SORTED_ITEMS:
+        items = sorted(obj.iteritems())
+    else:
+        items = obj.iteritems()
+
     def iter():
-        for key, value in sorted(obj.items()):
+        for key, value in items:
             key_str, key_lines = __format(key, nl, object_stack)
             value_str, value_lines = __format(value, nl, object_stack)
 
@@ -169,15 +188,44 @@ def __format_dict(obj, nl, object_stack):
 
 def __format_sequence(obj, open, close, nl, object_stack):
     nl = nl + " "
-    
-    seq = (__format(x, nl, object_stack) for x in obj)
-    result = __format_wrapped(seq, open, close, nl)
+
+    # If wrapping fails, we don't want to format the items we already
+    # formatted again
+    formatted = []
+    def iter():
+        for x in obj:
+            item = __format(x, nl, object_stack)
+            formatted.append(item)
+            yield item
+
+    result = __format_wrapped(iter(), open, close, nl)
     if result is None:
-        seq = (__format(x, nl, object_stack) for x in obj)
-        result = __format_separate(seq, open, close, nl)
+        rest = (__format(x, nl, object_stack) for x in itertools.islice(obj, len(formatted), None))
+        result = __format_separate(itertools.chain(formatted, rest), open, close, nl)
 
     return result
 
+def __get_ndarray_type():
+    # We don't want to import numpy if nothing else has
+    numpy = sys.modules.get('numpy')
+    if numpy is None:
+        return None
+
+    return numpy.ndarray
+
+def __format_ndarray(obj, nl):
+    numpy = sys.modules['numpy']
+
+    s = repr(obj)
+    # numpy only shows the items at the start and end of a big array; the
+    # minimum and maximum are computed over all of them
+    if obj.size > numpy.get_printoptions()['threshold']:
+        s += "\nshape %s, dtype %s" % (obj.shape, obj.dtype)
+        if obj.dtype.kind in 'biuf':
+            s += ", min %s, max %s" % (obj.min(), obj.max())
+
+    return s.replace("\n", nl), 1 + s.count("\n")
+
 def __format(obj, nl, object_stack):
     for o in object_stack:
         if obj is o:
@@ -193,8 +241,10 @@ def __format(obj, nl, object_stack):
         return __format_sequence(obj, '[', ']', nl, object_stack)
     elif issubclass(t, tuple) and repr_attr is tuple.__repr__:
         return __format_sequence(obj, '(', ')', nl, object_stack)
+    elif t is __get_ndarray_type():
+        return __format_ndarray(obj, nl)
     else:
-        s = repr(obj)
+        s = bounded_repr(obj, max_length=_MAX_LINES * _MAX_WIDTH)
         return s.replace("\n", nl),  1 + s.count("\n")
 
 def format(obj):
@@ -332,9 +382,35 @@ if __name__ == "__main__":
                 """
                 [1.0, 1.0]
                 """)
+
+        a = numpy.arange(10000)
+        assert format(a).endswith("\nshape (10000,), dtype %s, min 0, max 9999" % a.dtype)
     except ImportError:
         pass
 
+    # Big dictionaries aren't sorted
+    do_test(dict(((x, x) for x in range(_MAX_SORTED_ITEMS + 1))),
+            """
+            {0: 0,
+             1: 1,
+             2: 2,
+             3: 3,
+             ...}
+            """)
+
+    # Items are only formatted once, and only if they are shown
+    class Counted(object):
+        count = 0
+        def __repr__(self):
+            Counted.count += 1
+            return "C"
+
+    format([Counted()] * 3 + ["a" * 30])
+    assert Counted.count == 3
+
+    format([Counted()] * 1000000)
+    assert Counted.count < 100
+
     a = [1]
     a.append(a)
 
@@ -194,6 +194,14 @@ class Editor(gobject.GObject):
     def calculate(self, end_at_insert=False):
         pass
 
+    @property
+    def can_profile(self):
+        return (self.state != NotebookFile.NONE and
+                self.state != NotebookFile.EXECUTING)
+
+    def profile_statement(self, mode):
+        pass
+
     def undo(self):
         pass
 
@@ -40,6 +40,8 @@ class EditorWindow(BaseWindow):
          <separator/>
          <menuitem action="calculate"/>
          <menuitem action="calculate-to-line"/>
+         <menuitem action="profile-statement"/>
+         <menuitem action="profile-statement-sampling"/>
          <menuitem action="break"/>
          <separator/>
          <menuitem action="preferences"/>
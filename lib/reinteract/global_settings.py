@@ -23,6 +23,15 @@ def _bool_property(name, default):
 
     return gobject.property(getter=getter, setter=setter, type=bool, default=default)
 
+def _int_property(name, default):
+    def getter(self):
+        return self.config.get_int('Reinteract', name, default)
+
+    def setter(self, value):
+        self.config.set_int('Reinteract', name, value)
+
+    return gobject.property(getter=getter, setter=setter, type=int, default=default)
+
 def _string_property(name, default=None):
     def getter(self):
         return self.config.get_string('Reinteract', name, default)
@@ -50,6 +59,34 @@ class GlobalSettings(gobject.GObject):
 
     autocomplete = _bool_property('autocomplete', default=True)
 
+    # Execute worksheets in a separate process (see ProcessExecutor)
+    process_executor = _bool_property('process_executor', default=False)
+    # Number of independent statements to execute at once (see ThreadExecutor)
+    max_workers = _int_property('max_workers', default=1)
+    # Copy objects that statements modify when they are modified rather than beforehand
+    # (see Worksheet.lazy_copy for why it's off by default)
+    lazy_copy = _bool_property('lazy_copy', default=False)
+    # Modify objects in place rather than copying them when only the previous statement refers to them
+    elide_copies = _bool_property('elide_copies', default=False)
+    # Calculate worksheets automatically while editing
+    live_execution = _bool_property('live_execution', default=False)
+    # How long to wait after the last edit before calculating, in milliseconds
+    live_delay = _int_property('live_delay', default=300)
+    # Show how long each statement took to execute next to it
+    show_statement_times = _bool_property('show_statement_times', default=False)
+    # Number of result scopes of the last statements to keep in memory; 0 for no limit
+    retained_scopes = _int_property('retained_scopes', default=0)
+    # Memory to use for the result scopes of the last statements, in megabytes; 0 for no limit
+    retained_scopes_memory = _int_property('retained_scopes_memory', default=0)
+    # Save released result scopes to disk rather than reexecuting statements to get them back
+    spill_scopes = _bool_property('spill_scopes', default=True)
+    # Number of lines of output from a statement to show before the rest is hidden; 0 for no limit
+    max_output_lines = _int_property('max_output_lines', default=1000)
+    # Seconds a statement may execute before it is interrupted; 0 for no limit
+    statement_timeout = _int_property('statement_timeout', default=0)
+    # Seconds a calculation of a worksheet may take before it is interrupted; 0 for no limit
+    execution_timeout = _int_property('execution_timeout', default=0)
+
     def __init__(self):
         gobject.GObject.__init__(self)
 
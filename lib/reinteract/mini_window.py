@@ -42,6 +42,8 @@ class MiniWindow(BaseNotebookWindow):
          <separator/>
          <menuitem action="calculate"/>
          <menuitem action="calculate-to-line"/>
+         <menuitem action="profile-statement"/>
+         <menuitem action="profile-statement-sampling"/>
          <menuitem action="break"/>
          <separator/>
          <menuitem action="calculate-all"/>
@@ -7,14 +7,16 @@
 #
 ########################################################################
 
-import copy
 import gobject
 import imp
 import os
 import pkgutil
 import sys
 
+from compile_cache import BytecodeCache
+import copy_strategy
 from notebook_info import NotebookInfo
+from result_cache import ResultCache
 
 # Used to give each notebook a unique namespace
 _counter = 1
@@ -130,6 +132,21 @@ class Notebook(gobject.GObject):
         else:
             self.info = None
 
+        #: on-disk cache of compiled statements. See L{BytecodeCache}
+        if folder:
+            self.bytecode_cache = BytecodeCache(os.path.join(folder, ".cache", "bytecode"))
+        else:
+            self.bytecode_cache = None
+
+        #: cache of statement results, if enabled for the notebook. See L{ResultCache}
+        self.result_cache = None
+        if self.info and self.info.cache_results:
+            cache_size = self.info.cache_size
+            if cache_size is not None:
+                self.result_cache = ResultCache(os.path.join(folder, ".cache"), cache_size * 1024 * 1024)
+            else:
+                self.result_cache = ResultCache(os.path.join(folder, ".cache"))
+
         self.refresh()
 
     ############################################################
@@ -385,7 +402,7 @@ class Notebook(gobject.GObject):
 
     def setup_globals(self, globals):
         globals['__reinteract_notebook'] = self
-        globals['__reinteract_copy'] = copy.copy
+        globals['__reinteract_copy'] = copy_strategy.copy_value
         globals['help'] = _Helper()
 
     def file_for_absolute_path(self, absolute_path):
@@ -112,3 +112,39 @@ class NotebookInfo(object):
         self.__save()
 
     description = property(__get_description, __set_description)
+
+    def __get_cache_results(self):
+        if self.__parser.has_option('Notebook', 'cache_results'):
+            return self.__parser.getboolean('Notebook', 'cache_results')
+        else:
+            return False
+
+    def __set_cache_results(self, cache_results):
+        self.__parser.set('Notebook', 'cache_results', cache_results and 'true' or 'false')
+        self.__save()
+
+    # Whether the results of executing statements should be cached on disk
+    cache_results = property(__get_cache_results, __set_cache_results)
+
+    @property
+    def cache_size(self):
+        # Maximum size of the result cache, in megabytes
+        if self.__parser.has_option('Notebook', 'cache_size'):
+            try:
+                return self.__parser.getint('Notebook', 'cache_size')
+            except ValueError:
+                pass
+        return None
+
+    def __get_checkpoint_results(self):
+        if self.__parser.has_option('Notebook', 'checkpoint_results'):
+            return self.__parser.getboolean('Notebook', 'checkpoint_results')
+        else:
+            return False
+
+    def __set_checkpoint_results(self, checkpoint_results):
+        self.__parser.set('Notebook', 'checkpoint_results', checkpoint_results and 'true' or 'false')
+        self.__save()
+
+    # Whether the results of executing worksheets should be saved along with them
+    checkpoint_results = property(__get_checkpoint_results, __set_checkpoint_results)
@@ -52,6 +52,8 @@ class NotebookWindow(BaseNotebookWindow):
          <separator/>
          <menuitem action="calculate"/>
          <menuitem action="calculate-to-line"/>
+         <menuitem action="profile-statement"/>
+         <menuitem action="profile-statement-sampling"/>
          <menuitem action="break"/>
          <separator/>
          <menuitem action="calculate-all"/>
@@ -0,0 +1,286 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import os
+import tempfile
+
+import gtk
+
+from custom_result import CustomResult
+
+# Number of lines shown each time the user asks for more
+_PAGE_LINES = 1000
+
+# (pid, filename) for the files of the OutputResults that exist in this process
+_files = set()
+
+def remove_files():
+    """Remove the files of the OutputResults created in this process
+
+    For a process that exits without freeing its objects, like the worker
+    process of a ProcessExecutor. Copies of the results sent to other processes
+    have their own files. Files created by the process this one was forked from
+    are left alone.
+
+    """
+
+    pid = os.getpid()
+    for file_pid, filename in list(_files):
+        if file_pid == pid:
+            _files.discard((file_pid, filename))
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+class OutputResult(CustomResult):
+    """
+
+    Output of a statement past the limit on the number of lines kept in its
+    results. The lines are written to a temporary file rather than kept in
+    memory, and the widget shows how many there are, showing them a page at a
+    time when the user asks for them.
+
+    The file is removed when the OutputResult is freed. Copies made by pickling
+    (for example, in the result cache, or to send the results of a worker process)
+    contain the lines, and write them to a file of their own when unpickled.
+
+    """
+
+    def __init__(self):
+        #: number of lines written
+        self.line_count = 0
+        #: name of the file holding the lines, UTF-8 encoded
+        self.filename = None
+
+        # Offset in the file of the start of each page
+        self.__page_offsets = []
+        self.__file = None
+        # True if the lines were lost (see __setstate__)
+        self.__lost = False
+
+    def __getstate__(self):
+        if self.__file is not None:
+            self.__file.flush()
+
+        contents = None
+        if self.filename is not None:
+            try:
+                f = open(self.filename, "rb")
+                try:
+                    contents = f.read()
+                finally:
+                    f.close()
+            except IOError:
+                pass
+
+        return (self.line_count, self.__page_offsets, contents)
+
+    def __setstate__(self, state):
+        self.line_count, self.__page_offsets, contents = state
+        self.filename = None
+        self.__file = None
+        self.__lost = False
+
+        if contents is not None:
+            self.__create_file()
+            self.__file.write(contents)
+            self.finish()
+        elif self.line_count > 0:
+            self.__lost = True
+
+    # The module globals may have been cleared when this is called at exit
+    def __del__(self, files=_files, getpid=os.getpid, remove=os.remove):
+        self.finish()
+        if self.filename is not None:
+            files.discard((getpid(), self.filename))
+            try:
+                remove(self.filename)
+            except OSError:
+                pass
+
+    def __create_file(self):
+        handle, self.filename = tempfile.mkstemp(".txt", "reinteract_output")
+        self.__file = os.fdopen(handle, "wb")
+        _files.add((os.getpid(), self.filename))
+
+    def write_line(self, line):
+        """Add a line of output
+
+        @param line: the line, without a trailing newline
+
+        """
+
+        if self.__file is None:
+            self.__create_file()
+
+        if self.line_count % _PAGE_LINES == 0:
+            self.__page_offsets.append(self.__file.tell())
+
+        self.__file.write(line.encode("UTF-8"))
+        self.__file.write("\n")
+        self.line_count += 1
+
+    def finish(self):
+        """Close the file after the last line has been written"""
+
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def read_page(self, page):
+        """Read a page of the lines
+
+        @param page: index of the page, starting from 0
+        @returns: a list of at most _PAGE_LINES unicode strings, or None if the
+           lines are no longer available
+
+        """
+
+        if self.__lost:
+            return None
+        if self.filename is None or page >= len(self.__page_offsets):
+            return []
+
+        try:
+            f = open(self.filename, "rb")
+        except IOError:
+            return None
+
+        try:
+            f.seek(self.__page_offsets[page])
+            lines = []
+            for i in xrange(0, _PAGE_LINES):
+                line = f.readline()
+                if line == "":
+                    break
+                lines.append(line[:-1].decode("UTF-8"))
+        finally:
+            f.close()
+
+        return lines
+
+    def create_widget(self):
+        widget = gtk.VBox(spacing=4)
+
+        label = gtk.Label()
+        label.set_alignment(0, 0.5)
+
+        button = gtk.Button("Show More")
+        button.set_relief(gtk.RELIEF_NONE)
+
+        hbox = gtk.HBox(spacing=4)
+        hbox.pack_start(label, expand=False, fill=False)
+        hbox.pack_start(button, expand=False, fill=False)
+        widget.pack_start(hbox, expand=False, fill=False)
+
+        buf = gtk.TextBuffer()
+        view = gtk.TextView(buf)
+        view.set_editable(False)
+        scrolled = gtk.ScrolledWindow()
+        scrolled.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        scrolled.set_shadow_type(gtk.SHADOW_IN)
+        scrolled.set_size_request(-1, 300)
+        scrolled.add(view)
+        widget.pack_start(scrolled, expand=True, fill=True)
+
+        # Each widget for the result is expanded separately
+        state = { 'pages': 0, 'shown': 0 }
+
+        def update_label():
+            remaining = self.line_count - state['shown']
+            if remaining == 1:
+                label.set_text("1 more line")
+            else:
+                label.set_text("%d more lines" % remaining)
+            button.set_property('visible', remaining > 0)
+
+        def on_clicked(button):
+            lines = self.read_page(state['pages'])
+            if lines is None:
+                label.set_text("%d more lines (no longer available)" % (self.line_count - state['shown']))
+                button.hide()
+                return
+
+            end = buf.get_end_iter()
+            if state['shown'] > 0:
+                buf.insert(end, "\n")
+            buf.insert(end, "\n".join(lines))
+            state['pages'] += 1
+            state['shown'] += len(lines)
+            scrolled.show()
+            update_label()
+
+        button.connect('clicked', on_clicked)
+
+        widget.show_all()
+        scrolled.hide()
+        update_label()
+
+        return widget
+
+######################################################################
+
+if __name__ == '__main__':
+    import cPickle
+
+    from test_utils import assert_equals
+
+    result = OutputResult()
+    assert_equals(result.read_page(0), [])
+    for i in xrange(0, 2500):
+        result.write_line(u"line %d \u00e9" % i)
+    result.finish()
+    assert_equals(result.line_count, 2500)
+
+    page = result.read_page(0)
+    assert_equals(len(page), 1000)
+    assert_equals(page[0], u"line 0 \u00e9")
+    assert_equals(result.read_page(2), [u"line %d \u00e9" % i for i in xrange(2000, 2500)])
+    assert_equals(result.read_page(3), [])
+
+    # A pickled copy has the lines in a file of its own
+    filename = result.filename
+    copy = cPickle.loads(cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))
+    assert copy.filename != filename
+    assert_equals(copy.read_page(1)[0], u"line 1000 \u00e9")
+    copy_filename = copy.filename
+    del copy
+    assert not os.path.exists(copy_filename)
+    assert os.path.exists(filename)
+
+    data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+    del result
+    assert not os.path.exists(filename)
+    copy = cPickle.loads(data)
+    assert_equals(copy.read_page(2)[-1], u"line 2499 \u00e9")
+
+    # If the file is gone when pickling, the lines are lost
+    os.remove(copy.filename)
+    lost = cPickle.loads(cPickle.dumps(copy, cPickle.HIGHEST_PROTOCOL))
+    assert_equals(lost.line_count, 2500)
+    assert_equals(lost.read_page(0), None)
+    assert_equals(cPickle.loads(cPickle.dumps(OutputResult())).read_page(0), [])
+
+    # Files of results created in this process are removed by remove_files()
+    result = OutputResult()
+    result.write_line(u"x")
+    result.finish()
+    remove_files()
+    assert not os.path.exists(result.filename)
+
+    # But not those of a process this one was forked from
+    result = OutputResult()
+    result.write_line(u"x")
+    result.finish()
+    pid = os.fork()
+    if pid == 0:
+        remove_files()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.path.exists(result.filename)
@@ -0,0 +1,789 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import cPickle
+from cStringIO import StringIO
+import errno
+import gobject
+import os
+import signal
+import struct
+import sys
+import time
+import types
+
+import output_result
+from statement import Statement
+from thread_executor import ThreadExecutor
+
+# How long to wait after asking the worker process to stop before we kill it (ms)
+_KILL_TIMEOUT = 1000
+
+# How often the watchdog checks whether the execution has run too long (ms)
+_WATCHDOG_INTERVAL = 100
+
+_HEADER = struct.Struct("!I")
+
+class _TransferError(Exception):
+    pass
+
+# Types of objects that are always sent by value; their identity doesn't matter
+_ATOMIC_TYPES = frozenset([type(None), bool, int, long, float, complex, str, unicode])
+
+def _index_nested_objects(known):
+    # Returns a dictionary mapping the ids of the objects in the lists, tuples and
+    # dicts among the known objects to (object, (known_id, path)), where path
+    # is the sequence of indices and keys to get from the known object to it.
+    # This is only done in the worker, where it doesn't hold up the user interface,
+    # and the main process just follows the path. The objects are kept in the
+    # dictionary, so their ids aren't reused for new objects.
+    index = {}
+    for known_id, value in known.iteritems():
+        pending = [(value, ())]
+        while pending:
+            value, path = pending.pop()
+            if type(value) in (list, tuple):
+                items = enumerate(value)
+            elif type(value) is dict:
+                # Keys are sent as part of the path, so they must be simple
+                items = ((k, v) for k, v in value.iteritems() if type(k) in _ATOMIC_TYPES)
+            else:
+                continue
+
+            for k, item in items:
+                key = id(item)
+                if type(item) in _ATOMIC_TYPES or key in index or key in known:
+                    continue
+                item_path = path + (k,)
+                index[key] = (item, (known_id, item_path))
+                pending.append((item, item_path))
+
+    return index
+
+class ProcessExecutor(gobject.GObject):
+    """Class to execute Python statements asynchronously in a separate process
+
+    ProcessExecutor has the same interface and signals as L{ThreadExecutor}, but
+    executes the statements in a worker process forked from the main process.
+    The worker starts with a copy of the scopes of the worksheet, so no data needs
+    to be transferred to it. After each statement, it sends the results and the
+    names bound by the statement back to the main process. Objects that already
+    existed when the worker was forked - the values in the scopes of the worksheet
+    and the objects in lists, tuples and dicts among them - are sent back as
+    references rather than by value, so (for example) a large array is never
+    transferred unless a statement creates a new one. Other objects reachable from
+    them (attributes of instances or members of sets, for example) are sent back
+    by value, and so are copies in the main process rather than the same objects.
+
+    Because the code runs in a different process, it doesn't compete with the user
+    interface for the global interpreter lock, and it can be stopped even if it's
+    stuck in native code by killing the worker process. A new worker is forked
+    for each execution, so killing one never loses any state.
+
+    Not everything can be sent between processes: functions and classes defined in
+    the worksheet, for example, can't be pickled. When the results of a statement
+    can't be sent back, the remaining statements are executed in the main process
+    with a ThreadExecutor.
+
+    Since the worker is a forked copy of the main process, it has copies of
+    everything in it, not just the worksheet: anything else a statement changes in
+    the worker is lost when the worker exits. This includes modules imported for
+    the first time, changes to the globals of modules, and files opened or written
+    through buffers that aren't flushed. Only the calling thread exists in the
+    worker, so a statement that needs a lock held by another thread of the main
+    process at the time of the fork, or that uses GTK, may hang or crash the worker.
+    For these reasons, ProcessExecutor is only used when enabled in the settings.
+
+    As for ThreadExecutor, statement_timeout and timeout limit how long the
+    execution may take; when a limit is exceeded, the executor is interrupted,
+    which kills the worker if it doesn't stop.
+
+    """
+
+    __gsignals__ = {
+        'statement-executing' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'statement-complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        'complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+    }
+
+    @staticmethod
+    def is_supported():
+        """Return True if ProcessExecutor can be used on this platform"""
+
+        return hasattr(os, 'fork')
+
+    def __init__(self, parent_statement=None, max_workers=1, pool=None):
+        """Initialize the ProcessExecutor object
+
+        @param parent_statement: previous statement defining the execution environment for the first statement
+        @param max_workers: maximum number of statements to execute at once when falling
+          back to a ThreadExecutor. (The worker process executes statements sequentially.)
+        @param pool: L{WorkerPool} for the ThreadExecutor used when falling back
+
+        """
+        gobject.GObject.__init__(self)
+
+        self.parent_statement = parent_statement
+        self.statements = []
+        self.max_workers = max_workers
+        self.pool = pool
+
+        self.complete = False
+        self.interrupted = False
+
+        #: maximum time in seconds that a statement may execute before it is
+        #: interrupted, or None. Must be set before calling execute()
+        self.statement_timeout = None
+        #: maximum time in seconds that executing all the statements may take
+        #: before the execution is interrupted, or None. Must be set before calling execute()
+        self.timeout = None
+
+        self.__pid = None
+        self.__fd = None
+        self.__watch_id = 0
+        self.__kill_id = 0
+        self.__known = None
+        self.__loads = None
+        self.__chunks = []
+        self.__chunks_length = 0
+        self.__executing = None
+        self.__executing_start = None
+        self.__start_time = None
+        self.__watchdog_id = 0
+        self.__last_signalled = -1
+        self.__thread_executor = None
+
+    def add_statement(self, statement):
+        """Add a statement to the list of statements that the executor will execute."""
+
+        self.statements.append(statement)
+
+    def compile(self):
+        """Compile all statements.
+
+        See L{ThreadExecutor.compile}.
+
+        @returns: True if all statements compiled successfully
+
+        """
+
+        success = True
+        parent = self.parent_statement
+        for statement in self.statements:
+            statement.set_parent(parent)
+            if not statement.compile():
+                success = False
+            parent = statement
+
+        if not success:
+            for statement in self.statements:
+                self.emit('statement-complete', statement)
+            self.emit('complete')
+
+        return success
+
+    ############################################################
+    # Worker process
+    ############################################################
+
+    def __write_message(self, fd, message):
+        data = _HEADER.pack(len(message)) + message
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+
+    def __create_pickler(self):
+        # Objects that existed when we forked are sent as references. We use
+        # a single pickler for all messages so that when two statements refer
+        # to the same new object, that is preserved in the main process.
+        known = self.__known
+        # Objects inside the known objects are found the first time that we
+        # send something that might be one of them
+        nested = []
+        def persistent_id(obj):
+            if isinstance(obj, types.ModuleType):
+                return ('module', obj.__name__)
+            key = id(obj)
+            if key in known and known[key] is obj:
+                return ('known', key)
+            if type(obj) in _ATOMIC_TYPES:
+                return None
+            if not nested:
+                nested.append(_index_nested_objects(known))
+            entry = nested[0].get(key)
+            if entry is not None and entry[0] is obj:
+                return ('nested', entry[1])
+            return None
+
+        output = StringIO()
+        pickler = cPickle.Pickler(output, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+
+        def dumps(obj, clear_memo=False):
+            # After a failure, the memo may refer to objects that were never sent
+            if clear_memo:
+                pickler.clear_memo()
+            output.seek(0)
+            output.truncate()
+            pickler.dump(obj)
+            return output.getvalue()
+
+        return dumps
+
+    def __run_child(self, fd):
+        # KeyboardInterrupt is how we are asked to stop
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        dumps = self.__create_pickler()
+
+        for i, statement in enumerate(self.statements):
+            # The parent process does the same thing
+            if statement.state == Statement.EXECUTE_SUCCESS and statement.rebase():
+                continue
+
+            self.__write_message(fd, dumps(('executing', i)))
+            try:
+                statement.execute()
+            except KeyboardInterrupt:
+                pass
+
+            try:
+                message = dumps(('complete', i, statement.get_execution_state()))
+            except Exception:
+                self.__write_message(fd, dumps(('fallback', i), clear_memo=True))
+                return
+
+            self.__write_message(fd, message)
+
+            if statement.state != Statement.EXECUTE_SUCCESS:
+                break
+
+    ############################################################
+    # Main process
+    ############################################################
+
+    def __create_unpickler(self):
+        known = self.__known
+        def persistent_load(pid):
+            kind, value = pid
+            if kind == 'module':
+                try:
+                    return sys.modules[value]
+                except KeyError:
+                    raise _TransferError("Module %s not loaded" % value)
+            elif kind == 'nested':
+                # The containers are the same as when the worker was forked,
+                # unless a statement changed them without our noticing
+                key, path = value
+                try:
+                    obj = known[key]
+                    for index in path:
+                        obj = obj[index]
+                except (IndexError, KeyError, TypeError):
+                    raise _TransferError("Object in a container changed by the worker")
+                return obj
+            else:
+                return known[value]
+
+        input = _MessageReader()
+        unpickler = cPickle.Unpickler(input)
+        unpickler.persistent_load = persistent_load
+
+        def loads(data):
+            input.set_data(data)
+            return unpickler.load()
+
+        return loads
+
+    def __signal_complete_through(self, index):
+        for i in xrange(self.__last_signalled + 1, index + 1):
+            self.emit('statement-complete', self.statements[i])
+        self.__last_signalled = max(self.__last_signalled, index)
+
+    def __rebase_through(self, index):
+        # Catch up with the statements that the worker rebased rather than executing
+        for i in xrange(self.__last_signalled + 1, index):
+            if i > 0:
+                parent = self.statements[i - 1]
+            else:
+                parent = self.parent_statement
+            if parent is not None and parent.state != Statement.EXECUTE_SUCCESS:
+                break
+
+            statement = self.statements[i]
+            if statement.state == Statement.EXECUTE_SUCCESS and not statement.rebase():
+                # The child process executes the statement instead
+                break
+
+    def __handle_message(self, message):
+        kind = message[0]
+        index = message[1]
+
+        self.__rebase_through(index)
+        self.__signal_complete_through(index - 1)
+
+        if kind == 'executing':
+            self.__executing = index
+            self.__executing_start = time.time()
+            self.emit('statement-executing', self.statements[index])
+        elif kind == 'complete':
+            self.__executing = None
+            self.statements[index].set_execution_state(message[2])
+            self.__signal_complete_through(index)
+        elif kind == 'fallback':
+            self.__fall_back(index)
+
+    def __process_input(self):
+        # Handle all complete messages that we've read so far
+        while self.__pid is not None:
+            if self.__chunks_length < _HEADER.size:
+                return
+
+            data = "".join(self.__chunks)
+            length = _HEADER.unpack(data[0:_HEADER.size])[0]
+            if len(data) < _HEADER.size + length:
+                self.__chunks = [data]
+                return
+
+            message_data = data[_HEADER.size:_HEADER.size + length]
+            data = data[_HEADER.size + length:]
+            self.__chunks = [data]
+            self.__chunks_length = len(data)
+
+            try:
+                message = self.__loads(message_data)
+            except Exception:
+                # The worker sent back something we couldn't understand, like
+                # a reference to a module that isn't loaded in this process.
+                # The message must have been about a completed statement.
+                self.__fall_back(self.__executing)
+                return
+
+            self.__handle_message(message)
+
+    def __on_readable(self, fd, condition):
+        try:
+            data = os.read(fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                return True
+            data = ''
+
+        if data:
+            self.__chunks.append(data)
+            self.__chunks_length += len(data)
+            self.__process_input()
+            return self.__pid is not None
+        else:
+            self.__watch_id = 0
+            self.__finish()
+            return False
+
+    def __cleanup_child(self, kill):
+        if self.__watch_id:
+            gobject.source_remove(self.__watch_id)
+            self.__watch_id = 0
+        if self.__kill_id:
+            gobject.source_remove(self.__kill_id)
+            self.__kill_id = 0
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+        if self.__pid is not None:
+            if kill:
+                try:
+                    os.kill(self.__pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            os.waitpid(self.__pid, 0)
+            self.__pid = None
+
+        self.__known = None
+        self.__loads = None
+
+    def __finish(self):
+        self.__cleanup_child(kill=False)
+
+        # If the worker exited in the middle of a statement, it was killed, or
+        # crashed in native code.
+        if self.__executing is not None:
+            statement = self.statements[self.__executing]
+            if self.interrupted:
+                statement.set_execution_state((Statement.INTERRUPTED, None, None, None,
+                                               None, None, None, None, None, statement.metrics))
+            else:
+                statement.set_execution_state((Statement.EXECUTE_ERROR, None, None, None,
+                                               "Worker process exited unexpectedly", None, None,
+                                               None, None, statement.metrics))
+            self.__signal_complete_through(self.__executing)
+            self.__executing = None
+        else:
+            self.__rebase_through(len(self.statements))
+
+        self.__complete()
+
+    def __complete(self):
+        if self.__watchdog_id:
+            gobject.source_remove(self.__watchdog_id)
+            self.__watchdog_id = 0
+
+        self.complete = True
+        self.__signal_complete_through(len(self.statements) - 1)
+        self.emit('complete')
+
+    def __fall_back(self, index):
+        # Execute the statements starting with index in this process
+        self.__cleanup_child(kill=True)
+        self.__executing = None
+
+        self.__rebase_through(index)
+        self.__signal_complete_through(index - 1)
+
+        if index > 0:
+            parent = self.statements[index - 1]
+        else:
+            parent = self.parent_statement
+
+        executor = ThreadExecutor(parent, max_workers=self.max_workers, pool=self.pool)
+        # The ThreadExecutor takes over checking the timeouts
+        executor.statement_timeout = self.statement_timeout
+        executor.timeout = self.timeout
+        executor.start_time = self.__start_time
+        for statement in self.statements[index:]:
+            if statement.state != Statement.EXECUTE_SUCCESS:
+                statement.mark_for_execute()
+            executor.add_statement(statement)
+
+        def on_statement_executing(executor, statement):
+            self.emit('statement-executing', statement)
+
+        def on_statement_complete(executor, statement):
+            self.__signal_complete_through(self.statements.index(statement))
+
+        def on_complete(executor):
+            self.__thread_executor = None
+            self.__complete()
+
+        executor.connect('statement-executing', on_statement_executing)
+        executor.connect('statement-complete', on_statement_complete)
+        executor.connect('complete', on_complete)
+
+        self.__thread_executor = executor
+        if executor.compile():
+            executor.execute()
+
+    def __get_known_objects(self):
+        known = {}
+
+        if self.parent_statement is not None and self.parent_statement.result_scope is not None:
+            for value in self.parent_statement.result_scope.itervalues():
+                known[id(value)] = value
+        for statement in self.statements:
+            if statement.state == Statement.EXECUTE_SUCCESS:
+                # A released scope is only restored when the statement is rebased
+                if statement.result_scope is not None:
+                    for _, value in statement.result_scope.local_items():
+                        known[id(value)] = value
+                for result in statement.results:
+                    known[id(result)] = result
+
+        return known
+
+    def execute(self):
+        """Execute the statements of the executor asynchronously in a worker process."""
+
+        self.__known = self.__get_known_objects()
+        self.__loads = self.__create_unpickler()
+
+        self.__start_time = time.time()
+        if self.statement_timeout is not None or self.timeout is not None:
+            self.__watchdog_id = gobject.timeout_add(_WATCHDOG_INTERVAL, self.__check_timeouts)
+
+        read_fd, write_fd = os.pipe()
+
+        # Make sure that anything buffered is written before we fork, so
+        # it doesn't get written twice
+        sys.__stdout__.flush()
+        sys.__stderr__.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                try:
+                    self.__run_child(write_fd)
+                except BaseException:
+                    pass
+            finally:
+                # Objects aren't freed when we exit this way; the parent has
+                # its own copies of the files of output results
+                output_result.remove_files()
+                os._exit(0)
+
+        os.close(write_fd)
+        self.__pid = pid
+        self.__fd = read_fd
+        self.__watch_id = gobject.io_add_watch(read_fd, gobject.IO_IN | gobject.IO_HUP, self.__on_readable)
+
+    def __check_timeouts(self):
+        if self.interrupted or self.__thread_executor is not None:
+            self.__watchdog_id = 0
+            return False
+
+        now = time.time()
+        if self.timeout is not None and now - self.__start_time >= self.timeout:
+            message = "Execution timed out after %g seconds" % self.timeout
+        elif (self.statement_timeout is not None and self.__executing is not None and
+              now - self.__executing_start >= self.statement_timeout):
+            message = "Timed out after %g seconds" % self.statement_timeout
+        else:
+            return True
+
+        # If the worker finished the statement in the meantime, the message is
+        # discarded when we get the result
+        if self.__executing is not None:
+            self.statements[self.__executing].interrupt_message = message
+
+        self.__watchdog_id = 0
+        self.interrupt()
+
+        return False
+
+    def __kill_child(self):
+        self.__kill_id = 0
+        if self.__pid is not None:
+            try:
+                os.kill(self.__pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        return False
+
+    def interrupt(self):
+        """Interrupts the execution of the executor.
+
+        The worker process is first sent SIGINT, which interrupts Python code
+        in the same way as ThreadExecutor.interrupt(). If the worker doesn't
+        stop within a short time (for example, because it's inside a long-running
+        native computation), it is killed.
+
+        Calling interrupt() more than once will have no effect.
+
+        """
+
+        if self.complete or self.interrupted:
+            return
+
+        self.interrupted = True
+
+        if self.__thread_executor is not None:
+            self.__thread_executor.interrupt()
+        elif self.__pid is not None:
+            try:
+                os.kill(self.__pid, signal.SIGINT)
+            except OSError:
+                pass
+            self.__kill_id = gobject.timeout_add(_KILL_TIMEOUT, self.__kill_child)
+
+class _MessageReader(object):
+    # File-like object that cPickle.Unpickler reads a single message from
+    def __init__(self):
+        self.set_data("")
+
+    def set_data(self, data):
+        self.__data = data
+        self.__pos = 0
+
+    def read(self, n):
+        result = self.__data[self.__pos:self.__pos + n]
+        self.__pos += len(result)
+        return result
+
+    def readline(self):
+        end = self.__data.find("\n", self.__pos)
+        if end < 0:
+            end = len(self.__data)
+        else:
+            end += 1
+        result = self.__data[self.__pos:end]
+        self.__pos = end
+        return result
+
+######################################################################
+
+if __name__ == '__main__': #pragma: no cover
+    gobject.threads_init()
+
+    import stdout_capture
+    stdout_capture.init()
+
+    from notebook import Notebook
+    from test_utils import assert_equals
+    from worksheet import Worksheet
+
+    notebook = Notebook()
+    worksheet = Worksheet(notebook)
+
+    def test_execute(statements, interrupt=False, parent=None, statement_timeout=None, timeout=None,
+                     check_results=True):
+        executor = ProcessExecutor(parent)
+        executor.statement_timeout = statement_timeout
+        executor.timeout = timeout
+
+        for s, expected_state, expected_results in statements:
+            statement = Statement(s, worksheet)
+            statement._expected_state = expected_state
+            statement._expected_results = expected_results
+            executor.add_statement(statement)
+
+        loop = gobject.MainLoop()
+
+        def on_statement_complete(executor, statement):
+            statement._got_state = statement.state
+            statement._got_results = statement.results
+
+        def on_complete(executor):
+            loop.quit()
+
+        def do_interrupt():
+            executor.interrupt()
+            return False
+
+        def timeout():
+            raise AssertionError("ProcessExecutor didn't complete")
+
+        executor.connect('statement-complete', on_statement_complete)
+        executor.connect('complete', on_complete)
+
+        if executor.compile():
+            executor.execute()
+            if interrupt:
+                gobject.timeout_add(500, do_interrupt)
+            timeout_source = gobject.timeout_add(5000, timeout)
+            loop.run()
+            gobject.source_remove(timeout_source)
+
+        for s in executor.statements:
+            assert_equals(s._got_state, s._expected_state)
+            if check_results:
+                assert_equals(s._got_results, s._expected_results)
+
+        return executor.statements
+
+    test_execute(
+        [
+            ("a = 1", Statement.COMPILE_SUCCESS, None),
+            ("a =", Statement.COMPILE_ERROR, None)
+        ])
+
+    statements = test_execute(
+        [
+            ("a = [1]", Statement.EXECUTE_SUCCESS, []),
+            ("import os", Statement.EXECUTE_SUCCESS, []),
+            ("b = a", Statement.EXECUTE_SUCCESS, []),
+            ("a", Statement.EXECUTE_SUCCESS, ['[1]'])
+        ])
+    # Objects that came from the main process are passed back by reference
+    assert statements[2].result_scope['b'] is statements[0].result_scope['a']
+    assert statements[1].result_scope['os'] is os
+
+    # ... and so are objects inside containers that came from the main process
+    statements = test_execute(
+        [
+            ("x = [1]", Statement.EXECUTE_SUCCESS, []),
+            ("d = {'x': x, 'y': ([2],)}", Statement.EXECUTE_SUCCESS, []),
+        ])
+    d = statements[1].result_scope['d']
+    statements = test_execute(
+        [
+            ("e = dict(d)", Statement.EXECUTE_SUCCESS, []),
+            ("y = d['y'][0]", Statement.EXECUTE_SUCCESS, []),
+        ], parent=statements[1])
+    assert statements[0].result_scope['e']['x'] is d['x']
+    assert statements[1].result_scope['y'] is d['y'][0]
+
+    # Only the objects that can be sent by reference are indexed, and a
+    # container that contains itself is only visited once
+    l = [1, 'a', [2]]
+    l.append(l)
+    index = _index_nested_objects({ id(l): l })
+    assert_equals(index.keys(), [id(l[2])])
+    assert_equals(index[id(l[2])][1], (id(l), (2,)))
+
+    test_execute(
+        [
+            ("a = 1", Statement.EXECUTE_SUCCESS, []),
+            ("b", Statement.EXECUTE_ERROR, None),
+            ("c = 2", Statement.COMPILE_SUCCESS, None)
+        ])
+
+    # Output past the limit is in a file; the copy sent back has a file of its
+    # own, and the worker's file is removed
+    import glob
+    import tempfile
+    output_pattern = os.path.join(tempfile.gettempdir(), "reinteract_output*")
+    before = set(glob.glob(output_pattern))
+    worksheet.max_output_lines = 2
+    statements = test_execute(
+        [
+            ("for i in xrange(0, 5): print i", Statement.EXECUTE_SUCCESS, None),
+        ], check_results=False)
+    worksheet.max_output_lines = 1000
+    overflow = statements[0].results[2]
+    assert_equals(overflow.read_page(0), ['2', '3', '4'])
+    assert_equals(set(glob.glob(output_pattern)) - before, set([overflow.filename]))
+    del statements, overflow
+    assert_equals(set(glob.glob(output_pattern)) - before, set())
+
+    # Functions can't be sent back, so we fall back to executing in this process
+    statements = test_execute(
+        [
+            ("def f(x): return x + 1", Statement.EXECUTE_SUCCESS, []),
+            ("f(1)", Statement.EXECUTE_SUCCESS, ['2'])
+        ])
+    assert_equals(statements[1].result_scope['f'](2), 3)
+
+    # Interrupting python code
+    test_execute(
+        [
+            ("y = 1", Statement.EXECUTE_SUCCESS, []),
+            ("for x in xrange(0,100000000): y = y* 2", Statement.INTERRUPTED, None),
+            ("z = 1", Statement.COMPILE_SUCCESS, None)
+        ], interrupt=True)
+
+    # Killing a worker that doesn't respond to SIGINT
+    test_execute(
+        [
+            ("import signal", Statement.EXECUTE_SUCCESS, []),
+            ("signal.signal(signal.SIGINT, signal.SIG_IGN)\nwhile True: pass", Statement.INTERRUPTED, None),
+            ("z = 1", Statement.COMPILE_SUCCESS, None)
+        ], interrupt=True)
+
+    # Timeouts; the worker is killed if interrupting it doesn't work
+    statements = test_execute(
+        [
+            ("y = 1", Statement.EXECUTE_SUCCESS, []),
+            ("for x in xrange(0,100000000): y = y* 2", Statement.INTERRUPTED, None),
+            ("z = 1", Statement.COMPILE_SUCCESS, None)
+        ], statement_timeout=0.2)
+    assert_equals(statements[1].error_message, "Timed out after 0.2 seconds")
+
+    statements = test_execute(
+        [
+            ("import signal", Statement.EXECUTE_SUCCESS, []),
+            ("signal.signal(signal.SIGINT, signal.SIG_IGN)\nwhile True: pass", Statement.INTERRUPTED, None),
+        ], timeout=0.3)
+    assert_equals(statements[1].error_message, "Execution timed out after 0.3 seconds")
+
+    # After falling back to a ThreadExecutor
+    statements = test_execute(
+        [
+            ("def f(): pass", Statement.EXECUTE_SUCCESS, []),
+            ("for x in xrange(0,100000000): y = x", Statement.INTERRUPTED, None),
+        ], statement_timeout=0.2)
+    assert_equals(statements[1].error_message, "Timed out after 0.2 seconds")
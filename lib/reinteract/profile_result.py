@@ -0,0 +1,278 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import cProfile
+import os
+import pstats
+import sys
+import thread
+import time
+
+import gtk
+
+from custom_result import CustomResult
+
+#: profile by recording every function call and return with cProfile
+DETERMINISTIC = 'deterministic'
+#: profile by periodically recording the stack of the executing thread
+SAMPLING = 'sampling'
+
+# Interval between samples of the stack when sampling, in seconds
+_SAMPLE_INTERVAL = 0.001
+
+# Maximum number of functions to keep in a ProfileResult
+_MAX_ROWS = 100
+
+# Columns of the ListStore in the widget
+_FUNCTION = 0
+_LOCATION = 1
+_CALLS = 2
+_OWN_TIME = 3
+_CUMULATIVE_TIME = 4
+
+def _format_location(filename, lineno):
+    # Built-in functions have the filename '~'
+    if filename == '~':
+        return ""
+    else:
+        return "%s:%d" % (os.path.basename(filename), lineno)
+
+class ProfileResult(CustomResult):
+    """
+
+    Result of profiling the execution of a statement. The widget lists the
+    functions that took the most time; it can be sorted by the time spent in
+    the function itself or by the cumulative time including the functions it
+    called.
+
+    """
+
+    def __init__(self, mode, total_time, rows):
+        """Initialize the ProfileResult object
+
+        @param mode: the kind of profiling done, DETERMINISTIC or SAMPLING
+        @param total_time: the total time taken by the statement, in seconds
+        @param rows: list of (function, location, calls, own_time, cumulative_time) tuples.
+           calls is None if unknown (when sampling).
+
+        """
+
+        self.mode = mode
+        self.total_time = total_time
+        self.rows = sorted(rows, key=lambda row: row[_CUMULATIVE_TIME], reverse=True)[0:_MAX_ROWS]
+
+    def create_widget(self):
+        store = gtk.ListStore(str, str, int, float, float)
+        for function, location, calls, own_time, cumulative_time in self.rows:
+            if calls is None:
+                calls = -1
+            store.append((function, location, calls, own_time, cumulative_time))
+        store.set_sort_column_id(_CUMULATIVE_TIME, gtk.SORT_DESCENDING)
+
+        view = gtk.TreeView(store)
+
+        def add_column(title, column_id, format, descending=False):
+            cell = gtk.CellRendererText()
+            column = gtk.TreeViewColumn(title, cell)
+            column.set_sort_column_id(column_id)
+            # Clicking on a numeric column should show the most expensive functions first
+            if descending:
+                column.set_sort_order(gtk.SORT_DESCENDING)
+
+            def cell_data_func(column, cell, model, iter):
+                cell.props.text = format(model.get_value(iter, column_id))
+            column.set_cell_data_func(cell, cell_data_func)
+
+            view.append_column(column)
+
+        add_column("Function", _FUNCTION, lambda v: v)
+        add_column("Location", _LOCATION, lambda v: v)
+        add_column("Calls", _CALLS, lambda v: v >= 0 and str(v) or "", descending=True)
+        add_column("Own Time", _OWN_TIME, lambda v: "%.3f" % v, descending=True)
+        add_column("Cumulative", _CUMULATIVE_TIME, lambda v: "%.3f" % v, descending=True)
+
+        if self.mode == SAMPLING:
+            mode_text = "sampling"
+        else:
+            mode_text = "deterministic"
+        label = gtk.Label("Total time %.3fs (%s profile)" % (self.total_time, mode_text))
+        label.set_alignment(0, 0.5)
+
+        scrolled = gtk.ScrolledWindow()
+        scrolled.set_policy(gtk.POLICY_NEVER, gtk.POLICY_AUTOMATIC)
+        scrolled.set_shadow_type(gtk.SHADOW_IN)
+        scrolled.add(view)
+        if len(self.rows) > 15:
+            scrolled.set_size_request(-1, 300)
+
+        widget = gtk.VBox(spacing=4)
+        widget.pack_start(label, expand=False, fill=False)
+        widget.pack_start(scrolled, expand=True, fill=True)
+        widget.show_all()
+
+        return widget
+
+def _profile_deterministic(code, global_scope, scope):
+    profiler = cProfile.Profile()
+    start = time.time()
+    try:
+        profiler.runctx(code, global_scope, scope)
+    finally:
+        total_time = time.time() - start
+
+    rows = []
+    for (filename, lineno, name), (_, calls, own_time, cumulative_time, _) in pstats.Stats(profiler).stats.iteritems():
+        # Don't include the profiler itself
+        if name == "<method 'disable' of '_lsprof.Profiler' objects>":
+            continue
+        rows.append((name, _format_location(filename, lineno), calls, own_time, cumulative_time))
+
+    return ProfileResult(DETERMINISTIC, total_time, rows)
+
+class _Sampler(object):
+    # Periodically records the stack of a thread from a separate thread
+
+    def __init__(self, tid, code):
+        self.__tid = tid
+        self.__code = code
+        self.__stopped = False
+        self.__finished = thread.allocate_lock()
+
+        #: number of samples taken
+        self.count = 0
+        #: number of samples in which each function was executing, by (filename, lineno, name)
+        self.own = {}
+        #: number of samples in which each function was on the stack
+        self.cumulative = {}
+
+    def start(self):
+        self.__finished.acquire()
+        thread.start_new_thread(self.__run, ())
+
+    def stop(self):
+        self.__stopped = True
+        # Wait for the sampling thread to finish so we don't read partial counts
+        self.__finished.acquire()
+        self.__finished.release()
+
+    def __sample(self):
+        frame = sys._current_frames().get(self.__tid)
+
+        # Walk up the stack to the statement's code; frames above that belong
+        # to the executor
+        stack = []
+        while frame is not None:
+            co = frame.f_code
+            stack.append((co.co_filename, co.co_firstlineno, co.co_name))
+            if co is self.__code:
+                break
+            frame = frame.f_back
+
+        # If we didn't find the statement's code, it isn't executing yet
+        if frame is None:
+            return
+
+        self.count += 1
+        self.own[stack[0]] = self.own.get(stack[0], 0) + 1
+        for key in set(stack):
+            self.cumulative[key] = self.cumulative.get(key, 0) + 1
+
+    def __run(self):
+        try:
+            while not self.__stopped:
+                self.__sample()
+                time.sleep(_SAMPLE_INTERVAL)
+        finally:
+            self.__finished.release()
+
+def _profile_sampling(code, global_scope, scope):
+    sampler = _Sampler(thread.get_ident(), code)
+    start = time.time()
+    sampler.start()
+    try:
+        exec code in global_scope, scope
+    finally:
+        total_time = time.time() - start
+        sampler.stop()
+
+    # Sleeping doesn't take exactly the interval, so we divide up the total
+    # time by the number of samples
+    if sampler.count > 0:
+        sample_time = total_time / sampler.count
+    else:
+        sample_time = 0
+
+    rows = []
+    for key, count in sampler.cumulative.iteritems():
+        filename, lineno, name = key
+        rows.append((name, _format_location(filename, lineno), None,
+                     sampler.own.get(key, 0) * sample_time, count * sample_time))
+
+    return ProfileResult(SAMPLING, total_time, rows)
+
+def profile_exec(code, global_scope, scope, mode=DETERMINISTIC):
+    """Execute code under a profiler
+
+    Exceptions raised by the code are propagated, in which case no profile
+    is returned.
+
+    @param code: the code object to execute
+    @param global_scope: the globals to execute the code with
+    @param scope: the locals to execute the code with
+    @param mode: DETERMINISTIC or SAMPLING
+    @returns: a ProfileResult
+
+    """
+
+    if mode == SAMPLING:
+        return _profile_sampling(code, global_scope, scope)
+    else:
+        return _profile_deterministic(code, global_scope, scope)
+
+######################################################################
+
+if __name__ == '__main__':
+    from test_utils import assert_equals
+
+    code = compile("""
+def f(n):
+    total = 0
+    for i in xrange(0, n):
+        total += i
+    return total
+def g():
+    return f(200000)
+x = g()
+""", "<statement>", "exec")
+
+    scope = {}
+    result = profile_exec(code, scope, scope)
+    assert_equals(scope['x'], 19999900000)
+    assert_equals(result.mode, DETERMINISTIC)
+    names = [row[0] for row in result.rows]
+    assert 'f' in names and 'g' in names
+    # Sorted by cumulative time, so g comes before f
+    assert names.index('g') < names.index('f')
+    f_row = result.rows[names.index('f')]
+    assert_equals(f_row[1], "<statement>:2")
+    assert_equals(f_row[2], 1)
+
+    scope = {}
+    result = profile_exec(code, scope, scope, mode=SAMPLING)
+    assert_equals(scope['x'], 19999900000)
+    assert_equals(result.mode, SAMPLING)
+    for name, location, calls, own_time, cumulative_time in result.rows:
+        assert_equals(calls, None)
+        assert own_time <= cumulative_time <= result.total_time + 1e-6
+
+    # Exceptions are passed through
+    try:
+        profile_exec(compile("1/0", "<statement>", "exec"), {}, {})
+        raise AssertionError("Exception should have been propagated")
+    except ZeroDivisionError:
+        pass
@@ -0,0 +1,329 @@
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+import cPickle
+import errno
+import hashlib
+import os
+import sys
+import tempfile
+import thread
+import types
+
+# Bump this when the format of the cache entries changes
+_CACHE_VERSION = 1
+
+# Default limit on the total size of the files in the cache directory
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+def make_key(text, future_features, input_fingerprints):
+    """Compute the cache key for a statement
+
+    The key is a hash of everything that determines the result of executing the
+    statement: the text, the features imported from __future__, and the
+    fingerprints of the values of the names that the statement reads.
+
+    @param text: the text of the statement
+    @param future_features: list of names imported from __future__, or None
+    @param input_fingerprints: dictionary mapping the names the statement reads to
+       fingerprints of their values (see fingerprint_value())
+    @returns: the key, as a string of hex digits
+
+    """
+
+    if isinstance(text, unicode):
+        text = text.encode("UTF-8")
+
+    h = hashlib.sha1()
+    h.update(repr((_CACHE_VERSION, text, future_features, sorted(input_fingerprints.iteritems()))))
+
+    return h.hexdigest()
+
+def _fingerprint_module(module):
+    filename = getattr(module, '__file__', None)
+    if filename is not None:
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            mtime = None
+    else:
+        mtime = None
+
+    return "module:%s:%r" % (module.__name__, mtime)
+
+def fingerprint_value(key, name, value):
+    """Compute a fingerprint for a value bound by a statement
+
+    Rather than hashing the contents of the value, which could be arbitrarily large,
+    we identify the value by how it was computed: the key of the statement that bound
+    it and the name it was bound to. Modules are the exception, since their contents
+    can change without any statement in the worksheet changing. The same goes for
+    a function, class or other object from a module (as with 'from mymod import f'),
+    so the fingerprint of the module it comes from is included.
+
+    @param key: the cache key of the statement that bound the value
+    @param name: the name the value was bound to
+    @param value: the value
+    @returns: a fingerprint string
+
+    """
+
+    if isinstance(value, types.ModuleType):
+        return _fingerprint_module(value)
+
+    try:
+        module_name = value.__module__
+    except Exception:
+        module_name = None
+
+    module = None
+    if isinstance(module_name, basestring):
+        module = sys.modules.get(module_name)
+
+    if module is not None:
+        return "%s:%s:%s" % (key, name, _fingerprint_module(module))
+    else:
+        return "%s:%s" % (key, name)
+
+class ResultCache(object):
+    """
+
+    Cache of the results of executing statements, stored on disk so that it
+    persists between sessions. Each entry is stored in a separate file named
+    after the key (see make_key()); when the total size of the entries exceeds
+    the maximum size, the least recently used entries are removed.
+
+    Lookups and stores are done from the executor thread, so all access is
+    protected by a lock.
+
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        """Initialize the ResultCache object
+
+        @param directory: directory to store the cache entries in. Will be created if it doesn't exist
+        @param max_size: maximum total size of the cache entries in bytes
+
+        """
+
+        self.directory = directory
+        self.max_size = max_size
+
+        self.__lock = thread.allocate_lock()
+
+    def __get_filename(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def lookup(self, key):
+        """Look up the entry for a key
+
+        @param key: the key to look up
+        @returns: a tuple of (results, bound, deleted) where results is the list
+           of results from the statement, bound is a list of (name, value) pairs for
+           the names bound by the statement, and deleted is a list of the names it
+           deleted; or None if there is no entry for the key.
+
+        """
+
+        filename = self.__get_filename(key)
+
+        self.__lock.acquire()
+        try:
+            try:
+                f = open(filename, "rb")
+            except IOError:
+                return None
+
+            try:
+                try:
+                    version, results, bound, deleted = cPickle.load(f)
+                except Exception:
+                    # Corrupt or from an incompatible version of some module
+                    version = None
+            finally:
+                f.close()
+
+            if version != _CACHE_VERSION:
+                self.__remove(filename)
+                return None
+
+            # Mark the entry as recently used
+            try:
+                os.utime(filename, None)
+            except OSError:
+                pass
+
+            return results, bound, deleted
+        finally:
+            self.__lock.release()
+
+    def store(self, key, results, bound, deleted):
+        """Store an entry in the cache
+
+        If the entry can't be pickled, nothing is stored.
+
+        @param key: the key to store the entry under
+        @param results: list of results from the statement
+        @param bound: list of (name, value) pairs for the names bound by the statement
+        @param deleted: list of names deleted by the statement
+        @returns: True if the entry was stored
+
+        """
+
+        try:
+            data = cPickle.dumps((_CACHE_VERSION, results, bound, deleted), cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return False
+
+        if len(data) > self.max_size:
+            return False
+
+        self.__lock.acquire()
+        try:
+            try:
+                os.makedirs(self.directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    return False
+
+            # Write to a temporary file and rename into place so that a
+            # concurrent reader never sees a partial entry
+            try:
+                handle, tmpname = tempfile.mkstemp(".tmp", "entry", self.directory)
+                f = os.fdopen(handle, "wb")
+                try:
+                    f.write(data)
+                finally:
+                    f.close()
+                os.rename(tmpname, self.__get_filename(key))
+            except (IOError, OSError):
+                return False
+
+            self.__evict()
+
+            return True
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        """Remove all entries from the cache"""
+
+        self.__lock.acquire()
+        try:
+            for filename, _, _ in self.__list_entries():
+                self.__remove(filename)
+        finally:
+            self.__lock.release()
+
+    def __remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def __list_entries(self):
+        # Returns a list of (filename, size, atime) for the entries in the cache
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+
+        entries = []
+        for name in names:
+            if not name.endswith(".pickle"):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((filename, st.st_size, st.st_mtime))
+
+        return entries
+
+    def __evict(self):
+        # Must be called with the lock held
+        entries = self.__list_entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_size:
+            return
+
+        entries.sort(key=lambda entry: entry[2])
+        for filename, size, _ in entries:
+            if total <= self.max_size:
+                break
+            self.__remove(filename)
+            total -= size
+
+######################################################################
+
+if __name__ == '__main__':
+    import shutil
+    import time
+
+    from test_utils import assert_equals
+
+    directory = tempfile.mkdtemp("", "reinteract_result_cache")
+    try:
+        cache = ResultCache(directory)
+
+        key = make_key(u"a = b", None, { 'b': 'abc:b' })
+        assert_equals(key, make_key("a = b", None, { 'b': 'abc:b' }))
+        assert key != make_key(u"a = b", None, { 'b': 'def:b' })
+        assert key != make_key(u"a = b", ['division'], { 'b': 'abc:b' })
+
+        assert_equals(cache.lookup(key), None)
+        assert_equals(cache.store(key, [u'1'], [('a', [1, 2])], ['c']), True)
+        assert_equals(cache.lookup(key), ([u'1'], [('a', [1, 2])], ['c']))
+
+        # Things that can't be pickled aren't stored
+        assert_equals(cache.store(key, [], [('f', lambda x: x)], []), False)
+
+        # A new cache object for the same directory sees the old entries
+        assert_equals(ResultCache(directory).lookup(key), ([u'1'], [('a', [1, 2])], ['c']))
+
+        # Least recently used entries are evicted when the cache is full
+        cache = ResultCache(directory, max_size=2500)
+        keys = [make_key("a = %d" % i, None, {}) for i in xrange(0, 3)]
+        for i, k in enumerate(keys):
+            cache.store(k, [], [('a', 'x' * 1000)], [])
+            # Make sure that the times are distinguishable
+            os.utime(cache._ResultCache__get_filename(k), (time.time() - 100 + i, time.time() - 100 + i))
+        assert_equals(cache.lookup(keys[0]), None)
+        assert cache.lookup(keys[2]) is not None
+
+        assert_equals(fingerprint_value(key, 'a', 1), key + ':a')
+        assert fingerprint_value(key, 'os', os).startswith('module:os:')
+
+        # Objects from a module change when the module's file does
+        module_dir = tempfile.mkdtemp("", "reinteract_module")
+        try:
+            module_file = os.path.join(module_dir, "reinteract_test_mod.py")
+            f = open(module_file, "w")
+            f.write("def f(): pass\nclass C: pass\n")
+            f.close()
+            sys.path.insert(0, module_dir)
+            try:
+                import reinteract_test_mod
+            finally:
+                sys.path.remove(module_dir)
+
+            for value in (reinteract_test_mod.f, reinteract_test_mod.C, reinteract_test_mod.C()):
+                fingerprint = fingerprint_value(key, 'f', value)
+                assert fingerprint.startswith(key + ':f:module:reinteract_test_mod:')
+                st = os.stat(reinteract_test_mod.__file__)
+                os.utime(reinteract_test_mod.__file__, (st.st_atime, st.st_mtime + 10))
+                assert fingerprint_value(key, 'f', value) != fingerprint
+        finally:
+            del sys.modules['reinteract_test_mod']
+            shutil.rmtree(module_dir)
+
+        cache.clear()
+        assert_equals(cache.lookup(keys[2]), None)
+    finally:
+        shutil.rmtree(directory)
@@ -6,11 +6,38 @@
 #
 ########################################################################
 
+import __future__
+import codecs
+import dis
+import keyword
 import parser
 import re
 import token
 import symbol
 import sys
+import types
+
+try:
+    import ast
+except ImportError:
+    ast = None
+
+#
+# There are two implementations of the rewriting. The original one works on
+# the nested tuples of the parser module: it matches patterns against the
+# tuples for the whole statement, and builds new tuples that are turned back
+# into code. When the ast module is available (Python 2.6 and newer) we
+# instead parse the code into a tree of ast nodes and only replace the
+# statements that need to be rewritten; the expressions within them are
+# never visited except to find mutated paths.
+#
+
+#: Version of the rewriting; must be increased when the code produced by the
+#: Rewriter, or the names it reports, change, so that cached compiled code is discarded
+VERSION = 5
+
+#: Builtin functions that give code calling them access to variables by name
+NAME_ACCESS_FUNCTIONS = frozenset(['globals', 'locals', 'vars', 'eval', 'execfile', 'input'])
 
 class UnsupportedSyntaxError(Exception):
     """Exception thrown when some type of Python code that we can't support was used"""
@@ -20,10 +47,20 @@ class UnsupportedSyntaxError(Exception):
         return repr(self.value)
 
 class _RewriteState(object):
-    def __init__(self, output_func_name=None, print_func_name=None, future_features=None):
+    def __init__(self, output_func_name=None, print_func_name=None, mutate_func_name=None, future_features=None):
         self.mutated = []
+        # Paths that need to be copied before the mutations, with prefixes
+        # before longer paths
+        self.paths_to_copy = []
+        # Indices into paths_to_copy of paths mutated in the body of a function,
+        # which we can't guard
+        self.unguarded = set()
+        # Indices into paths_to_copy of paths mutated by the small_stmt being rewritten
+        self.site_mutations = set()
+        self.function_depth = 0
         self.output_func_name = output_func_name
         self.print_func_name = print_func_name
+        self.mutate_func_name = mutate_func_name
         self.future_features = future_features
 
     def add_mutated(self, path):
@@ -35,6 +72,15 @@ class _RewriteState(object):
             if not path in self.mutated:
                 self.mutated.append(path)
 
+            for prefix in _get_paths_to_copy(path):
+                if not prefix in self.paths_to_copy:
+                    self.paths_to_copy.append(prefix)
+                index = self.paths_to_copy.index(prefix)
+                if self.function_depth > 0:
+                    self.unguarded.add(index)
+                else:
+                    self.site_mutations.add(index)
+
 def _do_match(t, pattern, start_pos=0, start_pattern_index=0):
     # Match an AST tree against a pattern. Along with symbol/token names, patterns
     # can contain strings:
@@ -287,6 +333,24 @@ def _create_funccall_expr_stmt(name, args):
 
     return _do_create_funccall_expr_stmt(name, trailer)
 
+def _create_number_test(n):
+    # Creates a "test" AST which is a constant integer
+    return (symbol.test,
+            (symbol.or_test,
+             (symbol.and_test,
+              (symbol.not_test,
+               (symbol.comparison,
+                (symbol.expr,
+                 (symbol.xor_expr,
+                  (symbol.and_expr,
+                   (symbol.shift_expr,
+                    (symbol.arith_expr,
+                     (symbol.term,
+                      (symbol.factor,
+                       (symbol.power,
+                        (symbol.atom,
+                         (token.NUMBER, str(n))))))))))))))))
+
 def _rewrite_tree(t, state, actions):
     # Generic rewriting of an AST, actions is a map of symbol/token type to function
     # to call to produce a modified version of the the subtree
@@ -385,8 +449,34 @@ def _rewrite_small_stmt(t, state):
 
 def _rewrite_simple_stmt(t, state):
     # simple_stmt: small_stmt (';' small_stmt)* [';'] NEWLINE
-    return _rewrite_tree(t, state,
-                         { symbol.small_stmt: _rewrite_small_stmt })
+    if state.mutate_func_name is None or state.function_depth > 0:
+        return _rewrite_tree(t, state,
+                             { symbol.small_stmt: _rewrite_small_stmt })
+
+    # Insert a call to the mutate function before each small_stmt that mutates
+    # variables, passing the indices of the paths to copy, so that the copies
+    # are only made when the mutating code is actually reached
+    result = [t[0]]
+    changed = False
+    for subnode in t[1:]:
+        if subnode[0] == symbol.small_stmt:
+            state.site_mutations = set()
+            filtered = _rewrite_small_stmt(subnode, state)
+            if filtered != subnode:
+                changed = True
+            if state.site_mutations:
+                args = [_create_number_test(i) for i in sorted(state.site_mutations)]
+                result.append((symbol.small_stmt, _create_funccall_expr_stmt(state.mutate_func_name, args)))
+                result.append((token.SEMI, ';'))
+                changed = True
+            result.append(filtered)
+        else:
+            result.append(subnode)
+
+    if changed:
+        return tuple(result)
+    else:
+        return t
 
 def _rewrite_suite(t, state):
     # suite: simple_stmt | NEWLINE INDENT stmt+ DEDENT
@@ -425,9 +515,14 @@ def _rewrite_docstring_suite(t, state):
 
 def _rewrite_docstring_block_stmt(t, state):
     # Like _rewrite_block_stmt, but if the first statement is a literal
-    # string interpret it as a docstring and don't rewrite it to output
-    return _rewrite_tree(t, state,
-                         { symbol.suite:      _rewrite_docstring_suite })
+    # string interpret it as a docstring and don't rewrite it to output.
+    # (Only used for function definitions)
+    state.function_depth += 1
+    try:
+        return _rewrite_tree(t, state,
+                             { symbol.suite:      _rewrite_docstring_suite })
+    finally:
+        state.function_depth -= 1
 
 _rewrite_compound_stmt_actions = {
     symbol.if_stmt:    _rewrite_block_stmt,
@@ -702,11 +797,11 @@ def _compile_copy_code(path, copy_func_name):
     copy_code = _create_copy_code(path, copy_func_name)
     return parser.sequence2ast(copy_code).compile()
 
-def _compile_mutations(paths, copy_func_name):
-    # First add prefixes - if a.b.c is mutated, then we need to
-    # shallow-copy first a and then a.b
+def _get_paths_to_copy(path):
+    # Returns the prefixes of a mutated path that need to be copied, shortest
+    # first - if a.b.c is mutated, then we need to shallow-copy first a and then a.b
 
-    paths_to_copy = set()
+    paths_to_copy = []
 
     # path: atom trailer*
     # trailer: '(' [arglist] ')' | '[' subscriptlist ']' | '.' NAME
@@ -714,53 +809,455 @@ def _compile_mutations(paths, copy_func_name):
     # We normally chop of trailers one by one, but if we have
     # .NAME(...) (two trailers) then we chop that off as one piece
     #
-    for path in paths:
-        while True:
-            # Dont' try to copy things that don't look like they
-            # can be assigned to
-            if path[-1][1][0] != token.LPAR:
-                paths_to_copy.add(path)
+    while True:
+        # Dont' try to copy things that don't look like they
+        # can be assigned to
+        if path[-1][1][0] != token.LPAR:
+            paths_to_copy.append(path)
 
-            if len(path) == 1:
-                break
+        if len(path) == 1:
+            break
 
-            if (path[-1][1][0] == token.LPAR and
-                len(path) > 2 and
-                path[-2][1][0] == token.DOT):
+        if (path[-1][1][0] == token.LPAR and
+            len(path) > 2 and
+            path[-2][1][0] == token.DOT):
 
-                path = path[0:-2]
-            else:
-                path = path[0:-1]
+            path = path[0:-2]
+        else:
+            path = path[0:-1]
 
-    # Sort the paths with shorter paths earlier so that we copy prefixes
-    # before longer versions
-    paths_to_copy = sorted(paths_to_copy, lambda x,y: cmp(len(x),len(y)))
+    paths_to_copy.reverse()
 
+    return paths_to_copy
+
+def _compile_mutations(state, copy_func_name):
+    # The prefixes of each path were added to state.paths_to_copy before the
+    # path itself, so copying in order copies prefixes before longer versions
     return [(_get_path_root(path),
              _describe_path(path),
-             _compile_copy_code(path, copy_func_name)) for path in paths_to_copy]
+             _compile_copy_code(path, copy_func_name),
+             state.mutate_func_name is not None and not i in state.unguarded)
+            for i, path in enumerate(state.paths_to_copy)]
+
+######################################################################
+# Finding the names that code reads and binds
+
+_LOAD_OPS = frozenset([dis.opmap['LOAD_NAME'], dis.opmap['LOAD_GLOBAL']])
+_STORE_OPS = frozenset([dis.opmap['STORE_NAME'], dis.opmap['DELETE_NAME']])
+_STORE_GLOBAL_OPS = frozenset([dis.opmap['STORE_GLOBAL'], dis.opmap['DELETE_GLOBAL']])
+_NAME_OPS = _LOAD_OPS | _STORE_OPS | _STORE_GLOBAL_OPS
+_UNTRACKABLE_OPS = frozenset([dis.opmap['IMPORT_STAR'], dis.opmap['EXEC_STMT']])
+
+def _find_names(code, reads, writes, nested=False):
+    # Adds the global names that code loads to the set reads and the global
+    # names it binds to the set writes. Names bound by nested code, like the
+    # body of a function or class, are local to that code and don't count.
+    # Returns False if the code can access variables in ways that we can't
+    # track: exec, 'from module import *', or calling globals() and similar.
+    trackable = True
+
+    # This is a loop over the instructions of the code, but only the arguments
+    # of the instructions we care about are decoded, since it is a noticeable
+    # part of the time to compile a long statement
+    co_code = code.co_code
+    co_names = code.co_names
+    end = len(co_code)
+    extended_arg = 0
+    i = 0
+    while i < end:
+        op = ord(co_code[i])
+        if op < dis.HAVE_ARGUMENT:
+            if op in _UNTRACKABLE_OPS:
+                trackable = False
+            i += 1
+            continue
+
+        if op in _NAME_OPS:
+            name = co_names[ord(co_code[i + 1]) + ord(co_code[i + 2]) * 256 + extended_arg]
+            if op in _LOAD_OPS:
+                if name in NAME_ACCESS_FUNCTIONS:
+                    trackable = False
+                reads.add(name)
+            elif op in _STORE_GLOBAL_OPS or not nested:
+                writes.add(name)
+        elif op == dis.EXTENDED_ARG:
+            extended_arg = (ord(co_code[i + 1]) + ord(co_code[i + 2]) * 256) * 65536
+            i += 3
+            continue
+
+        extended_arg = 0
+        i += 3
+
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            if not _find_names(const, reads, writes, nested=True):
+                trackable = False
+
+    return trackable
+
+def _find_call_arguments(t, names):
+    # Adds the names in the arguments of the function calls in the parse tree t
+    # to the set names, since the function might mutate the objects passed to it
+    if t[0] == symbol.trailer and t[1][0] == token.LPAR:
+        _find_name_tokens(t, names)
+    elif token.ISNONTERMINAL(t[0]):
+        for child in t[1:]:
+            _find_call_arguments(child, names)
+
+def _find_name_tokens(t, names):
+    if t[0] == token.NAME:
+        if not keyword.iskeyword(t[1]):
+            names.add(t[1])
+    elif token.ISNONTERMINAL(t[0]):
+        for child in t[1:]:
+            _find_name_tokens(child, names)
+
+######################################################################
+# Rewriting with the ast module
+
+class _AstRewriteState(object):
+    def __init__(self, output_func_name=None, print_func_name=None, mutate_func_name=None):
+        # Names of the variables at the root of mutated paths
+        self.mutated_roots = set()
+        # Paths that need to be copied before the mutations, with prefixes
+        # before longer paths
+        self.paths_to_copy = []
+        # Map from _ast_path_key() to index in paths_to_copy
+        self.path_indices = {}
+        # Indices into paths_to_copy of paths mutated in the body of a function,
+        # which we can't guard
+        self.unguarded = set()
+        # Indices into paths_to_copy of paths mutated by the statement being rewritten
+        self.site_mutations = set()
+        self.function_depth = 0
+        self.output_func_name = output_func_name
+        self.print_func_name = print_func_name
+        self.mutate_func_name = mutate_func_name
+
+    def add_mutated(self, path):
+        # As for _RewriteState, we only handle paths that start with a name
+        if not _ast_is_path(path):
+            return
+
+        self.mutated_roots.add(_ast_get_path_root(path))
+
+        for prefix in _ast_get_paths_to_copy(path):
+            key = _ast_path_key(prefix)
+            index = self.path_indices.get(key)
+            if index is None:
+                index = self.path_indices[key] = len(self.paths_to_copy)
+                self.paths_to_copy.append(prefix)
+            if self.function_depth > 0:
+                self.unguarded.add(index)
+            else:
+                self.site_mutations.add(index)
+
+def _ast_is_path(node):
+    # Check if node is of the form 'a.b...c', where there may be subscripts
+    # and calls in the path
+    while True:
+        if isinstance(node, ast.Name):
+            return True
+        elif isinstance(node, (ast.Attribute, ast.Subscript)):
+            node = node.value
+        elif isinstance(node, ast.Call):
+            node = node.func
+        else:
+            return False
+
+def _ast_get_path_root(path):
+    while not isinstance(path, ast.Name):
+        if isinstance(path, ast.Call):
+            path = path.func
+        else:
+            path = path.value
+
+    return path.id
+
+def _ast_path_key(path):
+    # A key to compare paths by; the same path can occur with different
+    # contexts (the target of an assignment is ast.Store()), but only at the top
+    if isinstance(path, ast.Name):
+        return path.id
+    elif isinstance(path, ast.Attribute):
+        return ('.', ast.dump(path.value), path.attr)
+    elif isinstance(path, ast.Subscript):
+        return ('[', ast.dump(path.value), ast.dump(path.slice))
+    else:
+        return ast.dump(path)
+
+def _ast_describe_path(path):
+    # Turn a path into a (skeletal) textual description, as _describe_path()
+    if isinstance(path, ast.Name):
+        return path.id
+    elif isinstance(path, ast.Attribute):
+        return _ast_describe_path(path.value) + "." + path.attr
+    elif isinstance(path, ast.Subscript):
+        return _ast_describe_path(path.value) + "[...]"
+    else:
+        return _ast_describe_path(path.func) + "(...)"
+
+def _ast_get_paths_to_copy(path):
+    # Returns the prefixes of a mutated path that need to be copied, shortest
+    # first, chopping off the same pieces as _get_paths_to_copy()
+    paths_to_copy = []
+    while True:
+        # Don't try to copy things that can't be assigned to
+        if not isinstance(path, ast.Call):
+            paths_to_copy.append(path)
+
+        if isinstance(path, ast.Name):
+            break
+        elif isinstance(path, ast.Call):
+            # .NAME(...) is chopped off as one piece
+            if isinstance(path.func, ast.Attribute):
+                path = path.func.value
+            else:
+                path = path.func
+        else:
+            path = path.value
+
+    paths_to_copy.reverse()
+
+    return paths_to_copy
+
+def _ast_with_context(path, ctx):
+    result = type(path)(**dict(ast.iter_fields(path)))
+    result.ctx = ctx
+
+    return ast.copy_location(result, path)
+
+def _ast_create_call(func_name, args, location):
+    # Creates a statement calling a function; the nodes are given the location
+    # of the node 'location'
+    func = ast.copy_location(ast.Name(func_name, ast.Load()), location)
+    call = ast.copy_location(ast.Call(func, args, [], None, None), location)
+
+    return ast.copy_location(ast.Expr(call), location)
+
+def _ast_compile_copy_code(path, copy_func_name):
+    # path = copy_func_name(path)
+    call = _ast_create_call(copy_func_name, [_ast_with_context(path, ast.Load())], path).value
+    assign = ast.copy_location(ast.Assign([_ast_with_context(path, ast.Store())], call), path)
+
+    return compile(ast.Module([assign]), "<syntax-tree>", "exec", 0, True)
+
+def _ast_add_target_mutations(target, state):
+    # Assigning to an item or attribute of something mutates it
+    if isinstance(target, (ast.Tuple, ast.List)):
+        for elt in target.elts:
+            _ast_add_target_mutations(elt, state)
+    elif isinstance(target, (ast.Subscript, ast.Attribute)):
+        state.add_mutated(target.value)
+
+def _ast_names_in(node):
+    return set(n.id for n in ast.walk(node) if isinstance(n, ast.Name))
+
+def _ast_add_method_call_mutations(node, state, local_names=frozenset()):
+    # Calling a method of an object that isn't a getter might mutate it. We look
+    # for method calls anywhere in the expression node, but calls on parameters
+    # of a lambda or targets of a comprehension within it, as in
+    # 'sorted(l, key=lambda v: v.lower())', aren't calls on worksheet variables
+    if isinstance(node, ast.Lambda):
+        for default in node.args.defaults:
+            _ast_add_method_call_mutations(default, state, local_names)
+        local_names = local_names | _ast_names_in(node.args)
+        local_names |= set(name for name in (node.args.vararg, node.args.kwarg) if name)
+        _ast_add_method_call_mutations(node.body, state, local_names)
+        return
+    elif isinstance(node, (ast.ListComp, ast.GeneratorExp, ast.SetComp, ast.DictComp)):
+        for generator in node.generators:
+            _ast_add_method_call_mutations(generator.iter, state, local_names)
+            local_names = local_names | _ast_names_in(generator.target)
+            for condition in generator.ifs:
+                _ast_add_method_call_mutations(condition, state, local_names)
+        for field in ('elt', 'key', 'value'):
+            if hasattr(node, field):
+                _ast_add_method_call_mutations(getattr(node, field), state, local_names)
+        return
+
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and
+        _GETTER_RE.match(node.func.attr) is None and
+        not (_ast_is_path(node.func.value) and _ast_get_path_root(node.func.value) in local_names)):
+        state.add_mutated(node.func.value)
+
+    for child in ast.iter_child_nodes(node):
+        _ast_add_method_call_mutations(child, state, local_names)
+
+def _ast_rewrite_expr(stmt, state):
+    # A method call anywhere in the expression might mutate its object, not
+    # just one at the top, as in 'a.append(1) or b.append(2)'
+    value = stmt.value
+    _ast_add_method_call_mutations(value, state)
+
+    # 'yield x' as a statement is not an expression to output. A tuple is
+    # passed to the output function as a single argument, since we can't
+    # tell '1, 2' from '(1, 2)'
+    if state.output_func_name is not None and not isinstance(value, ast.Yield):
+        return _ast_create_call(state.output_func_name, [value], stmt)
+    else:
+        return stmt
+
+def _ast_copy_with_bodies(stmt, state, *fields):
+    result = ast.copy_location(type(stmt)(**dict(ast.iter_fields(stmt))), stmt)
+    for field in fields:
+        setattr(result, field, _ast_rewrite_body(getattr(stmt, field), state))
+
+    return result
+
+def _ast_rewrite_stmt(stmt, state):
+    t = type(stmt)
+    if t is ast.Expr:
+        return _ast_rewrite_expr(stmt, state)
+    elif t is ast.Assign:
+        for target in stmt.targets:
+            _ast_add_target_mutations(target, state)
+    elif t is ast.AugAssign:
+        # Depending on what a is, a += b can modify a. For example appending
+        # to an array with a += [3]. If a is immutable (a number say), then copying
+        # it is unnecessary, but cheap
+        state.add_mutated(stmt.target)
+    elif t is ast.Print:
+        if state.print_func_name is not None and stmt.dest is None and stmt.values:
+            return _ast_create_call(state.print_func_name, stmt.values, stmt)
+    elif t is ast.Global:
+        raise UnsupportedSyntaxError("The global statement is not supported")
+    elif t in (ast.If, ast.While, ast.For):
+        return _ast_copy_with_bodies(stmt, state, 'body', 'orelse')
+    elif t is ast.TryExcept:
+        result = _ast_copy_with_bodies(stmt, state, 'body', 'orelse')
+        result.handlers = [_ast_copy_with_bodies(handler, state, 'body') for handler in stmt.handlers]
+        return result
+    elif t is ast.TryFinally:
+        return _ast_copy_with_bodies(stmt, state, 'body', 'finalbody')
+    elif t is ast.With:
+        return _ast_copy_with_bodies(stmt, state, 'body')
+    elif t is ast.FunctionDef:
+        state.function_depth += 1
+        try:
+            result = _ast_copy_with_bodies(stmt, state)
+            # Don't output a docstring, even though it looks like a bare expression
+            body = stmt.body
+            if isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Str):
+                result.body = body[0:1] + _ast_rewrite_body(body[1:], state)
+            else:
+                result.body = _ast_rewrite_body(body, state)
+            return result
+        finally:
+            state.function_depth -= 1
+
+    # Other statements, including class definitions, are left alone
+    return stmt
+
+_AST_COMPOUND_STMTS = () if ast is None else (ast.If, ast.While, ast.For, ast.TryExcept, ast.TryFinally,
+                                              ast.With, ast.FunctionDef, ast.ClassDef)
+
+def _ast_rewrite_body(body, state):
+    if state.mutate_func_name is None or state.function_depth > 0:
+        return [_ast_rewrite_stmt(stmt, state) for stmt in body]
+
+    # Insert a call to the mutate function before each simple statement that
+    # mutates variables, passing the indices of the paths to copy, so that the
+    # copies are only made when the mutating code is actually reached
+    result = []
+    for stmt in body:
+        state.site_mutations = set()
+        rewritten = _ast_rewrite_stmt(stmt, state)
+        if state.site_mutations and not isinstance(stmt, _AST_COMPOUND_STMTS):
+            args = [ast.copy_location(ast.Num(i), stmt) for i in sorted(state.site_mutations)]
+            result.append(_ast_create_call(state.mutate_func_name, args, stmt))
+        result.append(rewritten)
+
+    return result
+
+def _ast_get_imports(tree):
+    # Returns the same thing as _get_imports() for an ast tree
+    if not tree.body:
+        return None
+
+    stmt = tree.body[0]
+    if isinstance(stmt, ast.Import):
+        # As for _process_dotted_as_name(), 'import a.b' is reported as binding 'b'
+        return [(alias.name, [('.', alias.asname or alias.name.split('.')[-1])]) for alias in stmt.names]
+    elif isinstance(stmt, ast.ImportFrom):
+        name = "." * (stmt.level or 0) + (stmt.module or "")
+        if stmt.names[0].name == '*':
+            return [(name, '*')]
+        else:
+            return [(name, [(alias.name, alias.asname or alias.name) for alias in stmt.names])]
+    else:
+        return None
+
+def _ast_find_call_arguments(tree, names):
+    # Does the same thing as _find_call_arguments() for an ast tree
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            args = node.args + [kw.value for kw in node.keywords] + [node.starargs, node.kwargs]
+            for arg in args:
+                if arg is not None:
+                    names.update(n.id for n in ast.walk(arg) if isinstance(n, ast.Name))
+
+def _ast_parse(code, encoding, flags):
+    # Parse code into an ast tree. The parser assumes that a str without a
+    # coding declaration is in Latin-1, so other encodings are declared.
+    # A unicode string is compiled so that str literals come out as UTF-8,
+    # which is what we want for UTF-8 code
+    flags |= ast.PyCF_ONLY_AST
+    if isinstance(code, unicode):
+        return compile(code, "<syntax-tree>", "exec", flags, True)
+    elif codecs.lookup(encoding).name == 'utf-8':
+        return compile(code.decode("utf8"), "<syntax-tree>", "exec", flags, True)
+
+    try:
+        tree = compile("# -*- coding: %s -*-\n" % encoding + code, "<syntax-tree>", "exec", flags, True)
+    except SyntaxError, e:
+        if e.lineno is not None:
+            e.lineno -= 1
+        raise
+
+    ast.increment_lineno(tree, -1)
+
+    return tree
+
+def _get_future_flags(future_features):
+    flags = 0
+    if future_features:
+        for feature in future_features:
+            flags |= getattr(__future__, feature).compiler_flag
+
+    return flags
 
 ######################################################################
 
 class Rewriter:
     """Class to rewrite and extract information from Python code"""
 
-    def __init__(self, code, encoding="utf8", future_features=None):
+    def __init__(self, code, encoding="utf8", future_features=None, use_ast=True):
         """Initialize the Rewriter object
 
         @param code: the text to compile
         @param encoding: the encoding of the text
         @param future_features: a list of names from the __future__ module
+        @param use_ast: if True, and the ast module is available, rewrite an ast
+          tree rather than the tuples from the parser module, which is much faster
 
         """
-        if (isinstance(code, unicode)):
-            code = code.encode("utf8")
-            encoding = "utf8"
+        self.use_ast = use_ast and ast is not None
+
+        if self.use_ast:
+            self.__flags = _get_future_flags(future_features)
+            self.original = _ast_parse(code, encoding, self.__flags)
+        else:
+            if (isinstance(code, unicode)):
+                code = code.encode("utf8")
+                encoding = "utf8"
+            self.original = parser.suite(code).totuple()
 
         self.code = code
         self.encoding = encoding
         self.future_features = future_features
-        self.original = parser.suite(code).totuple()
+        self.__reads = None
+        self.__writes = None
 
     def get_imports(self):
         """
@@ -771,9 +1268,27 @@ class Rewriter:
 
         """
 
-        return _get_imports(self.original)
+        if self.use_ast:
+            return _ast_get_imports(self.original)
+        else:
+            return _get_imports(self.original)
+
+    def get_names(self):
+        """
+        Return the global names that the code reads and binds. Variables that
+        are mutated (see rewrite_and_compile()) are considered to be bound.
+        This information is only available after calling rewrite_and_compile().
+
+        @returns: A tuple of two sets (reads, writes). If the code can access
+          variables in ways that we can't track (for example, using exec), or
+          rewrite_and_compile() hasn't been called, both are None.
+
+        """
+
+        return self.__reads, self.__writes
 
-    def rewrite_and_compile(self, output_func_name=None, print_func_name=None, copy_func_name="__copy"):
+    def rewrite_and_compile(self, output_func_name=None, print_func_name=None, copy_func_name="__copy",
+                            mutate_func_name=None):
         """
         Compiles the parse tree into code, while rewriting the parse tree according to the
         output_func_name and print_func_name arguments.
@@ -789,9 +1304,15 @@ class Rewriter:
 
          - Code that can be evaluated to copy the object.
 
+         - True if the object can be copied lazily: code to call mutate_func_name has
+           been inserted before every place that it might be mutated. Otherwise it
+           must be copied before the code is executed.
+
+        The list is ordered so that if a.b is copied, a is copied first.
+
         @param output_func_name: the name of function used to wrap statements that are simply expressions.
-           (More than one argument will be passed if the statement is in the form of a list.)
-           Can be None.
+           (Without the ast module, more than one argument will be passed if the statement is in
+           the form of a list, which should be treated as a tuple of the arguments.) Can be None.
 
         @param print_func_name: the name of a function used to replace print statements without a destination
           file. Can be None.
@@ -800,10 +1321,57 @@ class Rewriter:
            Should have the same semantics as copy.copy (will normally be an import of copy.copy)
            Defaults to __copy.
 
+        @param mutate_func_name: the name of a function to call before statements that
+           might mutate variables, with the indices into the list of mutations of the
+           objects that need to be copied first (in increasing order). The function
+           should copy the objects that haven't been copied already. Can be None, in which
+           case all objects must be copied before the code is executed. Mutations within
+           the bodies of functions are not guarded, since the function might be called
+           when the code has finished executing.
+
         @returns: a tuple of the compiled code followed by a list of mutations
         """
+        if self.use_ast:
+            state = _AstRewriteState(output_func_name=output_func_name,
+                                     print_func_name=print_func_name,
+                                     mutate_func_name=mutate_func_name)
+
+            rewritten = ast.Module(_ast_rewrite_body(self.original.body, state))
+            compiled = compile(rewritten, "<syntax-tree>", "exec", self.__flags, True)
+            mutated_roots = state.mutated_roots
+            mutations = [(_ast_get_path_root(path),
+                          _ast_describe_path(path),
+                          _ast_compile_copy_code(path, copy_func_name),
+                          mutate_func_name is not None and not i in state.unguarded)
+                         for i, path in enumerate(state.paths_to_copy)]
+        else:
+            compiled, mutated_roots, mutations = self.__rewrite_and_compile_tuples(output_func_name, print_func_name,
+                                                                                   copy_func_name, mutate_func_name)
+
+        reads = set()
+        writes = set()
+        if _find_names(compiled, reads, writes):
+            writes.update(mutated_roots)
+            # We can't see what a function does with the objects passed to it,
+            # so we have to assume that it mutates them, as in 'helper(a)'
+            arguments = set()
+            if self.use_ast:
+                _ast_find_call_arguments(self.original, arguments)
+            else:
+                _find_call_arguments(self.original, arguments)
+            writes.update(arguments & reads)
+            self.__reads = reads
+            self.__writes = writes
+        else:
+            self.__reads = None
+            self.__writes = None
+
+        return (compiled, mutations)
+
+    def __rewrite_and_compile_tuples(self, output_func_name, print_func_name, copy_func_name, mutate_func_name):
         state = _RewriteState(output_func_name=output_func_name,
                               print_func_name=print_func_name,
+                              mutate_func_name=mutate_func_name,
                               future_features=self.future_features)
 
         rewritten = _rewrite_file_input(self.original, state)
@@ -816,7 +1384,9 @@ class Rewriter:
             else:
                 raise UnsupportedSyntaxError("Unexpected parser error: " + e.message);
 
-        return (compiled, _compile_mutations(state.mutated, copy_func_name))
+        mutated_roots = set(_get_path_root(path) for path in state.mutated)
+
+        return (compiled, mutated_roots, _compile_mutations(state, copy_func_name))
 
 ##################################################3
 
@@ -824,8 +1394,16 @@ if __name__ == '__main__':
     import copy
     import re
 
-    def rewrite_and_compile(code, output_func_name=None, future_features=None, print_func_name=None, encoding="utf8"):
-        return Rewriter(code, encoding, future_features).rewrite_and_compile(output_func_name, print_func_name)
+    # Each test is run with both implementations of the rewriting, and checks
+    # that they give the same results
+    if ast is not None:
+        backends = (True, False)
+    else:
+        backends = (False,)
+
+    def rewrite_and_compile(code, output_func_name=None, future_features=None, print_func_name=None, encoding="utf8",
+                            use_ast=True):
+        return Rewriter(code, encoding, future_features, use_ast).rewrite_and_compile(output_func_name, print_func_name)
 
     def create_file_input(s):
         # Wrap up a statement (like an expr_stmt) into a file_input, so we can
@@ -878,45 +1456,53 @@ if __name__ == '__main__':
     # Test that our intercepting of bare expressions to save the output works
     #
     def test_output(code, expected):
-        compiled, _ = rewrite_and_compile(code, output_func_name='reinteract_output')
-        
-        test_args = []
-        def set_test_args(*args): test_args[:] = args
-        scope = { 'reinteract_output': set_test_args }
-
-        exec compiled in scope
-
-        if tuple(test_args) != tuple(expected):
-            raise AssertionError("Got '%s', expected '%s'" % (test_args, expected))
-
-    test_output('a=3', ())
-    test_output('1', (1,))
-    test_output('1,2', (1,2))
-    test_output('1;2', (2,))
-    test_output('a=3; a', (3,))
-    test_output('def x():\n    1\ny = x()', (1,))
+        for use_ast in backends:
+            compiled, _ = rewrite_and_compile(code, output_func_name='reinteract_output', use_ast=use_ast)
+
+            # Several arguments are output as a tuple, as by Statement.do_output()
+            outputs = []
+            def output(*args): outputs.append(args[0] if len(args) == 1 else args)
+            scope = { 'reinteract_output': output }
+
+            exec compiled in scope
+
+            if outputs != list(expected):
+                raise AssertionError("Got '%s', expected '%s' (use_ast=%s)" % (outputs, expected, use_ast))
+
+    test_output('a=3', [])
+    test_output('1', [1])
+    test_output('1,2', [(1,2)])
+    test_output('(1,2)', [(1,2)])
+    test_output('1;2', [1, 2])
+    test_output('a=3; a', [3])
+    test_output('def x():\n    1\ny = x()', [1])
+    test_output('if True:\n    1\nelse:\n    2', [1])
+    test_output('try:\n    1\nexcept:\n    2\nelse:\n    3\nfinally:\n    4', [1, 3, 4])
+    test_output('class C:\n    1', [])
+    test_output('def g():\n    yield 1\nlist(g())', [[1]])
 
     #
     # Test that we don't intercept docstrings, even though they look like bare expressions
     #
-    test_output('def x():\n    "x"\n    return 1\ny = x()', ())
-    test_output('def x():\n    """"x\n"""\n    return 1\ny = x()', ())
-    test_output('def x(): "x"\ny = x()', ())
+    test_output('def x():\n    "x"\n    return 1\ny = x()', [])
+    test_output('def x():\n    """"x\n"""\n    return 1\ny = x()', [])
+    test_output('def x(): "x"\ny = x()', [])
 
     #
     # Test that our intercepting of print works
     #
     def test_print(code, expected):
-        compiled, _ = rewrite_and_compile(code, print_func_name='reinteract_print')
-        
-        test_args = []
-        def set_test_args(*args): test_args[:] = args
-        scope = { 'reinteract_print': set_test_args }
+        for use_ast in backends:
+            compiled, _ = rewrite_and_compile(code, print_func_name='reinteract_print', use_ast=use_ast)
 
-        exec compiled in scope
+            test_args = []
+            def set_test_args(*args): test_args[:] = args
+            scope = { 'reinteract_print': set_test_args }
 
-        if tuple(test_args) != tuple(expected):
-            raise AssertionError("Got '%s', expected '%s'" % (test_args, expected))
+            exec compiled in scope
+
+            if tuple(test_args) != tuple(expected):
+                raise AssertionError("Got '%s', expected '%s' (use_ast=%s)" % (test_args, expected, use_ast))
 
     test_print('a=3', ())
     test_print('print 1', (1,))
@@ -928,13 +1514,37 @@ if __name__ == '__main__':
     #
     # Test catching possible mutations of variables
     #
-    def test_mutated(code, expected, prepare=None, assert_old=None, assert_new=None):
-        compiled, mutated = rewrite_and_compile(code)
+    def test_mutated(code, expected, prepare=None, assert_old=None, assert_new=None, ast_expected=None):
+        # ast_expected is given when the ast implementation finds mutations
+        # that the other one misses
+        for use_ast in backends:
+            if ast_expected is None:
+                do_test_mutated(code, expected, prepare, assert_old, assert_new, use_ast)
+            elif use_ast:
+                do_test_mutated(code, ast_expected, prepare, assert_old, assert_new, use_ast)
+            else:
+                # Missing mutations, so the old scope isn't preserved
+                do_test_mutated(code, expected, None, None, None, use_ast)
+
+        # The mutations are listed in the same order by both implementations;
+        # any that only the ast implementation finds are ignored
+        if len(backends) > 1:
+            results = [[(root, description, is_lazy)
+                        for (root, description, _, is_lazy)
+                        in Rewriter(code, use_ast=use_ast).rewrite_and_compile(mutate_func_name='mutate')[1]]
+                       for use_ast in backends]
+            if ast_expected is not None:
+                results[0] = [m for m in results[0] if m in results[1]]
+            if results[0] != results[1]:
+                raise AssertionError("Got '%s' with ast, '%s' without" % (results[0], results[1]))
+
+    def do_test_mutated(code, expected, prepare, assert_old, assert_new, use_ast):
+        compiled, mutated = rewrite_and_compile(code, use_ast=use_ast)
 
         #
         # Basic test - check the root and description for the returned list of mutations
         #
-        mutated_root_desc = sorted(((root, description) for (root, description, _) in mutated))
+        mutated_root_desc = sorted(((root, description) for (root, description, _, _) in mutated))
 
         # Extract the root from a description (just take the first word)
         def expand_root_desc(description):
@@ -944,7 +1554,7 @@ if __name__ == '__main__':
         expected_root_desc = sorted((expand_root_desc(x) for x in expected))
 
         if tuple(mutated_root_desc) != tuple(expected_root_desc):
-            raise AssertionError("Got '%s', expected '%s'" % (mutated, expected))
+            raise AssertionError("Got '%s', expected '%s' (use_ast=%s)" % (mutated, expected, use_ast))
 
         # More complex test
         #
@@ -958,7 +1568,7 @@ if __name__ == '__main__':
             exec prepare in old_scope
             new_scope = dict(old_scope)
 
-            for _, _, copy_code in mutated:
+            for _, _, copy_code, _ in mutated:
                 exec copy_code in new_scope
 
             exec compiled in new_scope
@@ -1011,6 +1621,23 @@ a.a = A()
 
     test_mutated('a.addmul(1,2)', ('a',),
                  prepare, 'a.b == 1', 'a.b == 3')
+    test_mutated('a.addmul(1,2) or a.a.addmul(1,2)', ('a',),
+                 prepare, 'a.b == 1 and a.a.b == 1', 'a.b == 3 and a.a.b == 3',
+                 ast_expected=('a', 'a.a'))
+    test_mutated('a.append(1) or b.append(2)', ('a',),
+                 'a = []; b = []', 'a == [] and b == []', 'a == [1] and b == [2]',
+                 ast_expected=('a', 'b'))
+    test_mutated('f(a.pop())', (),
+                 'a = [1]; f = str', 'a == [1]', 'a == []',
+                 ast_expected=('a',))
+    # Calls on the parameters of a lambda or the variables of a comprehension
+    # aren't calls on the variables of the same name
+    test_mutated('sorted(words, key=lambda v: v.lower())', (),
+                 "v = range(5); words = ['b', 'A']", 'v == range(5)', 'v == range(5)')
+    test_mutated('[v.lower() for w in words for v in w]', (),
+                 "v = range(5); words = ['b', 'A']", 'v == range(5)', "v == 'A'")
+    test_mutated('sum(v.count(1) for v in l)', (),
+                 "v = range(5); l = [[1], [2]]", 'v == range(5)', 'v == range(5)')
     test_mutated('a.a.addmul(1,2)', ('a', 'a.a'),
                  prepare, 'a.a.b == 1', 'a.a.b == 3')
 
@@ -1024,37 +1651,100 @@ a.a = A()
     test_mutated('a.get_a().b = 2', ('a',))
     test_mutated('a.get_a().a.b = 2', ('a', 'a.get_a(...).a'))
 
+    # Cases that are only found with the ast module, which sees through
+    # parentheses and into nested assignment targets
+    if ast is not None:
+        do_test_mutated('(a).append(1)', ('a',), 'a = []', 'a == []', 'a == [1]', use_ast=True)
+        do_test_mutated('a.b, c.d = 1, 2', ('a', 'c'), None, None, None, use_ast=True)
+        do_test_mutated('[a[0], (b[0], c)] = 1, (2, 3)', ('a', 'b'), None, None, None, use_ast=True)
+
+    #
+    # Test guarding mutations so that objects can be copied lazily
+    #
+    def test_guarded(code, prepare, expected_copies, expected_lazy):
+        for use_ast in backends:
+            do_test_guarded(code, prepare, expected_copies, expected_lazy, use_ast)
+
+    def do_test_guarded(code, prepare, expected_copies, expected_lazy, use_ast):
+        compiled, mutated = Rewriter(code, use_ast=use_ast).rewrite_and_compile(mutate_func_name='mutate')
+
+        copies = []
+        def mutate(*indices):
+            for i in indices:
+                if not i in copies:
+                    copies.append(i)
+                    exec mutated[i][2] in scope
+
+        scope = { '__copy' : copy.copy, 'mutate': mutate }
+        exec prepare in scope
+        exec compiled in scope
+
+        descriptions = [mutated[i][1] for i in copies]
+        if descriptions != list(expected_copies):
+            raise AssertionError("Got copies '%s', expected '%s' (use_ast=%s)" % (descriptions, expected_copies, use_ast))
+        lazy = [description for (_, description, _, is_lazy) in mutated if is_lazy]
+        if sorted(lazy) != sorted(expected_lazy):
+            raise AssertionError("Got lazy '%s', expected '%s' (use_ast=%s)" % (lazy, expected_lazy, use_ast))
+
+    test_guarded('if False: a.append(1)', 'a = []', (), ('a',))
+    test_guarded('if True: a.append(1)', 'a = []', ('a',), ('a',))
+    test_guarded('b = 1; a[0][1] = 1', 'a = [[0, 1]]', ('a', 'a[...]'), ('a', 'a[...]'))
+    test_guarded('for i in range(3): a.append(i)', 'a = []', ('a',), ('a',))
+    # Functions might be called after the statement finishes, so their
+    # mutations can't be guarded
+    test_guarded('def f(): a.append(1)\nb.append(1)', 'a = []; b = []', ('b',), ('b',))
+
     #
     # Test handling of encoding
     #
-    def test_encoding(code, expected, encoding=None):
-        if encoding is not None:
-            compiled, _ = rewrite_and_compile(code, encoding=encoding, output_func_name='reinteract_output')
-        else:
-            compiled, _ = rewrite_and_compile(code, output_func_name='reinteract_output')
-        
-        test_args = []
-        def set_test_args(*args): test_args[:] = args
-        scope = { 'reinteract_output': set_test_args }
+    def test_encoding(code, expected, encoding="utf8"):
+        for use_ast in backends:
+            compiled, _ = rewrite_and_compile(code, encoding=encoding, output_func_name='reinteract_output',
+                                              use_ast=use_ast)
 
-        exec compiled in scope
+            test_args = []
+            def set_test_args(*args): test_args[:] = args
+            scope = { 'reinteract_output': set_test_args }
 
-        if test_args[0] != expected:
-            raise AssertionError("Got '%s', expected '%s'" % (test_args[0], expected))
+            exec compiled in scope
+
+            if test_args[0] != expected:
+                raise AssertionError("Got '%s', expected '%s' (use_ast=%s)" % (test_args[0], expected, use_ast))
 
     test_encoding(u"u'\u00e4'".encode("utf8"), u'\u00e4')
     test_encoding(u"u'\u00e4'", u'\u00e4')
     test_encoding(u"u'\u00e4'".encode("iso-8859-1"), u'\u00e4', "iso-8859-1")
+    test_encoding(u"'\u00e4'".encode("utf8"), u'\u00e4'.encode("utf8"))
+    test_encoding(u"'\u00e4'", u'\u00e4'.encode("utf8"))
+    test_encoding(u"'\u00e4'".encode("iso-8859-1"), u'\u00e4'.encode("iso-8859-1"), "iso-8859-1")
+
+    #
+    # Test the location of syntax errors
+    #
+    def test_syntax_error(code, lineno, encoding="utf8"):
+        for use_ast in backends:
+            try:
+                Rewriter(code, encoding, use_ast=use_ast).rewrite_and_compile()
+            except SyntaxError, e:
+                if e.lineno != lineno:
+                    raise AssertionError("Got line %s, expected %s (use_ast=%s)" % (e.lineno, lineno, use_ast))
+            else:
+                raise AssertionError("Expected a SyntaxError (use_ast=%s)" % use_ast)
+
+    test_syntax_error('a = 1\nb = (', 2)
+    test_syntax_error('a = 1\nb = (', 2, "iso-8859-1")
+    test_syntax_error('a = 1\nb = )', 2, "iso-8859-1")
 
     #
     # Test import detection
     #
 
     def test_imports(code, expected):
-        rewriter = Rewriter(code)
-        result = rewriter.get_imports()
-        if result != expected:
-            raise AssertionError("Got '%s', expected '%s'" % (result, expected))
+        for use_ast in backends:
+            rewriter = Rewriter(code, use_ast=use_ast)
+            result = rewriter.get_imports()
+            if result != expected:
+                raise AssertionError("Got '%s', expected '%s' (use_ast=%s)" % (result, expected, use_ast))
 
     test_imports('a + 1', None)
     test_imports('import re', [('re', [('.', 're')])])
@@ -1066,15 +1756,54 @@ a.a = A()
     test_imports('from re import match as m, sub as s', [('re', [('match', 'm'), ('sub', 's')])])
     test_imports('from re import (match as m, sub as s)', [('re', [('match', 'm'), ('sub', 's')])])
     test_imports('from ..re import match', [('..re', [('match', 'match')])])
+    test_imports('from . import re', [('.', [('re', 're')])])
+    test_imports('import os.path', [('os.path', [('.', 'path')])])
     test_imports('from re import *', [('re', '*')])
 
     test_imports('from __future__ import division', [('__future__', [('division', 'division')])])
 
+    #
+    # Test finding the names read and bound
+    #
+
+    def test_names(code, expected_reads, expected_writes):
+        if expected_reads is not None:
+            expected_reads = set(expected_reads)
+        if expected_writes is not None:
+            expected_writes = set(expected_writes)
+
+        for use_ast in backends:
+            rewriter = Rewriter(code, use_ast=use_ast)
+            rewriter.rewrite_and_compile()
+            reads, writes = rewriter.get_names()
+            if reads != expected_reads or writes != expected_writes:
+                raise AssertionError("Got '%s', expected '%s' (use_ast=%s)" %
+                                     ((reads, writes), (expected_reads, expected_writes), use_ast))
+
+    test_names('a = b + c', ('b', 'c'), ('a',))
+    test_names('a.b = c.d', ('a', 'c'), ('a',))
+    test_names('a.append(1)', ('a',), ('a',))
+    test_names('del a', (), ('a',))
+    test_names('import os.path', (), ('os',))
+    test_names('for i in x: y = i', ('x', 'i'), ('i', 'y'))
+    test_names('def f(x):\n    y = x + z\n    return y', ('z',), ('f',))
+    test_names('class C:\n    a = b', ('__name__', 'b'), ('C',))
+    test_names('f = lambda: g', ('g',), ('f',))
+    test_names('from os import *', None, None)
+    test_names('exec "a = 1"', None, None)
+    test_names('globals()["a"] = 1', None, None)
+    test_names('helper(a)', ('helper', 'a'), ('a',))
+    test_names('x = f(a.b + 1, *c)', ('f', 'a', 'c'), ('x', 'a', 'c'))
+    test_names('x = len(a) or g(h(b))', ('len', 'g', 'h', 'a', 'b'), ('x', 'a', 'b', 'h'))
+    test_names('def f(y):\n    return g(y)', ('g',), ('f',))
+    test_names('x = sorted(l, key=lambda v: v.lower())', ('sorted', 'l'), ('x', 'l'))
+
     #
     # Test passing in future_features to use in compilation
     #
 
-    scope = {}
-    compiled, _ = rewrite_and_compile('a = 1/2', future_features=['with_statement', 'division'])
-    exec compiled in scope
-    assert scope['a'] == 0.5
+    for use_ast in backends:
+        scope = {}
+        compiled, _ = rewrite_and_compile('a = 1/2', future_features=['with_statement', 'division'], use_ast=use_ast)
+        exec compiled in scope
+        assert scope['a'] == 0.5
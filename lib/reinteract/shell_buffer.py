@@ -165,7 +165,15 @@ class ShellBuffer(gtk.TextBuffer):
         if chunk.results_start_mark:
             raise RuntimeError("__insert_results called when we already have results")
 
-        if (chunk.results is None or len(chunk.results) == 0) and chunk.error_message is None:
+        # While the statement is executing, we show its output so far
+        if chunk.live_output is not None:
+            results = chunk.live_output
+        elif chunk.error_message:
+            results = [ chunk.error_message ]
+        else:
+            results = chunk.results
+
+        if results is None or len(results) == 0:
             return
 
         self.__begin_modification()
@@ -186,11 +194,6 @@ class ShellBuffer(gtk.TextBuffer):
         chunk.results_start_mark = self.create_mark(None, location, True)
         chunk.results_start_mark.source = chunk
 
-        if chunk.error_message:
-            results = [ chunk.error_message ]
-        else:
-            results = chunk.results
-
         first = True
         for result in results:
             if not first:
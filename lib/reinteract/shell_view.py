@@ -18,9 +18,22 @@ from notebook import NotebookFile
 import sanitize_textview_ipc
 
 LEFT_MARGIN_WIDTH = 10
+# Width of the column to the right of the status that shows how long each
+# statement took to execute, when enabled
+TIMES_WIDTH = 50
 
 ALL_WHITESPACE_RE = re.compile("^\s*$")
 
+def _format_time(seconds):
+    if seconds < 0.001:
+        return "<1ms"
+    elif seconds < 1:
+        return "%dms" % (seconds * 1000)
+    elif seconds < 60:
+        return "%.1fs" % seconds
+    else:
+        return "%dm%02ds" % divmod(int(seconds), 60)
+
 class ShellView(gtk.TextView):
     __gsignals__ = {
         'backspace' : 'override',
@@ -39,6 +52,7 @@ class ShellView(gtk.TextView):
         
     def __init__(self, buf):
         self.edit_only = buf.worksheet.edit_only
+        self.__show_statement_times = False
 
         if not self.edit_only:
             buf.worksheet.connect('chunk-inserted', self.on_chunk_inserted)
@@ -59,7 +73,7 @@ class ShellView(gtk.TextView):
             
         gtk.TextView.__init__(self, buf)
         if not self.edit_only:
-            self.set_border_window_size(gtk.TEXT_WINDOW_LEFT, LEFT_MARGIN_WIDTH)
+            self.set_border_window_size(gtk.TEXT_WINDOW_LEFT, self.__get_left_margin_width())
         self.set_left_margin(2)
 
         # Attach a "behavior object" to the view which, by ugly hacks, makes it
@@ -79,6 +93,22 @@ class ShellView(gtk.TextView):
         self.__arg_highlight_end = None
         buf.connect('mark-set', self.on_mark_set)
 
+    def __get_left_margin_width(self):
+        if self.__show_statement_times:
+            return LEFT_MARGIN_WIDTH + TIMES_WIDTH
+        else:
+            return LEFT_MARGIN_WIDTH
+
+    def set_show_statement_times(self, show_statement_times):
+        """Set whether the time each statement took to execute is shown in the left margin"""
+
+        if self.edit_only or show_statement_times == self.__show_statement_times:
+            return
+
+        self.__show_statement_times = show_statement_times
+        self.set_border_window_size(gtk.TEXT_WINDOW_LEFT, self.__get_left_margin_width())
+        self.queue_draw()
+
     def __get_worksheet_line_yrange(self, line):
         buffer_line = self.get_buffer().pos_to_iter(line)
         return self.get_line_yrange(buffer_line)
@@ -96,7 +126,7 @@ class ShellView(gtk.TextView):
         height = end_y + end_height - y
         
         (_, window_y) = self.buffer_to_window_coords(gtk.TEXT_WINDOW_LEFT, 0, y)
-        cr.rectangle(area.x, window_y, area.width, height)
+        cr.rectangle(0, window_y, LEFT_MARGIN_WIDTH, height)
         cr.set_source_rgb(*fill_color)
         cr.fill()
                 
@@ -105,6 +135,25 @@ class ShellView(gtk.TextView):
         cr.set_line_width(1)
         cr.stroke()
 
+    def paint_chunk_time(self, cr, chunk):
+        if chunk.metrics is None or chunk.metrics.execute_time is None:
+            return
+
+        (y, _) = self.__get_worksheet_line_yrange(chunk.start)
+        (_, window_y) = self.buffer_to_window_coords(gtk.TEXT_WINDOW_LEFT, 0, y)
+
+        layout = self.create_pango_layout(_format_time(chunk.metrics.execute_time))
+        width, _ = layout.get_pixel_size()
+
+        cr.move_to(LEFT_MARGIN_WIDTH + TIMES_WIDTH - 2 - width, window_y)
+        cr.set_source_rgb(0.4, 0.4, 0.4)
+        cr.show_layout(layout)
+
+    def __show_watch_cursor(self, worksheet):
+        # When the worksheet is calculated as the user types, a watch cursor
+        # flashing on and off would be distracting
+        return worksheet.state == NotebookFile.EXECUTING and worksheet.live_delay is None
+
     def do_realize(self):
         gtk.TextView.do_realize(self)
 
@@ -130,7 +179,7 @@ class ShellView(gtk.TextView):
         self.__watch_window.set_cursor(gtk.gdk.Cursor(gtk.gdk.WATCH))
         self.__watch_window.set_user_data(self)
 
-        if self.get_buffer().worksheet.state == NotebookFile.EXECUTING:
+        if self.__show_watch_cursor(self.get_buffer().worksheet):
             self.__watch_window.show()
             self.__watch_window.raise_()
 
@@ -169,6 +218,9 @@ class ShellView(gtk.TextView):
                 else:
                     self.paint_chunk(cr, event.area, chunk, (0, 0, 1), (0, 0, 0.5))
 
+                if self.__show_statement_times and not chunk.executing:
+                    self.paint_chunk_time(cr, chunk)
+
     def __draw_rect_outline(self, event, rect):
         if (rect.y + rect.height <= event.area.y or rect.y >= event.area.y + event.area.height):
             return
@@ -377,7 +429,7 @@ class ShellView(gtk.TextView):
                 # Workaround for http://bugzilla.gnome.org/show_bug.cgi?id=573664
                 event.x = 50.
             else:
-                event.x -= LEFT_MARGIN_WIDTH
+                event.x -= self.__get_left_margin_width()
 
     def do_button_press_event(self, event):
         self.__rewrite_window(event)
@@ -607,7 +659,7 @@ class ShellView(gtk.TextView):
 
         if self.window:
             left_margin_window = self.get_window(gtk.TEXT_WINDOW_LEFT)
-            left_margin_window.invalidate_rect((0, window_y, LEFT_MARGIN_WIDTH, end_y + end_height - start_y),
+            left_margin_window.invalidate_rect((0, window_y, self.__get_left_margin_width(), end_y + end_height - start_y),
                                                False)
 
     def on_chunk_inserted(self, worksheet, chunk):
@@ -621,7 +673,7 @@ class ShellView(gtk.TextView):
 
     def on_notify_state(self, worksheet, param_spec):
         if (self.flags() & gtk.REALIZED) != 0:
-            if worksheet.state == NotebookFile.EXECUTING:
+            if self.__show_watch_cursor(worksheet):
                 self.__watch_window.show()
                 self.__watch_window.raise_()
             else:
@@ -686,6 +738,17 @@ class ShellView(gtk.TextView):
 
         buf.worksheet.calculate(end_line=end_line)
 
+        self.__after_calculate()
+
+    def profile_statement(self, mode):
+        """Profile the statement at the cursor. See Worksheet.profile_statement()"""
+
+        buf = self.get_buffer()
+        line = buf.iter_to_pos(buf.get_iter_at_mark(buf.get_insert()), ADJUST_BEFORE)[0]
+        if buf.worksheet.profile_statement(line, mode):
+            self.__after_calculate()
+
+    def __after_calculate(self):
         # This is a hack to work around the fact that scroll_mark_onscreen()
         # doesn't wait for a size-allocate cycle, so doesn't properly handle
         # embedded request widgets
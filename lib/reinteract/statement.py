@@ -6,18 +6,170 @@
 #
 ########################################################################
 
-import copy
+import collections
+import cProfile
+import dis
+import os
 import pkgutil
+import threading
 import traceback
 import sys
+import time
+import types
 
+from bounded_repr import bounded_repr
+from chained_scope import ChainedScope
+from compile_cache import compile_cache
+import copy_strategy
 from custom_result import CustomResult
 import notebook
 from notebook import HelpResult
+from output_result import OutputResult
+import profile_result
+from profile_result import profile_exec
+from result_cache import make_key, fingerprint_value
 from rewrite import Rewriter, UnsupportedSyntaxError
 import reunicode
 from stdout_capture import StdoutCapture
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Builtins that give the code calling them access to its globals dictionary
+_GLOBALS_FUNCTIONS = frozenset(['globals', 'eval', 'execfile', 'input'])
+
+# Number of lines of output kept for showing while a statement is executing
+_LIVE_OUTPUT_LINES = 20
+
+def _needs_flat_scope(code):
+    # Code nested inside a statement (function and class bodies, lambdas,
+    # generator expressions) looks up global variables directly in the globals
+    # dictionary, bypassing ChainedScope.__missing__. The same is true for
+    # code run by an exec statement or by eval(). In those cases we need to
+    # execute the statement in a scope that holds all the variables of the
+    # worksheet.
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            return True
+
+    if _GLOBALS_FUNCTIONS.intersection(code.co_names):
+        return True
+
+    co_code = code.co_code
+    exec_stmt = dis.opmap['EXEC_STMT']
+    i = 0
+    while i < len(co_code):
+        op = ord(co_code[i])
+        if op == exec_stmt:
+            return True
+        if op >= dis.HAVE_ARGUMENT:
+            i += 3
+        else:
+            i += 1
+
+    return False
+
+class _OutputTarget(threading.local):
+    # The reinteract_output() and reinteract_copy_mutated() functions defined in
+    # the worksheet's global scope call methods of __reinteract_statement. Since
+    # statements may be executed in several threads at once, we make
+    # __reinteract_statement an object that forwards to the statement executing
+    # in the current thread.
+
+    def __init__(self):
+        self.statement = None
+
+    def do_output(self, *args):
+        self.statement.do_output(*args)
+
+    def copy_mutated(self, *indices):
+        self.statement.copy_mutated(*indices)
+
+_output_target = _OutputTarget()
+
+def _get_peak_rss():
+    # Returns the peak resident set size of the process in kilobytes, or None
+    if resource is None:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes
+    if sys.platform == 'darwin':
+        peak_rss /= 1024
+
+    return peak_rss
+
+def _estimate_size(value):
+    # Rough estimate of the memory used by a value; we count the contents of
+    # containers one level deep, and use the size of the data for numpy arrays
+    # (and anything else with an integer nbytes attribute)
+    if isinstance(value, types.ModuleType):
+        # Shared with the rest of the program
+        return 0
+
+    try:
+        nbytes = getattr(value, 'nbytes', None)
+    except Exception:
+        nbytes = None
+    if isinstance(nbytes, (int, long)):
+        return nbytes
+
+    size = sys.getsizeof(value, 0)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += sys.getsizeof(item, 0)
+    elif isinstance(value, dict):
+        for k, v in value.iteritems():
+            size += sys.getsizeof(k, 0) + sys.getsizeof(v, 0)
+
+    return size
+
+def _is_only_reference(scope, name):
+    # True if the binding of name in scope is the only reference to its value.
+    # The value is never held in a local variable, so the only other reference
+    # is the argument to getrefcount(), however deep the call stack is, and
+    # even if a tracing or profiling function looks at the local variables
+    return sys.getrefcount(dict.__getitem__(scope, name)) == 2
+
+class StatementMetrics(object):
+    """
+
+    Measurements of the resources used to compile and execute a statement. The
+    CPU time and peak memory are for the whole process, so they include other
+    statements if several are being executed at once.
+
+    """
+
+    def __init__(self):
+        #: time spent compiling the statement, in seconds
+        self.compile_time = None
+        #: wall-clock time taken by the last execution, in seconds
+        self.execute_time = None
+        #: CPU time used during the last execution, in seconds
+        self.cpu_time = None
+        #: increase in the peak resident set size of the process during the last
+        #: execution, in kilobytes. None if unknown
+        self.peak_rss_delta = None
+        #: time spent during the last execution copying objects that the
+        #: statement modifies, in seconds
+        self.copy_time = None
+        #: list of (description, strategy) for the objects copied during the last
+        #: execution, where strategy is the name of the L{copy_strategy} used
+        self.copies = None
+
+    @property
+    def cost(self):
+        """Total time spent compiling and executing the statement, in seconds"""
+
+        return (self.compile_time or 0) + (self.execute_time or 0)
+
+    def __repr__(self):
+        return "StatementMetrics(compile_time=%r, execute_time=%r, cpu_time=%r, peak_rss_delta=%r, copy_time=%r, copies=%r)" % \
+            (self.compile_time, self.execute_time, self.cpu_time, self.peak_rss_delta, self.copy_time, self.copies)
+
 class WarningResult(object):
     def __init__(self, message):
         self.message = message
@@ -49,25 +201,68 @@ class Statement:
         self.imports = None
         #: names imported from __future__. Used when compiling subsequent statements
         self.future_features = None
+        #: set of names that the statement reads. Set after compilation; None if unknown
+        self.reads = None
+        #: set of names that the statement binds or deletes. Set after compilation; None if unknown
+        self.writes = None
 
         #: scope at the end of successful execution
         self.result_scope = None
         #: list of results from the statement. Set after successful execution
         self.results = None
 
+        #: key for the statement in the notebook's result cache, if it has one
+        self.cache_key = None
+        #: dictionary mapping the names bound by the statement to fingerprints of their
+        #: values. Set after successful execution if the notebook has a result cache
+        self.fingerprints = None
+        #: if not None, the next execution of the statement is profiled, and a
+        #: ProfileResult is added to the results. One of the modes defined in
+        #: L{profile_result}
+        self.profile = None
+        #: key for the statement in the worksheet's checkpoint. Set by the worksheet
+        #: before execution; see L{checkpoint.make_key}
+        self.checkpoint_key = None
+
+        #: resources used compiling and executing the statement. See L{StatementMetrics}
+        self.metrics = StatementMetrics()
+
         #: error_message: error message in case of compilation or execution error
         self.error_message = None
         #: line where error occured in case of compilation or execution error
         self.error_line = None
         #: offset within line of a compilation error
         self.error_offset = None
+        #: if not None, used as the error message if the current execution is
+        #: interrupted. Set by the executor to explain why it interrupted the statement
+        self.interrupt_message = None
+        #: True while the statement executes at the same time as other statements
+        #: that may be reading the scope of its parent; set by the executor. Copies
+        #: of objects from the parent's scope are never elided then
+        self.shares_parent_scope = False
 
         self.__compiled = None
+        self.__needs_flat_scope = False
+        # (checkpoint, key) for the copy of the result scope saved by release_scope()
+        self.__spill = None
+        # True if a later statement took over objects from the result scope
+        self.__consumed = False
+        # While executing, the scopes to copy mutated objects in, and the indices
+        # of the mutations that have been copied
+        self.__copy_scopes = None
+        self.__copied = None
         self.__parent_future_features = None
 
         self.set_parent(parent)
 
-        self.__stdout_buffer = None
+        # While executing, the pieces of the current line of output, and the last
+        # complete lines, for get_live_output()
+        self.__stdout_partial = None
+        self.__live_output = None
+        # While executing, the number of lines of output in the results, and the
+        # OutputResult holding the lines past worksheet.max_output_lines
+        self.__output_lines = 0
+        self.__output_overflow = None
         self.__capture = None
 
     def set_parent(self, parent):
@@ -98,15 +293,46 @@ class Statement:
         elif self.state != Statement.NEW:
             return self.state != Statement.COMPILE_ERROR
 
+        start_time = time.time()
+        try:
+            return self.__do_compile()
+        finally:
+            self.metrics.compile_time = time.time() - start_time
+
+    def __do_compile(self):
         self.error_message = None
         self.error_line = None
         self.error_offset = None
 
         try:
-            rewriter = Rewriter(self.__text, future_features=self.__parent_future_features)
-            self.imports = rewriter.get_imports()
-            self.__compiled, self.__mutated = rewriter.rewrite_and_compile(output_func_name='reinteract_output',
-                                                                           copy_func_name="__reinteract_copy")
+            compiled = compile_cache.lookup(self.__text, self.__parent_future_features)
+            bytecode_cache = self.__worksheet.notebook.bytecode_cache
+            if compiled is None and bytecode_cache is not None:
+                compiled = bytecode_cache.lookup(self.__text, self.__parent_future_features)
+                if compiled is not None:
+                    compile_cache.store(self.__text, self.__parent_future_features, compiled)
+            if compiled is None:
+                rewriter = Rewriter(self.__text, future_features=self.__parent_future_features)
+                imports = rewriter.get_imports()
+                code, mutated = rewriter.rewrite_and_compile(output_func_name='reinteract_output',
+                                                             copy_func_name="__reinteract_copy",
+                                                             mutate_func_name='reinteract_copy_mutated')
+                reads, writes = rewriter.get_names()
+                # Output of a value stores it in '_'
+                if writes is not None and 'reinteract_output' in reads:
+                    writes.add('_')
+                if reads is not None:
+                    reads = frozenset(reads)
+                if writes is not None:
+                    writes = frozenset(writes)
+
+                compiled = (code, mutated, imports, _needs_flat_scope(code), reads, writes)
+                compile_cache.store(self.__text, self.__parent_future_features, compiled)
+                if bytecode_cache is not None:
+                    bytecode_cache.store(self.__text, self.__parent_future_features, compiled)
+
+            (self.__compiled, self.__mutated, self.imports,
+             self.__needs_flat_scope, self.reads, self.writes) = compiled
         except SyntaxError, e:
             self.error_message = e.msg
             self.error_line = e.lineno
@@ -158,30 +384,145 @@ class Statement:
             elif isinstance(args[0], CustomResult) or isinstance(args[0], HelpResult):
                 self.results.append(args[0])
             else:
-                self.results.append(self.__coerce_to_unicode(repr(args[0])))
+                self.results.append(self.__coerce_to_unicode(bounded_repr(args[0])))
                 self.result_scope['_'] = args[0]
         else:
-            self.results.append(self.__coerce_to_unicode(repr(args)))
+            self.results.append(self.__coerce_to_unicode(bounded_repr(args)))
             self.result_scope['_'] = args
 
+    def __copy_mutation(self, i):
+        root, description, copy_code, _ = self.__mutated[i]
+        global_scope, scope = self.__copy_scopes
+        try:
+            # If the path to the mutated object starts with a module, ignore it;
+            # our copy magic only applies to worksheet-loca variables
+            if root in scope and type(scope[root]) != type(sys):
+                if description == root and self.__can_elide_copy(root):
+                    # Take over the object from the parent statement. Deleting it
+                    # from the parent's scope also keeps a binding of the name in
+                    # an earlier scope from showing through
+                    parent_scope = self.__parent.result_scope
+                    scope[root] = dict.__getitem__(parent_scope, root)
+                    del parent_scope[root]
+                    self.__parent.__consumed = True
+                    self.__parent.__discard_spill()
+                    self.metrics.copies.append((description, 'elided'))
+                    return
+
+                old_value = scope[root]
+                copy_strategy.pop_last_strategy()
+                exec copy_code in global_scope, scope
+                self.metrics.copies.append((description, copy_strategy.pop_last_strategy()))
+                # When copying lazily, the statement may already have bound other
+                # names to the object; they should refer to the copy as well
+                if description == root:
+                    new_value = scope[root]
+                    for name, value in dict.items(scope):
+                        if value is old_value and name != root:
+                            scope[name] = new_value
+        except:
+            self.results.append(WarningResult("'%s' apparently modified, but can't copy it" % description))
+
+    def __can_elide_copy(self, root):
+        # We don't need to copy an object if nothing but the parent statement's
+        # scope refers to it; we can modify it in place if we give up the parent's
+        # scope, so that the parent will be reexecuted if its scope is needed again.
+        if not self.__worksheet.elide_copies or self.shares_parent_scope:
+            return False
+
+        parent = self.__parent
+        if parent is None or parent.result_scope is None:
+            return False
+
+        # The name must refer to the object bound in the parent's scope, not
+        # to something this statement bound itself
+        parent_scope = parent.result_scope
+        if dict.__contains__(self.__copy_scopes[1], root) or not dict.__contains__(parent_scope, root):
+            return False
+
+        # Anything else that refers to the object (another name, a container,
+        # the result cache) might observe the modification
+        return _is_only_reference(parent_scope, root)
+
+    def copy_mutated(self, *indices):
+        """Called by execution of statements before code that might modify variables (see L{Rewriter})"""
+
+        if self.__copy_scopes is None:
+            return
+
+        start = time.time()
+        for i in indices:
+            if not i in self.__copied:
+                self.__copied.add(i)
+                self.__copy_mutation(i)
+        self.metrics.copy_time += time.time() - start
+
     def __stdout_write(self, s):
         s = self.__coerce_to_unicode(s)
 
-        if self.__stdout_buffer is None:
-            self.__stdout_buffer = s
-        else:
-            self.__stdout_buffer += s
-
-        pos = 0
-        while True:
-            next = self.__stdout_buffer.find("\n", pos)
-            if next < 0:
-                break
-            self.results.append(self.__stdout_buffer[pos:next])
-            pos = next + 1
-            
-        if pos > 0:
-            self.__stdout_buffer = self.__stdout_buffer[pos:]
+        # We only look for newlines in the new text, and only join the pieces
+        # of a line when it's complete, so a long line isn't copied for each write
+        lines = s.split("\n")
+        if len(lines) > 1:
+            self.__stdout_partial.append(lines[0])
+            lines[0] = u"".join(self.__stdout_partial)
+            # get_live_output() may be reading the old list in another thread
+            self.__stdout_partial = []
+            for line in lines[0:-1]:
+                self.__append_output(line)
+                self.__live_output.append(line)
+
+        if lines[-1] != "":
+            self.__stdout_partial.append(lines[-1])
+
+    def __append_output(self, line):
+        # Past the limit, lines go to a file rather than into the results, so
+        # memory use and the size of the displayed results stay bounded
+        if self.__output_overflow is not None:
+            self.__output_overflow.write_line(line)
+            return
+
+        max_output_lines = self.__worksheet.max_output_lines
+        if max_output_lines is not None and self.__output_lines >= max_output_lines:
+            self.__output_overflow = OutputResult()
+            self.results.append(self.__output_overflow)
+            self.__output_overflow.write_line(line)
+            return
+
+        self.results.append(line)
+        self.__output_lines += 1
+
+    def __finish_output(self):
+        if self.__output_overflow is not None:
+            self.__output_overflow.finish()
+            self.__output_overflow = None
+
+    def get_live_output(self):
+        """Return the last lines the statement has output so far while it is executing
+
+        This can be called from a different thread than the one executing the statement.
+
+        @returns: a list of at most _LIVE_OUTPUT_LINES strings, including the
+           incomplete last line, or None if the statement isn't executing or
+           hasn't output anything
+
+        """
+
+        live_output = self.__live_output
+        partial = self.__stdout_partial
+        if live_output is None or partial is None:
+            return None
+
+        lines = list(live_output)
+        if len(partial) > 0:
+            lines.append(u"".join(partial))
+            if len(lines) > _LIVE_OUTPUT_LINES:
+                del lines[0]
+
+        if len(lines) == 0:
+            return None
+
+        return lines
 
     def before_execute(self):
         """Set up for execution
@@ -198,7 +539,8 @@ class Statement:
         assert self.state != Statement.NEW and self.state != Statement.COMPILE_ERROR
         self.state = Statement.EXECUTING
 
-        self.__worksheet.global_scope['__reinteract_statement'] = self
+        self.__worksheet.global_scope['__reinteract_statement'] = _output_target
+        _output_target.statement = self
         self.__capture = StdoutCapture(self.__stdout_write)
         self.__capture.push()
 
@@ -213,9 +555,15 @@ class Statement:
             self.state = Statement.INTERRUPTED
             self.results = None
             self.result_scope = None
-
-        self.__worksheet.global_scope['__reinteract_statement'] = None
-        self.__stdout_buffer = None
+            self.error_message = self.interrupt_message
+        self.interrupt_message = None
+
+        _output_target.statement = None
+        self.__stdout_partial = None
+        self.__live_output = None
+        self.__finish_output()
+        self.__copy_scopes = None
+        self.__copied = None
         self.__capture.pop()
         self.__capture = None
 
@@ -230,8 +578,8 @@ class Statement:
         # The top two frames are always statement.__do_execute and the compiled
         # statement, so we skip them as not useful. We additionally skip frames that
         # are inside the notebook and pkgutil modules because these are likely our
-        # our custom import implementation
-        skip_filenames = [self.__get_module_filename(m) for m in (notebook, pkgutil)]
+        # our custom import implementation, and frames from the profiler
+        skip_filenames = [self.__get_module_filename(m) for m in (notebook, pkgutil, profile_result, cProfile)]
         extracted = filter(lambda x: x[0] not in skip_filenames, traceback.extract_tb(tb)[2:])
 
         formatted = "".join(traceback.format_list(extracted))
@@ -239,30 +587,145 @@ class Statement:
 
         return (formatted + last_line).rstrip()
 
+    def __get_input_fingerprint(self, name):
+        statement = self.__parent
+        while statement is not None:
+            if statement.fingerprints is None:
+                return None
+            if name in statement.fingerprints:
+                return statement.fingerprints[name]
+            statement = statement.__parent
+
+        # Not bound by any statement, so it comes from the global scope
+        return "global"
+
+    def __compute_cache_key(self):
+        if self.reads is None:
+            return None
+
+        input_fingerprints = {}
+        for name in self.reads:
+            fingerprint = self.__get_input_fingerprint(name)
+            if fingerprint is None:
+                return None
+            input_fingerprints[name] = fingerprint
+
+        return make_key(self.__text, self.future_features, input_fingerprints)
+
+    def __update_fingerprints(self, scope):
+        self.fingerprints = {}
+        for name, value in scope.local_items():
+            if self.cache_key is not None:
+                self.fingerprints[name] = fingerprint_value(self.cache_key, name, value)
+            else:
+                self.fingerprints[name] = None
+        for name in scope.deleted:
+            self.fingerprints[name] = None
+
+    def __get_parent_scope(self):
+        if self.__parent:
+            return self.__parent.result_scope
+        else:
+            return self.__worksheet.global_scope
+
+    def __restore_scope(self, scope, bound, deleted):
+        for name in deleted:
+            if name in scope:
+                del scope[name]
+        for name, value in bound:
+            scope[name] = value
+        scope.seal()
+
     def __do_execute(self):
         root_scope = self.__worksheet.global_scope
-        if self.__parent:
-            scope = copy.copy(self.__parent.result_scope)
+        parent_scope = self.__get_parent_scope()
+
+        # Rather than copying the entire parent scope, we normally execute the
+        # statement with a ChainedScope as locals; this stores only the names that
+        # the statement binds and looks up everything else in the parent scope.
+        # Name lookups from nested code don't go through the locals, so for
+        # statements with nested code we fall back to a flattened copy.
+        if self.__needs_flat_scope:
+            scope = ChainedScope(parent_scope, flatten=True)
+            global_scope = scope
         else:
-            scope = copy.copy(root_scope)
+            scope = ChainedScope(parent_scope)
+            global_scope = root_scope
 
         self.results = []
         self.result_scope = scope
-        self.__stdout_buffer = None
-
-        for root, description, copy_code in self.__mutated:
-            try:
-                # If the path to the mutated object starts with a module, ignore it;
-                # our copy magic only applies to worksheet-loca variables
-                if root in scope and type(scope[root]) != type(sys):
-                    exec copy_code in scope, scope
-            except:
-                self.results.append(WarningResult("'%s' apparently modified, but can't copy it" % description))
+        self.__discard_spill()
+        self.__consumed = False
+        self.__stdout_partial = []
+        self.__live_output = collections.deque(maxlen=_LIVE_OUTPUT_LINES)
+        self.__output_lines = 0
+        self.__output_overflow = None
+        self.metrics.copy_time = 0.
+        self.metrics.copies = []
+
+        # Profiling only applies to a single execution
+        profile = self.profile
+        self.profile = None
+
+        # If we've executed the same statement with the same inputs before, we can
+        # restore the results from the cache rather than executing it again
+        cache = self.__worksheet.notebook.result_cache
+        self.cache_key = None
+        self.fingerprints = None
+        if cache is not None:
+            self.cache_key = self.__compute_cache_key()
+
+        # The worksheet's checkpoint has the results from a previous session if
+        # neither this statement nor any statement before it has changed since
+        # A statement being profiled has to actually be executed
+        entry = None
+        if profile is None:
+            checkpoint = self.__worksheet.checkpoint
+            if checkpoint is not None and self.checkpoint_key is not None:
+                entry = checkpoint.lookup(self.checkpoint_key)
+            if entry is None and self.cache_key is not None:
+                entry = cache.lookup(self.cache_key)
+
+        if entry is not None:
+            results, bound, deleted = entry
+            self.results = results
+            self.__restore_scope(scope, bound, deleted)
+            if cache is not None:
+                self.__update_fingerprints(scope)
+            self.state = Statement.EXECUTE_SUCCESS
+            return True
+
+        # Objects that the statement might modify are copied so that the parent
+        # scope isn't affected. If the modification is guarded (see
+        # L{Rewriter.rewrite_and_compile}), we can wait until the statement
+        # gets to it, which avoids copying if it doesn't. Objects in flattened
+        # scopes are always copied up front, since nested code might refer to them.
+        self.__copy_scopes = (global_scope, scope)
+        self.__copied = set()
+        lazy_copy = self.__worksheet.lazy_copy and not self.__needs_flat_scope
+        copy_start = time.time()
+        for i, (_, _, _, guarded) in enumerate(self.__mutated):
+            if not (lazy_copy and guarded):
+                self.__copied.add(i)
+                self.__copy_mutation(i)
+        self.metrics.copy_time = time.time() - copy_start
 
         try:
-            exec self.__compiled in scope, scope
-            if self.__stdout_buffer is not None and self.__stdout_buffer != '':
-                self.results.append(self.__stdout_buffer)
+            if profile is not None:
+                result = profile_exec(self.__compiled, global_scope, scope, profile)
+            else:
+                exec self.__compiled in global_scope, scope
+            if len(self.__stdout_partial) > 0:
+                self.__append_output(u"".join(self.__stdout_partial))
+            self.__finish_output()
+            scope.seal()
+            if profile is not None:
+                self.results.append(result)
+            if cache is not None:
+                self.__update_fingerprints(scope)
+                # The profile shouldn't be shown when the results are restored later
+                if self.cache_key is not None and profile is None:
+                    cache.store(self.cache_key, self.results, scope.local_items(), list(scope.deleted))
             self.state = Statement.EXECUTE_SUCCESS
         except KeyboardInterrupt, e:
             raise e
@@ -284,12 +747,228 @@ class Statement:
         was_in_execute = self.state == Statement.EXECUTING
         if not was_in_execute:
             self.before_execute()
+
+        start_time = time.time()
+        start_cpu = sum(os.times()[0:2])
+        start_rss = _get_peak_rss()
         try:
             return self.__do_execute()
         finally:
+            self.metrics.execute_time = time.time() - start_time
+            self.metrics.cpu_time = sum(os.times()[0:2]) - start_cpu
+            if start_rss is not None:
+                self.metrics.peak_rss_delta = _get_peak_rss() - start_rss
+
             if not was_in_execute:
                 self.after_execute()
 
+    def rebase(self, parent_scope=None):
+        """Update the result scope of a statement that executed successfully for a new parent scope
+
+        When a previous statement is reexecuted, but it didn't change any of the names
+        that this statement reads, reexecuting this statement would give the same
+        results, so we just need to rebuild the result scope on top of the parent's new
+        result scope.
+
+        @param parent_scope: the scope to rebuild the result scope on top of. If None,
+           the result scope of the parent statement.
+        @returns: True if successful; False if the scope had been released and
+           couldn't be restored, so the statement needs to be reexecuted
+
+        """
+
+        assert self.state == Statement.EXECUTE_SUCCESS
+
+        if parent_scope is None:
+            parent_scope = self.__get_parent_scope()
+
+        if self.result_scope is None:
+            # The scope was released; the names it bound were saved to disk
+            assert self.__spill is not None
+            if not self.__restore_spilled_scope(parent_scope):
+                return False
+        else:
+            self.result_scope = self.result_scope.rebase(parent_scope)
+
+        return True
+
+    @property
+    def scope_released(self):
+        """True if the statement executed successfully, but release_scope() has been called"""
+        return self.state == Statement.EXECUTE_SUCCESS and self.result_scope is None
+
+    @property
+    def scope_consumed(self):
+        """True if a later statement modified objects from the result scope in place
+
+        The statement needs to be reexecuted before its scope can be used as
+        the parent scope of other statements. See L{Worksheet.elide_copies}.
+
+        """
+
+        return self.__consumed
+
+    @property
+    def can_rebase(self):
+        """True if the statement executed successfully and rebase() can update its scope
+
+        That's the case if the scope hasn't been consumed and is either in memory
+        or was saved to disk when it was released.
+
+        """
+
+        return (self.state == Statement.EXECUTE_SUCCESS and not self.__consumed and
+                (self.result_scope is not None or self.__spill is not None))
+
+    def estimate_scope_size(self):
+        """Estimate the memory used by the values of the names the statement bound
+
+        @returns: the estimated size in bytes; 0 if the statement has no result scope
+
+        """
+
+        if self.result_scope is None:
+            return 0
+
+        return sum(_estimate_size(value) for name, value in self.result_scope.local_items())
+
+    def release_scope(self, spill=None, key=None):
+        """Drop the result scope of a statement that executed successfully to free memory
+
+        The results are kept. If spill is passed in, the names bound by the
+        statement are saved there first, so that rebuild_scope() can restore
+        the scope without reexecuting the statement. Statements that use this
+        statement as their parent must be rebased onto a scope that doesn't
+        refer to the released scope, or released as well.
+
+        @param spill: a L{checkpoint.Checkpoint} to save the scope into, or None
+        @param key: the key to store the scope under in spill
+        @returns: True if the scope was saved into spill
+
+        """
+
+        assert self.state == Statement.EXECUTE_SUCCESS
+
+        if self.result_scope is None:
+            return self.__spill is not None
+
+        self.__discard_spill()
+        # A consumed scope no longer matches the execution of the statement
+        if spill is not None and not self.__consumed:
+            # The results are kept in memory, so aren't saved
+            if spill.store(key, None, self.result_scope.local_items(), list(self.result_scope.deleted)):
+                self.__spill = (spill, key)
+
+        self.result_scope = None
+
+        return self.__spill is not None
+
+    @property
+    def spill_key(self):
+        """The key that release_scope() saved the result scope under, or None"""
+        if self.__spill is not None:
+            return self.__spill[1]
+        else:
+            return None
+
+    def __discard_spill(self):
+        # Remove the saved copy of the result scope, which no longer matches
+        if self.__spill is not None:
+            spill, key = self.__spill
+            spill.remove(key)
+            self.__spill = None
+
+    def __restore_spilled_scope(self, parent_scope):
+        spill, key = self.__spill
+        entry = spill.lookup(key)
+        if entry is None:
+            self.__discard_spill()
+            return False
+
+        _, bound, deleted = entry
+        self.result_scope = ChainedScope(parent_scope)
+        self.__restore_scope(self.result_scope, bound, deleted)
+
+        return True
+
+    def rebuild_scope(self):
+        """Restore the result scope after release_scope()
+
+        The scope is restored from the copy saved when it was released, as are
+        the scopes of any released statements before it. If some scope wasn't
+        saved, or can't be loaded, the statements need to be reexecuted to get
+        the scope back.
+
+        @returns: True if the statement now has a result scope
+
+        """
+
+        if self.result_scope is not None:
+            return True
+
+        released = []
+        statement = self
+        while statement is not None and statement.result_scope is None:
+            if statement.state != Statement.EXECUTE_SUCCESS or statement.__spill is None:
+                return False
+            released.append(statement)
+            statement = statement.__parent
+
+        for statement in reversed(released):
+            if not statement.__restore_spilled_scope(statement.__get_parent_scope()):
+                return False
+
+        return True
+
+    def get_execution_state(self):
+        """Get the outcome of the last execution of the statement
+
+        The result can be passed to set_execution_state() on a copy of the statement
+        in a different process, if it can be pickled.
+
+        @returns: an opaque tuple
+
+        """
+
+        if self.result_scope is not None:
+            bound = self.result_scope.local_items()
+            deleted = list(self.result_scope.deleted)
+        else:
+            bound = None
+            deleted = None
+
+        return (self.state, self.results, bound, deleted,
+                self.error_message, self.error_line, self.error_offset,
+                self.cache_key, self.fingerprints, self.metrics)
+
+    def set_execution_state(self, execution_state):
+        """Set the outcome of executing the statement from the result of get_execution_state()
+
+        The result scope is recreated on top of the result scope of the parent statement.
+
+        @param execution_state: the result of calling get_execution_state()
+
+        """
+
+        (self.state, self.results, bound, deleted,
+         self.error_message, self.error_line, self.error_offset,
+         self.cache_key, self.fingerprints, self.metrics) = execution_state
+
+        if self.state == Statement.INTERRUPTED and self.interrupt_message is not None:
+            self.error_message = self.interrupt_message
+        self.interrupt_message = None
+
+        # The statement was executed in place of this one, so any profiling was done there
+        self.profile = None
+
+        self.__discard_spill()
+        self.__consumed = False
+        if bound is not None:
+            self.result_scope = ChainedScope(self.__get_parent_scope())
+            self.__restore_scope(self.result_scope, bound, deleted)
+        else:
+            self.result_scope = None
+
     def mark_for_execute(self):
         """Mark a statement that executed succesfully as needing execution again"""
         if self.state != Statement.NEW and self.state != Statement.COMPILE_ERROR:
@@ -320,11 +999,39 @@ if __name__=='__main__':
     expect_result("'a'", repr('a'))
     expect_result("1,2", repr((1,2)))
 
+    # Long reprs are shortened without computing all of them
+    expect_result("range(0, 1000)", repr(range(0, 100))[0:-1] + ", ...]")
+
     # Print, on the other hand, gives the string form of the expression, with
     # one result object per output line
     expect_result("print 'a'", 'a')
     expect_result("print 'a', 'b'", ['a b'])
     expect_result("print 'a\\nb'", ['a','b'])
+    expect_result("import sys; sys.stdout.write('a'); sys.stdout.write('b\\nc'); sys.stdout.write('d')",
+                  ['ab', 'cd'])
+
+    # While executing, the last lines of output can be retrieved
+    live_output = []
+    s = Statement("for i in xrange(0, 30): print i\nprint 'a',\ncheck()", worksheet)
+    worksheet.global_scope['check'] = lambda: live_output.append(s.get_live_output())
+    s.compile()
+    s.execute()
+    del worksheet.global_scope['check']
+    assert_equals(live_output, [[str(i) for i in xrange(11, 30)] + ['a']])
+    assert_equals(len(s.results), 31)
+    assert_equals(s.get_live_output(), None)
+
+    # Output past the limit goes to an OutputResult
+    worksheet.max_output_lines = 10
+    s = Statement("import sys\nfor i in xrange(0, 25): sys.stdout.write('%d\\n' % i)\n42", worksheet)
+    s.compile()
+    s.execute()
+    assert_equals(s.results[0:10], [str(i) for i in xrange(0, 10)])
+    assert isinstance(s.results[10], OutputResult)
+    assert_equals(s.results[10].line_count, 15)
+    assert_equals(s.results[10].read_page(0)[0], "10")
+    assert_equals(s.results[11:], ['42'])
+    worksheet.max_output_lines = 1000
 
     # Test that we copy a variable before mutating it (when we can detect
     # the mutation)
@@ -344,6 +1051,38 @@ if __name__=='__main__':
     s2a.execute()
     assert_equals(s2a.results[0], "0")
 
+    # A container that the statement stores the object in sees the modification
+    s2 = Statement("d = {'x': b}\nb.append(2)\nd['x']", worksheet, parent=s1)
+    s2.compile()
+    s2.execute()
+    assert_equals(s2.results, ["[0, 2]"])
+    s2 = Statement("c = [b]\nb.append(2)\nc", worksheet, parent=s1)
+    s2.compile()
+    s2.execute()
+    assert_equals(s2.results, ["[[0, 2]]"])
+    assert_equals(s1.result_scope['b'], [0])
+
+    # The copy is only made when the statement reaches the modification
+    worksheet.lazy_copy = True
+    s2 = Statement("if False: b.append(1)", worksheet, parent=s1)
+    s2.compile()
+    s2.execute()
+    assert s2.result_scope['b'] is s1.result_scope['b']
+
+    # Names that the statement bound to the object refer to the copy
+    s2 = Statement("c = b\nb.append(2)", worksheet, parent=s1)
+    s2.compile()
+    s2.execute()
+    assert_equals(s2.result_scope['c'], [0, 2])
+    assert s2.result_scope['c'] is s2.result_scope['b']
+    assert_equals(s1.result_scope['b'], [0])
+
+    worksheet.lazy_copy = False
+    s2 = Statement("if False: b.append(1)", worksheet, parent=s1)
+    s2.compile()
+    s2.execute()
+    assert s2.result_scope['b'] is not s1.result_scope['b']
+
     # Tests of catching errors
     s1 = Statement("b = ", worksheet)
     assert_equals(s1.compile(), False)
@@ -364,3 +1103,141 @@ if __name__=='__main__':
 
     s1 = Statement("import  __future__", worksheet) # just a normal import
     assert_equals(s1.future_features, None)
+
+    # Tests of tracking the names a statement reads and writes
+    s1 = Statement("a = b + 1", worksheet)
+    s1.compile()
+    assert_equals(s1.reads, set(['b']))
+    assert_equals(s1.writes, set(['a']))
+    s1 = Statement("a", worksheet)
+    s1.compile()
+    assert_equals(s1.writes, set(['_']))
+
+    # Tests of caching compilation
+    hits = compile_cache.hits
+    s1 = Statement("a = 1 + 1", worksheet)
+    s1.compile()
+    s2 = Statement("a = 1 + 1", worksheet)
+    s2.compile()
+    assert_equals(compile_cache.hits, hits + 1)
+    s2.execute()
+    assert_equals(s2.result_scope['a'], 2)
+    # Different __future__ features mean a different compilation
+    s1 = Statement("from __future__ import division", worksheet)
+    s1.compile()
+    misses = compile_cache.misses
+    s2 = Statement("a = 1 + 1", worksheet, parent=s1)
+    s2.compile()
+    assert_equals(compile_cache.misses, misses + 1)
+
+    # Tests of the on-disk cache of compiled code
+    import os
+    import shutil
+    import tempfile
+    from compile_cache import BytecodeCache
+
+    cache_dir = tempfile.mkdtemp("", "reinteract_statement")
+    try:
+        nb.bytecode_cache = BytecodeCache(cache_dir)
+        s1 = Statement("b = [1]; b[0] = 2", worksheet)
+        s1.compile()
+        assert_equals(len(os.listdir(cache_dir)), 1)
+        compile_cache.clear()
+        misses = compile_cache.misses
+        s2 = Statement("b = [1]; b[0] = 2", worksheet)
+        s2.compile()
+        assert_equals(compile_cache.misses, misses + 1)
+        assert_equals(s2.writes, s1.writes)
+        s2.execute()
+        assert_equals(s2.result_scope['b'], [2])
+    finally:
+        nb.bytecode_cache = None
+        shutil.rmtree(cache_dir)
+
+    # Tests of rebasing a statement onto a new parent scope
+    s1 = Statement("a = 1; b = 2", worksheet)
+    s1.compile()
+    s1.execute()
+    s2 = Statement("c = a + 1", worksheet, parent=s1)
+    s2.compile()
+    s2.execute()
+    s1 = Statement("a = 1; b = 3", worksheet)
+    s1.compile()
+    s1.execute()
+    s2.set_parent(s1)
+    s2.rebase()
+    assert_equals(s2.result_scope['b'], 3)
+    assert_equals(s2.result_scope['c'], 2)
+
+    # Statements record the time spent compiling and executing
+    s1 = Statement("l = [1]", worksheet)
+    s1.compile()
+    s1.execute()
+    s2 = Statement("l.append(2)", worksheet, parent=s1)
+    s2.compile()
+    s2.execute()
+    assert s2.metrics.compile_time is not None
+    assert s2.metrics.execute_time >= s2.metrics.copy_time > 0
+    # And which strategy was used to copy the objects it modifies
+    assert_equals(s2.metrics.copies, [('l', 'copy')])
+
+    # Profiling a statement adds a ProfileResult, for that execution only
+    s1 = Statement("x = sorted([3, 1, 2])", worksheet)
+    s1.compile()
+    s1.profile = profile_result.DETERMINISTIC
+    s1.execute()
+    assert_equals(len(s1.results), 1)
+    assert isinstance(s1.results[0], profile_result.ProfileResult)
+    assert_equals(s1.result_scope['x'], [1, 2, 3])
+    s1.execute()
+    assert_equals(s1.results, [])
+
+    # Tests of the result cache
+    from result_cache import ResultCache
+
+    cache_dir = tempfile.mkdtemp("", "reinteract_statement")
+    try:
+        nb.result_cache = ResultCache(cache_dir)
+        calls = []
+        def count():
+            calls.append(1)
+        worksheet.global_scope['count'] = count
+
+        def execute_cached(parent_text):
+            s1 = Statement(parent_text, worksheet)
+            s1.compile()
+            s1.execute()
+            s2 = Statement("count(); b = a + 1; b", worksheet, parent=s1)
+            s2.compile()
+            s2.execute()
+            return s2
+
+        s2 = execute_cached("a = 1")
+        assert_equals(s2.results, ['2'])
+        s2 = execute_cached("a = 1")
+        assert_equals(s2.results, ['2'])
+        assert_equals(s2.result_scope['b'], 2)
+        assert_equals(len(calls), 1)
+
+        # A different input value means a different key
+        s2 = execute_cached("a = 2")
+        assert_equals(s2.results, ['3'])
+        assert_equals(len(calls), 2)
+
+        # Output past the limit is still there when the results are restored
+        # from the cache after the statement that produced them is gone
+        worksheet.max_output_lines = 1
+        def execute_output():
+            s = Statement("count()\nfor i in xrange(0, 3): print i", worksheet)
+            s.compile()
+            s.execute()
+            return s
+        s = execute_output()
+        del s
+        s = execute_output()
+        assert_equals(len(calls), 3)
+        assert_equals(s.results[1].read_page(0), ['1', '2'])
+        worksheet.max_output_lines = 1000
+    finally:
+        nb.result_cache = None
+        shutil.rmtree(cache_dir)
@@ -26,6 +26,9 @@ class _StdoutStack(threading.local):
     def write(self, str):
         self.current.write(str)
 
+    def flush(self):
+        self.current.flush()
+
     def push(self, value):
         self.stack.append(self.current)
         self.current = value
@@ -85,6 +88,10 @@ class StdoutCapture:
     def write(self, str):
         self.__write_function(str)
 
+    def flush(self):
+        # Captured output is passed on as it is written
+        pass
+
 if __name__ == "__main__":
     init()
     
@@ -109,3 +116,11 @@ if __name__ == "__main__":
 
     assert s == "Foo\n"
 
+    # Code that flushes sys.stdout works with or without a capture
+    sys.stdout.flush()
+    c.push()
+    try:
+        sys.stdout.flush()
+    finally:
+        c.pop()
+
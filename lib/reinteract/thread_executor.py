@@ -7,11 +7,15 @@
 #
 ########################################################################
 
+import collections
 import ctypes
 import gobject
 import signal
 import sys
 import thread
+import threading
+import time
+import traceback
 
 from statement import Statement
 
@@ -22,6 +26,8 @@ from statement import Statement
 # through pthreads.
 #
 _PyThreadState_SetAsyncExc = ctypes.pythonapi.PyThreadState_SetAsyncExc
+# Thread IDs don't fit in a C int on 64-bit platforms
+_PyThreadState_SetAsyncExc.argtypes = [ctypes.c_long, ctypes.py_object]
 
 #
 # _PyThreadState_SetAsyncExc won't immediately wake up a thread that is blocking
@@ -51,6 +57,7 @@ else:
         _pthreads_dll = ctypes.CDLL("libpthread.so.0")
     
     _pthread_kill = _pthreads_dll.pthread_kill
+    _pthread_kill.argtypes = [ctypes.c_ulong, ctypes.c_int]
 
 if _pthread_kill is not None:
     def _ignore_handler(signum, frame):
@@ -58,9 +65,137 @@ if _pthread_kill is not None:
 
     signal.signal(signal.SIGUSR1, _ignore_handler)
 
+# How often the watchdog checks whether the execution has run too long, in milliseconds
+_WATCHDOG_INTERVAL = 100
+
+# How long the watchdog waits after interrupting a statement that has run too long
+# before signalling the thread again, in seconds
+_ESCALATE_TIMEOUT = 1.0
+
+def _clear_interrupt():
+    # Discards an exception set with _PyThreadState_SetAsyncExc on the current
+    # thread that hasn't been raised yet (passing NULL clears it)
+    _PyThreadState_SetAsyncExc(thread.get_ident(), ctypes.py_object())
+
+class WorkerPool(object):
+    """Long-lived threads that run the jobs of ThreadExecutors
+
+    Starting a thread for each execution adds latency to every calculation, so
+    a worksheet keeps a pool of threads and reuses them. Jobs are queued and run
+    in order; a job is run by an idle thread if there is one, otherwise a new
+    thread is started for it, so a job never waits for a job that is stuck
+    (for example, in native code that can't be interrupted). Threads beyond
+    max_idle exit when they run out of jobs.
+
+    """
+
+    def __init__(self, max_idle=1):
+        """Initialize the WorkerPool object
+
+        @param max_idle: number of threads to keep waiting for jobs
+
+        """
+
+        self.max_idle = max_idle
+
+        self.__condition = threading.Condition()
+        self.__jobs = collections.deque()
+        self.__threads = 0
+        self.__idle = 0
+        self.__closed = False
+
+    @property
+    def thread_count(self):
+        """The number of threads currently in the pool"""
+        return self.__threads
+
+    def submit(self, func):
+        """Queue a job to be run in one of the threads of the pool
+
+        @param func: function to call with no arguments
+
+        """
+
+        self.__condition.acquire()
+        try:
+            if self.__closed:
+                raise ValueError("WorkerPool is closed")
+
+            self.__jobs.append(func)
+            # Threads that were already notified stay counted as idle until
+            # they wake up, so this doesn't hand two jobs to one thread
+            if self.__idle >= len(self.__jobs):
+                self.__condition.notify()
+            else:
+                self.__threads += 1
+                thread.start_new_thread(self.__run, ())
+        finally:
+            self.__condition.release()
+
+    def close(self):
+        """Let the threads exit once they finish the jobs already queued"""
+
+        self.__condition.acquire()
+        self.__closed = True
+        self.__condition.notifyAll()
+        self.__condition.release()
+
+    def __run(self):
+        self.__condition.acquire()
+        try:
+            while True:
+                while not self.__jobs and not self.__closed and self.__idle < self.max_idle:
+                    self.__idle += 1
+                    self.__condition.wait()
+                    self.__idle -= 1
+
+                if not self.__jobs:
+                    break
+
+                job = self.__jobs.popleft()
+                self.__condition.release()
+                try:
+                    try:
+                        job()
+                        # An interrupt sent just as the job finished must not
+                        # be raised in the next job
+                        _clear_interrupt()
+                    except KeyboardInterrupt:
+                        pass
+                    except Exception:
+                        traceback.print_exc()
+                finally:
+                    self.__condition.acquire()
+        finally:
+            self.__threads -= 1
+            self.__condition.release()
+
+def _depends_on(statement, earlier):
+    # True if statement might read something that earlier binds. If we don't know
+    # what the statements read and write, we have to assume the worst.
+    if statement.reads is None or earlier.writes is None:
+        return True
+
+    return not earlier.writes.isdisjoint(statement.reads)
+
 class ThreadExecutor(gobject.GObject):
     """Class to execute Python statements asynchronously in a thread
 
+    If max_workers is greater than one, statements that don't depend on each
+    other are executed at the same time in a pool of threads. A statement is
+    started as soon as none of the statements before it that haven't finished
+    bind a name that it reads; it is executed on top of the scope of the
+    last statement of the finished prefix, and its result scope is then rebased
+    onto the scope of the preceding statement once that statement finishes.
+    Statements still complete in order, so the signals are the same as for
+    sequential execution.
+
+    If statement_timeout or timeout is set, a watchdog in the main loop interrupts
+    the execution when a statement or the whole execution takes longer, and the
+    interrupted statements get a message saying that they timed out. If the thread
+    is still running a second later, it is signalled again to break it out of a
+    blocking system call.
+
     Signals
     =======
      -  B{statement-executing}(executor, statement) emitted when the executor starts processing a statement. There is no guarantee that this signal will be emitted for each processed statement.
@@ -75,10 +210,12 @@ class ThreadExecutor(gobject.GObject):
         'complete' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
     }
 
-    def __init__(self, parent_statement=None):
+    def __init__(self, parent_statement=None, max_workers=1, pool=None):
         """Initialize the ThreadExecutor object
 
         @param parent_statement: prievous statement defining the execution environment for the first statement
+        @param max_workers: maximum number of statements to execute at once
+        @param pool: L{WorkerPool} to run the execution in. If None, new threads are started.
 
         """
         gobject.GObject.__init__(self)
@@ -86,6 +223,10 @@ class ThreadExecutor(gobject.GObject):
         self.parent_statement = parent_statement
         self.statements = []
         self.lock = thread.allocate_lock()
+        self.max_workers = max_workers
+        self.pool = pool
+        # Thread executing the statements when executing sequentially; set once it starts
+        self.tid = None
 
         self.idle_id = 0
         self.last_complete = -1
@@ -93,6 +234,22 @@ class ThreadExecutor(gobject.GObject):
         self.complete = False
         self.interrupted = False
 
+        #: maximum time in seconds that a statement may execute before it is
+        #: interrupted, or None. Must be set before calling execute()
+        self.statement_timeout = None
+        #: maximum time in seconds that executing all the statements may take
+        #: before the execution is interrupted, or None. Must be set before calling execute()
+        self.timeout = None
+        #: time (as returned by time.time()) from which the timeout is measured.
+        #: If None, execute() sets it to the current time
+        self.start_time = None
+
+        # tid => (statement, time it started) for the statements executing now
+        self.__execution_starts = {}
+        self.__watchdog_id = 0
+        # Time at which the watchdog interrupted the execution
+        self.__timed_out_at = None
+
     def __run_idle(self):
         self.lock.acquire()
         complete = self.complete
@@ -133,11 +290,35 @@ class ThreadExecutor(gobject.GObject):
         # held. Given those assumptions, we can be sure that the finishing steps
         # will be run and they won't be interrupted.
         #
+        # Python only raises an asynchronous exception every so many bytecodes,
+        # so an interrupt sent just as a statement finishes can still be pending
+        # when we get the lock back; we discard it then to keep b) true, and
+        # check self.interrupted instead.
+        #
         statement = None
         try:
+            # With a pool, the executor can be interrupted before the job starts
+            self.lock.acquire()
+            self.tid = thread.get_ident()
+            interrupted = self.interrupted
+            self.lock.release()
+
             for i, statement in enumerate(self.statements):
+                if interrupted:
+                    break
+
                 self.lock.acquire()
+                # If the statement doesn't depend on anything that changed, we
+                # just need to update its scope for the new parent scope (if the
+                # scope was released and can't be restored, we execute it again)
+                if statement.state == Statement.EXECUTE_SUCCESS and statement.rebase():
+                    self.last_complete = i
+                    self.__queue_idle()
+                    self.lock.release()
+                    continue
+
                 statement.before_execute()
+                self.__execution_starts[self.tid] = (statement, time.time())
                 self.__queue_idle()
                 try:
                     self.lock.release()
@@ -146,13 +327,16 @@ class ThreadExecutor(gobject.GObject):
                 except:
                     self.lock.acquire()
                 finally:
+                    _clear_interrupt()
+                    del self.__execution_starts[self.tid]
                     statement.after_execute()
                     result_state = statement.state
+                    interrupted = self.interrupted
                     self.last_complete = i;
                     self.__queue_idle()
                     self.lock.release()
 
-                    if result_state != Statement.EXECUTE_SUCCESS:
+                    if result_state != Statement.EXECUTE_SUCCESS or interrupted:
                         break
 
             self.lock.acquire()
@@ -167,6 +351,118 @@ class ThreadExecutor(gobject.GObject):
             self.__queue_idle()
             self.lock.release()
 
+    def __get_parent(self, i):
+        if i > 0:
+            return self.statements[i - 1]
+        else:
+            return self.parent_statement
+
+    def __find_runnable(self):
+        # Must be called with the lock held. Returns the index of the first statement
+        # that can be started now, or None
+        if self.__stopping:
+            return None
+
+        first_unfinished = self.last_complete + 1
+        for i in xrange(first_unfinished, len(self.statements)):
+            if self.__started[i]:
+                continue
+
+            statement = self.statements[i]
+            for k in xrange(first_unfinished, i):
+                if _depends_on(statement, self.statements[k]):
+                    break
+            else:
+                return i
+
+        return None
+
+    def __advance(self):
+        # Must be called with the lock held. Rebases finished statements onto the
+        # previous statement's scope in order and updates last_complete
+        while not self.__failed and self.last_complete + 1 < len(self.statements):
+            i = self.last_complete + 1
+            if not self.__finished[i]:
+                break
+
+            statement = self.statements[i]
+            statement.set_parent(self.__get_parent(i))
+            if statement.state != Statement.EXECUTE_SUCCESS:
+                self.__failed = True
+                self.__stopping = True
+            elif not statement.rebase():
+                # The released scope couldn't be restored; it will be
+                # executed again on the next calculation
+                statement.mark_for_execute()
+                self.__failed = True
+                self.__stopping = True
+            self.last_complete = i
+
+    def __run_worker(self):
+        # See the comment in __run_thread() for the locking and exception handling
+        # pattern; each statement started here is executed in the same way.
+        tid = thread.get_ident()
+
+        self.lock.acquire()
+        try:
+            while True:
+                i = self.__find_runnable()
+                if i is None:
+                    if self.__stopping or all(self.__started):
+                        break
+                    self.__condition.wait()
+                    continue
+
+                statement = self.statements[i]
+                self.__started[i] = True
+
+                if statement.state != Statement.EXECUTE_SUCCESS:
+                    # Execute on top of the scope of the last statement we know
+                    # we don't depend on
+                    statement.set_parent(self.__get_parent(self.last_complete + 1))
+                    # Other statements may be executing on top of the same scope
+                    statement.shares_parent_scope = True
+                    statement.before_execute()
+                    self.__executed[i] = True
+                    self.__running[tid] = statement
+                    self.__execution_starts[tid] = (statement, time.time())
+                    self.__queue_idle()
+                    try:
+                        self.lock.release()
+                        statement.execute()
+                        self.lock.acquire()
+                    except:
+                        self.lock.acquire()
+                    finally:
+                        _clear_interrupt()
+                        del self.__running[tid]
+                        del self.__execution_starts[tid]
+                        statement.after_execute()
+                        statement.shares_parent_scope = False
+
+                self.__finished[i] = True
+                self.__advance()
+                self.__condition.notifyAll()
+                self.__queue_idle()
+        finally:
+            self.__workers -= 1
+            if self.__workers == 0:
+                # Statements after a failure that we already executed need to
+                # be executed again; their results were computed on top of the
+                # wrong scope, so we discard them.
+                for i in xrange(self.last_complete + 1, len(self.statements)):
+                    statement = self.statements[i]
+                    statement.set_parent(self.__get_parent(i))
+                    if self.__executed[i]:
+                        statement.mark_for_execute()
+                        statement.results = None
+                        statement.result_scope = None
+
+                self.complete = True
+                self.last_complete = len(self.statements) - 1
+                self.__queue_idle()
+            self.lock.release()
+
     def add_statement(self, statement):
         """Add a statement to the list of statements that the executor will execute."""
 
@@ -198,9 +494,85 @@ class ThreadExecutor(gobject.GObject):
 
         return success
 
+    def __start(self, func):
+        if self.pool is not None:
+            self.pool.submit(func)
+        else:
+            thread.start_new_thread(func, ())
+
+    def __check_timeouts(self):
+        now = time.time()
+
+        self.lock.acquire()
+        try:
+            if self.complete:
+                self.__watchdog_id = 0
+                return False
+
+            if self.__timed_out_at is not None:
+                if now - self.__timed_out_at < _ESCALATE_TIMEOUT:
+                    return True
+
+                # The interrupt didn't stop the statements; they may be blocking
+                # in a system call that was restarted after the first signal
+                if _pthread_kill is not None:
+                    for tid in self.__execution_starts:
+                        _pthread_kill(tid, signal.SIGUSR1)
+
+                self.__watchdog_id = 0
+                return False
+
+            if self.interrupted:
+                # Already interrupted by the user
+                self.__watchdog_id = 0
+                return False
+
+            if self.timeout is not None and now - self.start_time >= self.timeout:
+                message = "Execution timed out after %g seconds" % self.timeout
+                timed_out = [statement for statement, _ in self.__execution_starts.itervalues()]
+            elif self.statement_timeout is not None:
+                message = "Timed out after %g seconds" % self.statement_timeout
+                timed_out = [statement for statement, start in self.__execution_starts.itervalues()
+                             if now - start >= self.statement_timeout]
+                if len(timed_out) == 0:
+                    return True
+            else:
+                return True
+
+            for statement in timed_out:
+                statement.interrupt_message = message
+            self.__interrupt()
+            self.__timed_out_at = now
+
+            return True
+        finally:
+            self.lock.release()
+
     def execute(self):
         """Execute the statements of the executor asynchronously in a thread."""
-        self.tid = thread.start_new_thread(self.__run_thread, ())
+        if self.start_time is None:
+            self.start_time = time.time()
+        if self.statement_timeout is not None or self.timeout is not None:
+            self.__watchdog_id = gobject.timeout_add(_WATCHDOG_INTERVAL, self.__check_timeouts)
+
+        if self.max_workers <= 1:
+            self.__start(self.__run_thread)
+            return
+
+        n = len(self.statements)
+        self.__started = [False] * n
+        self.__finished = [False] * n
+        self.__executed = [False] * n
+        self.__running = {}
+        self.__stopping = False
+        self.__failed = False
+        self.__condition = threading.Condition(self.lock)
+
+        self.lock.acquire()
+        self.__workers = min(self.max_workers, max(n, 1))
+        for i in xrange(0, self.__workers):
+            self.__start(self.__run_worker)
+        self.lock.release()
 
     def interrupt(self):
         """Interrupts the execution of the executor if possible.
@@ -223,12 +595,28 @@ class ThreadExecutor(gobject.GObject):
         # protect against sending the KeyboardInterrupt exception more than once
         self.lock.acquire()
         if not self.complete and not self.interrupted:
-            self.interrupted = True
-            _PyThreadState_SetAsyncExc(self.tid, ctypes.py_object(KeyboardInterrupt))
-            if _pthread_kill is not None:
-                _pthread_kill(self.tid, signal.SIGUSR1)
+            self.__interrupt()
         self.lock.release()
 
+    def __interrupt(self):
+        # Must be called with the lock held
+        self.interrupted = True
+        if self.max_workers <= 1:
+            # If the thread hasn't started yet, it will see self.interrupted
+            if self.tid is not None:
+                tids = [self.tid]
+            else:
+                tids = []
+        else:
+            self.__stopping = True
+            self.__condition.notifyAll()
+            tids = self.__running.keys()
+
+        for tid in tids:
+            _PyThreadState_SetAsyncExc(tid, ctypes.py_object(KeyboardInterrupt))
+            if _pthread_kill is not None:
+                _pthread_kill(tid, signal.SIGUSR1)
+
 ######################################################################
 
 if __name__ == '__main__': #pragma: no cover
@@ -249,8 +637,11 @@ if __name__ == '__main__': #pragma: no cover
     notebook = Notebook()
     worksheet = Worksheet(notebook)
 
-    def test_execute(statements):
-        executor = ThreadExecutor()
+    def test_execute(statements, max_workers=1, pool=None, interrupt_first=False,
+                     statement_timeout=None, timeout=None):
+        executor = ThreadExecutor(max_workers=max_workers, pool=pool)
+        executor.statement_timeout = statement_timeout
+        executor.timeout = timeout
 
         for s, expected_state, expected_results in statements:
             statement = Statement(s, worksheet)
@@ -288,6 +679,9 @@ if __name__ == '__main__': #pragma: no cover
         executor.connect('statement-complete', on_statement_complete)
         executor.connect('complete', on_complete)
 
+        if interrupt_first:
+            executor.interrupt()
+
         if executor.compile():
             executor.execute()
             interrupt_source = gobject.timeout_add(500, interrupt)
@@ -306,6 +700,8 @@ if __name__ == '__main__': #pragma: no cover
             if s._expected_state == Statement.INTERRUPTED and not s._got_executing:
                 raise AssertionError("ThreadExecutor did not send 'statement-executing' within timeout")
 
+        return executor.statements
+
     test_execute(
         [
             ("a = 1", Statement.COMPILE_SUCCESS, None),
@@ -325,6 +721,24 @@ if __name__ == '__main__': #pragma: no cover
             ("c = 2", Statement.COMPILE_SUCCESS, None)
         ])
 
+    # Test executing independent statements in parallel
+    test_execute(
+        [
+            ("import time", Statement.EXECUTE_SUCCESS, []),
+            ("time.sleep(0.1); a = 1", Statement.EXECUTE_SUCCESS, []),
+            ("time.sleep(0.1); b = 2", Statement.EXECUTE_SUCCESS, []),
+            ("print a + b", Statement.EXECUTE_SUCCESS, ['3']),
+            ("a = 10; b", Statement.EXECUTE_SUCCESS, ['2']),
+            ("a + b", Statement.EXECUTE_SUCCESS, ['12'])
+        ], max_workers=3)
+
+    test_execute(
+        [
+            ("a = 1", Statement.EXECUTE_SUCCESS, []),
+            ("b", Statement.EXECUTE_ERROR, None),
+            ("c = 2", Statement.COMPILE_SUCCESS, None)
+        ], max_workers=2)
+
     # Test interrupting straight python code
     test_execute(
         [
@@ -333,6 +747,70 @@ if __name__ == '__main__': #pragma: no cover
             ("z = 1", Statement.COMPILE_SUCCESS, None)
         ])
 
+    # Test timeouts; the watchdog interrupts before the test does
+    statements = test_execute(
+        [
+            ("y = 1", Statement.EXECUTE_SUCCESS, []),
+            ("for x in xrange(0,100000000): y = y* 2", Statement.INTERRUPTED, None),
+            ("z = 1", Statement.COMPILE_SUCCESS, None)
+        ], statement_timeout=0.2)
+    assert_equals(statements[1].error_message, "Timed out after 0.2 seconds")
+
+    statements = test_execute(
+        [
+            ("import time", Statement.EXECUTE_SUCCESS, []),
+            ("time.sleep(0.15)", Statement.EXECUTE_SUCCESS, []),
+            ("time.sleep(0.15)", Statement.EXECUTE_SUCCESS, []),
+            ("time.sleep(0.15)", Statement.INTERRUPTED, None),
+        ], statement_timeout=0.2, timeout=0.35)
+    assert_equals(statements[3].error_message, "Execution timed out after 0.35 seconds")
+
+    statements = test_execute(
+        [
+            ("import time", Statement.EXECUTE_SUCCESS, []),
+            ("time.sleep(0.1); a = 1", Statement.EXECUTE_SUCCESS, []),
+            ("for x in xrange(0,100000000): y = x", Statement.INTERRUPTED, None),
+        ], max_workers=2, statement_timeout=0.2)
+    assert_equals(statements[1].error_message, None)
+    assert_equals(statements[2].error_message, "Timed out after 0.2 seconds")
+
+    # Test reusing the threads of a WorkerPool
+    pool = WorkerPool()
+    for i in xrange(0, 3):
+        test_execute(
+            [
+                ("a = 1", Statement.EXECUTE_SUCCESS, []),
+                ("a", Statement.EXECUTE_SUCCESS, ['1'])
+            ], pool=pool)
+    assert_equals(pool.thread_count, 1)
+
+    test_execute(
+        [
+            ("y = 1", Statement.EXECUTE_SUCCESS, []),
+            ("for x in xrange(0,100000000): y = y* 2", Statement.INTERRUPTED, None),
+            ("z = 1", Statement.COMPILE_SUCCESS, None)
+        ], pool=pool)
+
+    # The interrupt doesn't leak into the next job
+    test_execute(
+        [
+            ("import time", Statement.EXECUTE_SUCCESS, []),
+            ("time.sleep(0.1); a = 1", Statement.EXECUTE_SUCCESS, []),
+            ("time.sleep(0.1); b = 2", Statement.EXECUTE_SUCCESS, []),
+            ("a + b", Statement.EXECUTE_SUCCESS, ['3'])
+        ], max_workers=2, pool=pool)
+
+    # Interrupting before the job starts means nothing is executed
+    test_execute(
+        [
+            ("a = 1", Statement.COMPILE_SUCCESS, None),
+            ("a", Statement.COMPILE_SUCCESS, None)
+        ], pool=pool, interrupt_first=True)
+
+    pool.close()
+    time.sleep(0.1)
+    assert_equals(pool.thread_count, 0)
+
     # Test interrupting a blocking syscall, if support on this platform
     if _pthread_kill is not None:
         test_execute(
@@ -8,6 +8,7 @@
 
 import inspect
 from retokenize import *
+from rewrite import NAME_ACCESS_FUNCTIONS
 
 # These are keywords where completion doesn't make sense afterwords, for
 # various reasons
@@ -188,6 +189,37 @@ class TokenizedStatement(object):
     def get_tokens(self, line):
         return self.tokens[line]
 
+    def get_names(self):
+        """Get the names that appear in the statement
+
+        This is useful as a (generous) estimate of the variables that a statement
+        reads and binds when it can't be compiled.
+
+        @returns: a set of names, or None if the statement might access variables
+          with names that don't appear in it. (Because it uses exec, 'from module import *',
+          or calls a function like globals())
+
+        """
+
+        names = set()
+        in_import = False
+        for line, tokens in zip(self.lines, self.tokens):
+            for token_type, start, end, _ in tokens:
+                text = line[start:end]
+                if token_type == TOKEN_NAME:
+                    if text in NAME_ACCESS_FUNCTIONS:
+                        return None
+                    names.add(text)
+                elif token_type == TOKEN_KEYWORD:
+                    if text == 'exec':
+                        return None
+                    elif text == 'import':
+                        in_import = True
+                elif in_import and text == '*':
+                    return None
+
+        return names
+
     def _get_iter(self, line, index):
         # Get an iterator pointing to the token containing the specified
         # position. Return None if there no such token
@@ -749,6 +781,25 @@ if __name__ == '__main__':
             print "For %s, got next_line_indent=%d, expected %d" % (text, next_line_indent, expected)
             failed = True
 
+    ### Tests of get_names()
+
+    def test_names(lines, expected):
+        ts = TokenizedStatement()
+        ts.set_lines(lines)
+        names = ts.get_names()
+        if expected is not None:
+            expected = set(expected)
+        if names != expected:
+            print "For %s, got %s, expected %s" % (lines, names, expected)
+            failed = True
+
+    test_names(['a = b.c(1, "d")'], ['a', 'b', 'c'])
+    test_names(['for i in x:', '    print i'], ['i', 'x'])
+    test_names(['from os import path'], ['os', 'path'])
+    test_names(['from os import *'], None)
+    test_names(['exec "a = 1"'], None)
+    test_names(['locals()'], None)
+
     ### Tests of find_completions()
 
     class MyObject:
@@ -12,22 +12,35 @@ import gobject
 import logging
 import os
 import re
+import shutil
 from StringIO import StringIO
+import tempfile
+import time
 
 from change_range import ChangeRange
+import checkpoint
 from chunks import *
 from notebook import Notebook, NotebookFile
+import profile_result
 import reunicode
 from statement import Statement
-from thread_executor import ThreadExecutor
+from thread_executor import ThreadExecutor, WorkerPool
 from undo_stack import UndoStack, InsertOp, DeleteOp
 
 _debug = logging.getLogger("Worksheet").debug
 
+# Minimum time between passes updating chunks from the executor, in seconds
+_UPDATE_INTERVAL = 0.016
+
+# Interval for showing the output of statements as they execute, in milliseconds
+_LIVE_OUTPUT_INTERVAL = 100
+
 _DEFINE_GLOBALS = compile("""
-global reinteract_output
+global reinteract_output, reinteract_copy_mutated
 def reinteract_output(*args):
    __reinteract_statement.do_output(*args)
+def reinteract_copy_mutated(*indices):
+   __reinteract_statement.copy_mutated(*indices)
 """, __name__, 'exec')
 
 BLANK_RE = re.compile(r'^\s*$')
@@ -97,6 +110,41 @@ class Worksheet(gobject.GObject):
 
         self.notebook = notebook
         self.edit_only = edit_only
+        #: class used to execute statements: ThreadExecutor or ProcessExecutor
+        self.executor_class = ThreadExecutor
+        #: maximum number of independent statements to execute at once
+        self.max_workers = 1
+        #: if True, objects that statements might modify are copied when the
+        #: statement gets to the code that modifies them rather than beforehand.
+        #: Only names bound to the object are pointed to the copy, so if the
+        #: statement stores the object in a container before modifying it, the
+        #: container keeps the unmodified original.
+        self.lazy_copy = False
+        #: if True, an object that a statement modifies isn't copied if only the
+        #: previous statement's scope refers to it; the object is modified in place
+        #: and the previous statement is reexecuted if its scope is needed again
+        self.elide_copies = False
+        #: saved results of executing the worksheet, if enabled for the notebook. See L{Checkpoint}
+        self.checkpoint = None
+        #: if not None, the worksheet is calculated automatically when the user
+        #: has stopped editing for this many milliseconds
+        self.live_delay = None
+        #: if not None, the result scopes of all but this many of the last
+        #: statements are released after execution to save memory
+        self.max_retained_scopes = None
+        #: if not None, the result scopes of the last statements are only kept
+        #: up to this many bytes (estimated); the rest are released
+        self.max_retained_bytes = None
+        #: if True, released scopes are saved to disk, so they can be restored
+        #: without reexecuting statements
+        self.spill_scopes = True
+        #: if not None, lines that a statement outputs past this many are written
+        #: to a file and shown on request rather than kept in the results. See L{OutputResult}
+        self.max_output_lines = 1000
+        #: if not None, a statement executing for longer than this many seconds is interrupted
+        self.statement_timeout = None
+        #: if not None, a calculation taking longer than this many seconds is interrupted
+        self.execution_timeout = None
         self.__file = None
         self.__filename = None
         self.__code_modified = False
@@ -124,6 +172,24 @@ class Worksheet(gobject.GObject):
 
         self.__undo_stack = UndoStack(self)
 
+        self.__executor = None
+        self.__executor_statements = None
+        # Executor interrupted by an edit that hasn't stopped yet
+        self.__cancelled_executor = None
+        # If calculate() was called while waiting for it to stop, (end_line,)
+        self.__deferred_calculate = None
+        # Threads kept around between calculations, so each doesn't start a new one
+        self.__pool = WorkerPool()
+        # Statements that the executor has reported on that we haven't updated the chunks for
+        self.__pending_updates = []
+        self.__update_source = 0
+        self.__last_update = 0
+        self.__live_output_source = 0
+        self.__live_timeout = 0
+        self.__live_pending = False
+        self.__spill = None
+        self.__spill_count = 0
+
         notebook._add_worksheet(self)
 
     def do_import(self, name, globals, locals, fromlist, level):
@@ -182,28 +248,54 @@ class Worksheet(gobject.GObject):
     def __chunk_changed(self, chunk):
         self.__changed_chunks.add(chunk)
 
-    def __mark_rest_for_execute(self, start_line):
+    def __mark_dependents_for_execute(self, start_line, names):
         if self.state != NotebookFile.NEEDS_EXECUTE:
             self.__set_state(NotebookFile.NEEDS_EXECUTE)
 
-        # Mark all statements starting from start_line as needing execution.
-        # We do this immediately when we change or delete a previous
-        # StatementChunk. The alternative would be to do it when we
-        # __thaw_changes(), which would conceivably be more efficient, but
-        # it's hard to see how to handle deleted chunks in that case.
+        # Mark the statements starting from start_line that depend on any of
+        # the given names (None means any name) as needing execution. Since
+        # a statement that is reexecuted may itself bind different values, the
+        # names it binds are added to the set as we go. We do this immediately
+        # when we change or delete a previous StatementChunk. The alternative
+        # would be to do it when we __thaw_changes(), which would conceivably
+        # be more efficient, but it's hard to see how to handle deleted chunks
+        # in that case.
+        #
+        # A variable passed to a function is assumed to be mutated by it, but
+        # a mutation of a variable that a function reaches in some other way
+        # (for example, through the globals of the function) can't be seen.
+        if names is not None:
+            names = set(names)
+
         for chunk in self.iterate_chunks(start_line):
-            if isinstance(chunk, StatementChunk):
+            if not isinstance(chunk, StatementChunk):
+                continue
+
+            if not (chunk.needs_compile or chunk.needs_execute):
+                if names is not None:
+                    reads = chunk.get_reads()
+                    if reads is not None and names.isdisjoint(reads):
+                        continue
+
                 if chunk.mark_for_execute():
                     self.__chunk_changed(chunk)
+
+            if names is not None:
+                writes = chunk.get_writes()
+                if writes is None:
+                    names = None
                 else:
-                    # Everything after the first chunk that was previously
-                    # marked for execution must also have been marked for
-                    # execution, so we can stop
-                    break
+                    names.update(writes)
 
-    def __mark_changed_statement(self, chunk):
+    def __mark_changed_statement(self, chunk, old_writes):
         self.__chunk_changed(chunk)
-        self.__mark_rest_for_execute(chunk.end)
+
+        new_writes = chunk.get_writes()
+        if old_writes is None or new_writes is None:
+            names = None
+        else:
+            names = old_writes | new_writes
+        self.__mark_dependents_for_execute(chunk.end, names)
 
     def __remove_chunk(self, chunk):
         try:
@@ -212,8 +304,11 @@ class Worksheet(gobject.GObject):
             pass
         if not chunk.newly_inserted:
             self.__deleted_chunks.add(chunk)
+        # The statements after a deleted statement were executed on top of
+        # its scope, so they are all reexecuted, as they would be if it had
+        # never been there; only edits are limited to the dependent statements
         if isinstance(chunk, StatementChunk):
-            self.__mark_rest_for_execute(chunk.end)
+            self.__mark_dependents_for_execute(chunk.end, None)
 
     def __adjust_or_create_chunk(self, start, end, line_class):
         if line_class == BLANK:
@@ -257,10 +352,11 @@ class Worksheet(gobject.GObject):
         if statement_end > chunk_start:
             chunk_lines = lines[0:statement_end - chunk_start]
             chunk = self.__adjust_or_create_chunk(chunk_start, statement_end, STATEMENT_START)
+            old_writes = chunk.get_writes()
             chunk.set_lines(chunk_lines)
 
             if not chunk.changes.empty():
-                self.__mark_changed_statement(chunk)
+                self.__mark_changed_statement(chunk, old_writes)
 
         start = statement_end
         prev_class = CONTINUATION # Doesn't matter, not blank/continuation
@@ -401,11 +497,10 @@ class Worksheet(gobject.GObject):
         if len(text) == 0:
             return
 
-        if self.state == NotebookFile.EXECUTING:
-            return
-
         self.__freeze_changes()
 
+        self.__cancel_invalidated_execution(line)
+
         self.emit('text-inserted', line, offset, text)
 
         count = 0
@@ -469,8 +564,10 @@ class Worksheet(gobject.GObject):
         self.__thaw_changes()
         self.__undo_stack.append_op(InsertOp((line, offset), (end_line, end_offset), text))
 
-        if self.__user_action_count > 0 and not self.code_modified:
-            self.code_modified = True
+        if self.__user_action_count > 0:
+            if not self.code_modified:
+                self.code_modified = True
+            self.__queue_live_calculate()
 
     def __delete_lines(self, start_line, end_line):
         # Delete an integral number of lines, fixing up the affected chunks
@@ -505,9 +602,6 @@ class Worksheet(gobject.GObject):
     def delete_range(self, start_line, start_offset, end_line, end_offset):
         _debug("Deleting from %s,%s to %s,%s", start_line, start_offset, end_line, end_offset)
 
-        if self.state == NotebookFile.EXECUTING:
-            return
-
         if start_line == end_line and start_offset == end_offset:
             return
 
@@ -515,6 +609,8 @@ class Worksheet(gobject.GObject):
 
         start_line, start_offset, end_line, end_offset = order_positions(start_line, start_offset, end_line, end_offset)
 
+        self.__cancel_invalidated_execution(start_line)
+
         deleted_text = self.get_text(start_line, start_offset, end_line, end_offset)
 
         self.emit('text-deleted', start_line, start_offset, end_line, end_offset)
@@ -539,8 +635,10 @@ class Worksheet(gobject.GObject):
         self.__thaw_changes()
         self.__undo_stack.append_op(DeleteOp((start_line, start_offset), (end_line, end_offset), deleted_text))
 
-        if self.__user_action_count > 0 and not self.code_modified:
-            self.code_modified = True
+        if self.__user_action_count > 0:
+            if not self.code_modified:
+                self.code_modified = True
+            self.__queue_live_calculate()
 
     def place_cursor(self, line, offset):
         _debug("Place cursor at %s,%s", line, offset)
@@ -567,9 +665,31 @@ class Worksheet(gobject.GObject):
 
             for module, _ in imports:
                 if module == module_name:
-                    self.__mark_rest_for_execute(chunk.start)
+                    if chunk.mark_for_execute():
+                        self.__chunk_changed(chunk)
+                    self.__mark_dependents_for_execute(chunk.end, chunk.get_writes())
 
     def calculate(self, wait=False, end_line=None):
+        # An execution cancelled by an edit might still be running on the worker
+        # threads and changing modules; starting another one at the same time
+        # could interfere with it, so we wait until it has stopped
+        if self.__cancelled_executor is not None:
+            # A single calculation covers this and any that was deferred before
+            if self.__deferred_calculate is not None:
+                deferred_end_line = self.__deferred_calculate[0]
+                if deferred_end_line is None or end_line is None:
+                    end_line = None
+                else:
+                    end_line = max(end_line, deferred_end_line)
+                self.__deferred_calculate = None
+
+            if wait:
+                self.__wait_for_cancelled_execution()
+            else:
+                _debug("Deferring calculation until the cancelled execution stops")
+                self.__deferred_calculate = (end_line,)
+                return
+
         _debug("Calculating")
 
         self.__freeze_changes()
@@ -578,18 +698,57 @@ class Worksheet(gobject.GObject):
         have_error = False
 
         executor = None
+        executor_statements = []
+        checkpoint_key = None
+        # (chunk, checkpoint_key) for the statements before the first one we execute
+        previous = []
 
         for chunk in self.iterate_chunks(end_line=end_line):
             if isinstance(chunk, StatementChunk):
                 changed = False
 
+                if self.checkpoint is not None:
+                    checkpoint_key = checkpoint.make_key(checkpoint_key, chunk.tokenized.get_text())
+
                 if chunk.needs_compile or chunk.needs_execute:
                     if not executor:
-                        executor = ThreadExecutor(parent)
+                        # The parent scope might have been released to save memory, or
+                        # consumed by a later statement. If it can't be restored from
+                        # disk, we have to start from the last statement that has a
+                        # usable scope, reexecuting the statements after it.
+                        first = len(previous)
+                        while first > 0 and (previous[first - 1][0].statement.scope_consumed or
+                                             not previous[first - 1][0].statement.rebuild_scope()):
+                            first -= 1
+                        if first > 0:
+                            parent = previous[first - 1][0].statement
+                        else:
+                            parent = None
+
+                        for previous_chunk, _ in previous[first:]:
+                            if not previous_chunk.statement.can_rebase:
+                                self.__mark_released_for_execute(previous_chunk)
+
+                        self.__pool.max_idle = max(self.max_workers, 1)
+                        executor = self.executor_class(parent, max_workers=self.max_workers,
+                                                       pool=self.__pool)
+                        executor.statement_timeout = self.statement_timeout
+                        executor.timeout = self.execution_timeout
+                        for previous_chunk, previous_key in previous[first:]:
+                            statement = previous_chunk.statement
+                            statement.checkpoint_key = previous_key
+                            executor.add_statement(statement)
+                            executor_statements.append(statement)
+                elif executor and not chunk.statement.can_rebase:
+                    self.__mark_released_for_execute(chunk)
 
                 if executor:
                     statement = chunk.get_statement(self)
+                    statement.checkpoint_key = checkpoint_key
                     executor.add_statement(statement)
+                    executor_statements.append(statement)
+                else:
+                    previous.append((chunk, checkpoint_key))
 
                 parent = chunk.statement
         
@@ -602,37 +761,54 @@ class Worksheet(gobject.GObject):
                 loop = gobject.MainLoop()
 
             def on_statement_execution_state_changed(executor, statement):
+                # Ignore an execution that was cancelled by an edit
+                if executor is not self.__executor:
+                    return
+
                 if (statement.state == Statement.COMPILE_ERROR or
                     statement.state == Statement.EXECUTE_ERROR or
                     statement.state == Statement.INTERRUPTED):
                     self.__executor_error = True
 
-                statement.chunk.update_statement()
-
-                if self.__freeze_changes_count == 0:
-                    self.__freeze_changes()
-                    self.__chunk_changed(statement.chunk)
-                    self.__thaw_changes()
-                else:
-                    self.__chunk_changed(statement.chunk)
+                self.__queue_update(statement)
 
             def on_complete(executor):
+                if wait:
+                    loop.quit()
+
+                if executor is not self.__executor:
+                    if executor is self.__cancelled_executor:
+                        self.__cancelled_execution_complete()
+                    return
+
+                self.__flush_updates()
+                self.__stop_live_output()
                 self.__executor = None
+                self.__executor_statements = None
+                if self.__executor_error:
+                    self.__mark_stale_for_execute(executor_statements)
+                self.__release_scopes()
                 if self.__executor_error:
                     self.__set_state(NotebookFile.ERROR)
                 elif more_statements:
                     self.__set_state(NotebookFile.NEEDS_EXECUTE)
                 else:
                     self.__set_state(NotebookFile.EXECUTE_SUCCESS)
-                if wait:
-                    loop.quit()
+
+                # Edits made after the statements being executed don't cancel
+                # the execution, so they still need to be calculated
+                if self.__live_pending:
+                    self.__live_pending = False
+                    self.calculate()
 
             self.__executor = executor
+            self.__executor_statements = executor_statements
             self.__executor_error = False
             self.__set_state(NotebookFile.EXECUTING)
             executor.connect('statement-executing', on_statement_execution_state_changed)
             executor.connect('statement-complete', on_statement_execution_state_changed)
             executor.connect('complete', on_complete)
+            self.__live_output_source = gobject.timeout_add(_LIVE_OUTPUT_INTERVAL, self.__on_live_output_timeout)
 
             if executor.compile():
                 executor.execute()
@@ -646,10 +822,288 @@ class Worksheet(gobject.GObject):
 
         self.__thaw_changes()
 
+    def profile_statement(self, line, mode=profile_result.DETERMINISTIC, wait=False):
+        """Execute the statement at the given line under a profiler
+
+        Statements before it are calculated first if necessary, and a ProfileResult
+        is added to the results of the statement. Statements after it that depend
+        on it will need to be reexecuted.
+
+        @param line: a line within the statement
+        @param mode: profile_result.DETERMINISTIC or profile_result.SAMPLING
+        @param wait: if True, don't return until the execution is complete
+        @returns: False if there is no statement at the line, or the worksheet is already executing
+
+        """
+
+        chunk = self.__chunks[line]
+        if not isinstance(chunk, StatementChunk) or self.state == NotebookFile.EXECUTING:
+            return False
+
+        self.__freeze_changes()
+        if chunk.mark_for_execute():
+            self.__chunk_changed(chunk)
+        self.__mark_dependents_for_execute(chunk.end, chunk.get_writes())
+        chunk.get_statement(self).profile = mode
+        self.__thaw_changes()
+
+        self.calculate(wait=wait, end_line=chunk.end)
+
+        return True
+
     def interrupt(self):
         if self.state == NotebookFile.EXECUTING:
             self.__executor.interrupt()
 
+    def get_statement_metrics(self):
+        """Return the resources used by the statements in the worksheet, most expensive first
+
+        @returns: a list of (chunk, metrics) tuples for the statements that have
+           been compiled, sorted by decreasing cost. See L{StatementMetrics}
+
+        """
+
+        result = [(chunk, chunk.metrics) for chunk in self.iterate_chunks()
+                  if isinstance(chunk, StatementChunk) and chunk.metrics is not None]
+        result.sort(key=lambda (chunk, metrics): metrics.cost, reverse=True)
+
+        return result
+
+    def __queue_update(self, statement):
+        # When many statements execute quickly, updating the chunks for each
+        # one as the executor reports it takes longer than executing them, so
+        # we update the chunks in batches, at most every _UPDATE_INTERVAL
+        self.__pending_updates.append(statement)
+        if self.__update_source == 0:
+            delay = self.__last_update + _UPDATE_INTERVAL - time.time()
+            if delay > 0:
+                self.__update_source = gobject.timeout_add(int(delay * 1000) + 1, self.__on_update_timeout)
+            else:
+                self.__update_source = gobject.idle_add(self.__on_update_timeout)
+
+    def __on_update_timeout(self):
+        self.__update_source = 0
+        self.__flush_updates()
+
+        return False
+
+    def __flush_updates(self):
+        if self.__update_source != 0:
+            gobject.source_remove(self.__update_source)
+            self.__update_source = 0
+
+        statements = self.__pending_updates
+        self.__pending_updates = []
+        self.__last_update = time.time()
+
+        if not statements:
+            return
+
+        self.__freeze_changes()
+        # A statement is reported both when it starts and when it completes
+        updated = set()
+        for statement in statements:
+            if statement in updated:
+                continue
+            updated.add(statement)
+            statement.chunk.update_statement()
+            self.__chunk_changed(statement.chunk)
+        self.__thaw_changes()
+
+    def __on_live_output_timeout(self):
+        # Show what the statements being executed have output so far
+        self.__freeze_changes()
+        for statement in self.__executor_statements:
+            chunk = statement.chunk
+            if chunk.statement is statement and statement.state == Statement.EXECUTING:
+                if chunk.set_live_output(statement.get_live_output()):
+                    self.__chunk_changed(chunk)
+        self.__thaw_changes()
+
+        return True
+
+    def __stop_live_output(self):
+        if self.__live_output_source != 0:
+            gobject.source_remove(self.__live_output_source)
+            self.__live_output_source = 0
+
+    def __cancel_invalidated_execution(self, line):
+        # Called before an edit starting at line. If the edit could change any of
+        # the statements being executed, we interrupt the execution and forget
+        # about it; results that were already reported are kept, but the
+        # statements that hadn't finished are discarded, since the executor
+        # may still be using them.
+
+        if self.state != NotebookFile.EXECUTING:
+            return
+
+        # An edit on the line after the last statement can extend it
+        if line > self.__executor_statements[-1].chunk.end:
+            return
+
+        _debug("Cancelling execution")
+
+        # Keep the results of statements that completed before the edit
+        self.__flush_updates()
+        self.__stop_live_output()
+
+        executor = self.__executor
+        statements = self.__executor_statements
+        self.__executor = None
+        self.__executor_statements = None
+
+        executor.interrupt()
+        self.__cancelled_executor = executor
+
+        for statement in statements:
+            chunk = statement.chunk
+            if chunk.statement is not statement:
+                continue
+            if chunk.executing or chunk.needs_compile or chunk.needs_execute:
+                chunk.clear_live_output()
+                chunk.statement = None
+                chunk.executing = False
+                chunk.needs_compile = True
+                chunk.needs_execute = False
+                chunk.status_changed = True
+                self.__chunk_changed(chunk)
+
+        self.__set_state(NotebookFile.NEEDS_EXECUTE)
+
+    def __cancelled_execution_complete(self):
+        self.__cancelled_executor = None
+
+        deferred = self.__deferred_calculate
+        if deferred is not None:
+            self.__deferred_calculate = None
+            self.calculate(end_line=deferred[0])
+
+    def __wait_for_cancelled_execution(self):
+        loop = gobject.MainLoop()
+
+        def on_complete(executor):
+            loop.quit()
+
+        self.__cancelled_executor.connect('complete', on_complete)
+        loop.run()
+
+    def __on_live_timeout(self):
+        self.__live_timeout = 0
+
+        # If an edit after the statements being executed triggered this, we
+        # wait until the execution completes
+        if self.state == NotebookFile.EXECUTING:
+            self.__live_pending = True
+        else:
+            self.calculate()
+
+        return False
+
+    def __queue_live_calculate(self):
+        if self.__live_timeout != 0:
+            gobject.source_remove(self.__live_timeout)
+            self.__live_timeout = 0
+
+        if self.live_delay is not None and not self.edit_only:
+            self.__live_timeout = gobject.timeout_add(self.live_delay, self.__on_live_timeout)
+
+    def __mark_stale_for_execute(self, statements):
+        # After a statement fails, the executor stops, so statements after it
+        # that didn't need to be executed still have scopes built on the scopes
+        # from before the failed statement was executed. They have to be
+        # executed again once the error is fixed.
+        self.__freeze_changes()
+        failed = False
+        for statement in statements:
+            if failed:
+                chunk = statement.chunk
+                if chunk.statement is statement and chunk.mark_for_execute():
+                    self.__chunk_changed(chunk)
+            elif statement.state != Statement.EXECUTE_SUCCESS:
+                failed = True
+        self.__thaw_changes()
+
+    def __mark_released_for_execute(self, chunk):
+        # The scope of the statement was released and can't be restored from
+        # disk, so it has to be reexecuted. The statements that use the names it
+        # binds need to be reexecuted too, since reexecution creates new objects.
+        self.__freeze_changes()
+        if chunk.mark_for_execute():
+            self.__chunk_changed(chunk)
+        self.__mark_dependents_for_execute(chunk.end, chunk.get_writes())
+        self.__thaw_changes()
+
+    def __get_spill(self):
+        if self.__spill is None:
+            self.__spill = checkpoint.Checkpoint(tempfile.mkdtemp("", "reinteract_scopes"))
+
+        return self.__spill
+
+    def __release_scopes(self):
+        # Release the result scopes of statements beyond those allowed by
+        # max_retained_scopes and max_retained_bytes; the last statement's
+        # scope is always kept.
+        if self.max_retained_scopes is None and self.max_retained_bytes is None:
+            return
+
+        # Statements remove the saved scopes that they replace, but the scopes
+        # of statements deleted from the worksheet are left behind
+        if self.__spill is not None:
+            self.__spill.prune(set(chunk.statement.spill_key for chunk in self.iterate_chunks()
+                                   if isinstance(chunk, StatementChunk) and chunk.statement is not None))
+
+        # The scopes that we might release are those of the statements up to
+        # the first one that needs to be executed
+        statements = []
+        for chunk in self.iterate_chunks():
+            if isinstance(chunk, StatementChunk):
+                statement = chunk.statement
+                if (chunk.needs_compile or chunk.needs_execute or
+                    statement is None or statement.state != Statement.EXECUTE_SUCCESS):
+                    break
+                statements.append(statement)
+
+        # Find the first retained statement, working back from the end
+        first_retained = len(statements)
+        count = 0
+        size = 0
+        while first_retained > 0:
+            statement = statements[first_retained - 1]
+            if statement.result_scope is None:
+                break
+
+            count += 1
+            size += statement.estimate_scope_size()
+            if self.max_retained_scopes is not None and count > self.max_retained_scopes:
+                break
+            if self.max_retained_bytes is not None and size > self.max_retained_bytes and count > 1:
+                break
+
+            first_retained -= 1
+
+        if first_retained == 0:
+            return
+
+        # The retained scopes refer to the scopes before them. We rebase them
+        # onto a flat copy of the names visible to the first retained
+        # statement, so that the values that are no longer visible can be freed.
+        last_released = statements[first_retained - 1]
+        if last_released.result_scope is not None:
+            base = last_released.result_scope.flatten()
+            for i in xrange(first_retained, len(statements)):
+                if i == first_retained:
+                    statements[i].rebase(base)
+                else:
+                    statements[i].rebase()
+
+        for statement in statements[0:first_retained]:
+            if statement.result_scope is not None:
+                if self.spill_scopes:
+                    self.__spill_count += 1
+                    statement.release_scope(self.__get_spill(), "%040x" % self.__spill_count)
+                else:
+                    statement.release_scope()
+
     def __get_last_scope(self, chunk):
         # Get the last result scope we have that precedes the specified chunk
 
@@ -660,9 +1114,19 @@ class Worksheet(gobject.GObject):
 
             # We intentionally don't check "needs_execute" ... if there is a result scope,
             # it's fair game for completion/help, even if it's old
-            if isinstance(previous_chunk, StatementChunk) and previous_chunk.statement is not None and previous_chunk.statement.result_scope is not None:
-                return previous_chunk.statement.result_scope
-                break
+            if isinstance(previous_chunk, StatementChunk) and previous_chunk.statement is not None:
+                statement = previous_chunk.statement
+                # If the scope was released to save memory, restore it if we can;
+                # otherwise we fall back to an earlier scope until the statement
+                # is reexecuted
+                if (statement.scope_released and not statement.rebuild_scope() and
+                    self.__executor is None):
+                    self.__mark_released_for_execute(previous_chunk)
+                    self.__queue_live_calculate()
+                # A consumed scope no longer has the objects that a later statement
+                # took over and modified, so we skip it as well
+                if statement.result_scope is not None and not statement.scope_consumed:
+                    return statement.result_scope
 
             line = previous_chunk.start - 1
 
@@ -715,6 +1179,9 @@ class Worksheet(gobject.GObject):
         if not isinstance(chunk, StatementChunk):
             return None, None, None, None, None
 
+        if chunk.statement is not None and chunk.statement.scope_released:
+            chunk.statement.rebuild_scope()
+
         if chunk.statement is not None and chunk.statement.result_scope is not None:
             result_scope = chunk.statement.result_scope
         else:
@@ -739,6 +1206,7 @@ class Worksheet(gobject.GObject):
     def clear(self):
         self.__do_clear()
         self.__set_filename_and_modified(None, False)
+        self.checkpoint = None
 
         # XXX: This prevents redoing New, would that "just work"?
         self.__undo_stack.clear()
@@ -863,6 +1331,57 @@ class Worksheet(gobject.GObject):
         self.code_modified = modified
         self.thaw_notify()
 
+    def __iterate_checkpoint_keys(self):
+        # Yields (chunk, key) for each statement chunk in the worksheet
+        key = None
+        for chunk in self.iterate_chunks():
+            if isinstance(chunk, StatementChunk):
+                key = checkpoint.make_key(key, chunk.tokenized.get_text())
+                yield chunk, key
+
+    def __update_checkpoint(self, filename):
+        # Sets up the checkpoint for the current filename, and brings it up
+        # to date with the current state of the worksheet
+        info = self.notebook.info
+        if not (info and info.checkpoint_results):
+            self.checkpoint = None
+            return
+
+        directory = checkpoint.get_directory(filename)
+        if self.checkpoint is None or self.checkpoint.directory != directory:
+            self.checkpoint = checkpoint.Checkpoint(directory)
+
+        keys = set()
+        up_to_date = self.state != NotebookFile.EXECUTING
+        for chunk, key in self.__iterate_checkpoint_keys():
+            keys.add(key)
+
+            # Statements are only stored here, when saving, rather than as they
+            # execute, since each edit changes the keys of all the statements
+            # after it. We only store statements up to the first one that needs
+            # to be executed, since the results of later statements might not
+            # match the current text of the worksheet.
+            if up_to_date:
+                statement = chunk.statement
+                if (chunk.needs_compile or chunk.needs_execute or
+                    statement is None or statement.state != Statement.EXECUTE_SUCCESS):
+                    up_to_date = False
+                elif self.checkpoint.has_entry(key):
+                    pass
+                elif statement.scope_consumed or not statement.rebuild_scope():
+                    # Released to save memory and not saved to disk, or modified
+                    # by a later statement
+                    up_to_date = False
+                else:
+                    # The profile shouldn't be shown when the results are restored
+                    results = [result for result in statement.results
+                               if not isinstance(result, profile_result.ProfileResult)]
+                    self.checkpoint.store(key, results,
+                                          statement.result_scope.local_items(),
+                                          list(statement.result_scope.deleted))
+
+        self.checkpoint.prune(keys)
+
     def load(self, filename, escape=False):
         """Load a file from disk into the worksheet. Can raise IOError if the
         file cannot be read, and reunicode.ConversionError if the file contains
@@ -886,6 +1405,11 @@ class Worksheet(gobject.GObject):
         self.__set_filename_and_modified(filename, escape)
         self.__undo_stack.clear()
 
+        # Nothing is loaded from the checkpoint until the worksheet is
+        # calculated; then each statement with a checkpoint entry restores its
+        # results rather than executing.
+        self.__update_checkpoint(filename)
+
     def save(self, filename=None):
         if filename is None:
             if self.__filename is None:
@@ -929,6 +1453,7 @@ class Worksheet(gobject.GObject):
             self.__set_filename_and_modified(filename, False)
             if self.notebook.info:
                 self.notebook.info.update_last_modified()
+            self.__update_checkpoint(filename)
         finally:
             if not success:
                 f.close()
@@ -938,6 +1463,22 @@ class Worksheet(gobject.GObject):
                     pass
 
     def close(self):
+        if self.__live_timeout != 0:
+            gobject.source_remove(self.__live_timeout)
+            self.__live_timeout = 0
+
+        if self.__update_source != 0:
+            gobject.source_remove(self.__update_source)
+            self.__update_source = 0
+
+        self.__stop_live_output()
+
+        if self.__spill is not None:
+            shutil.rmtree(self.__spill.directory, ignore_errors=True)
+            self.__spill = None
+
+        self.__pool.close()
+
         if self.__file:
             self.__file.worksheet = None
             self.__file.modified = False
@@ -1310,6 +1851,47 @@ if __name__ == '__main__': #pragma: no cover
     insert(1, 0, "#")
     assert worksheet.get_chunk(2).needs_execute
 
+    # But only lines that depend on the changed line are marked
+    clear()
+
+    insert(0, 0, "a = 1\nb = 2\nc = b\na\nc")
+    calculate()
+    insert(1, 4, "3")
+    assert not worksheet.get_chunk(3).needs_execute
+    assert worksheet.get_chunk(4).needs_execute
+    calculate()
+    expect_results([[], [], [], ['1'], ['32']])
+
+    # Deleting a line marks all the lines after it
+    delete(1, 0, 2, 0)
+    assert worksheet.get_chunk(1).needs_execute
+    assert worksheet.get_chunk(2).needs_execute
+
+    # A variable passed to a function might be mutated by it
+    clear()
+
+    insert(0, 0, "d = {}\ndef helper(x): x['k'] = 2\nhelper(d)\nd['k']")
+    calculate()
+    expect_results([[], [], [], ['2']])
+    insert(1, 24, "3")
+    assert worksheet.get_chunk(3).needs_execute
+    calculate()
+    expect_results([[], [], [], ['32']])
+
+    # Lines that weren't reexecuted because an earlier line failed are marked
+    clear()
+
+    insert(0, 0, "a = 1\nb = 2\nc = 3\nc")
+    calculate()
+    insert(1, 4, "z")
+    assert not worksheet.get_chunk(3).needs_execute
+    calculate()
+    assert worksheet.get_chunk(2).needs_execute
+    assert worksheet.get_chunk(3).needs_execute
+    delete(1, 4, 1, 5)
+    calculate()
+    expect_results([[], [], [], ['3']])
+
     # Test that we don't send out ::chunk-deleted signal for chunks for
     # which we never sent a ::chunk-inserted signal
 
@@ -1425,6 +2007,242 @@ a(2)
 ...     return x + 1
 """, 2, 2)
 
+    #
+    # Test of get_statement_metrics()
+    #
+    from test_utils import assert_equals
+
+    clear()
+    insert(0, 0, "import time\n1\ntime.sleep(0.05)")
+    calculate()
+    metrics = worksheet.get_statement_metrics()
+    assert_equals(metrics[0][0].start, 2)
+    assert metrics[0][1].execute_time >= 0.05
+
+    #
+    # Test of profile_statement()
+    #
+    clear()
+    insert(0, 0, "def f():\n    return 1\n\nx = f()\nx")
+    calculate()
+    assert_equals(worksheet.profile_statement(2, wait=True), False)
+    assert_equals(worksheet.profile_statement(3, wait=True), True)
+    results = worksheet.get_chunk(3).results
+    assert_equals(len(results), 1)
+    assert isinstance(results[0], profile_result.ProfileResult)
+    assert 'f' in [row[0] for row in results[0].rows]
+    # The statement after it depends on it, so needs to be executed again
+    assert_equals(worksheet.get_chunk(4).needs_execute, True)
+    calculate()
+    expect_results([[], None, results, ['1']])
+
+    #
+    # Tests of live execution and of editing during execution
+    #
+    def run_main_loop(timeout):
+        loop = gobject.MainLoop()
+        gobject.timeout_add(timeout, loop.quit)
+        loop.run()
+
+    clear()
+    worksheet.live_delay = 10
+
+    # Edits that aren't made by the user don't trigger execution
+    insert(0, 0, "a = 1\na")
+    run_main_loop(100)
+    expect_results([None, None])
+
+    worksheet.begin_user_action()
+    insert(1, 1, " + 1")
+    worksheet.end_user_action()
+    run_main_loop(200)
+    expect_results([[], ['2']])
+
+    worksheet.live_delay = None
+
+    # An edit to one of the statements being executed cancels the execution
+    clear()
+    insert(0, 0, "import time\ntime.sleep(0.5)\nb = 2\nb")
+    worksheet.calculate()
+    assert_equals(worksheet.state, NotebookFile.EXECUTING)
+    insert(3, 1, " + 1")
+    assert_equals(worksheet.state, NotebookFile.NEEDS_EXECUTE)
+    calculate()
+    expect_results([[], [], [], ['3']])
+
+    # A new calculation doesn't start until the cancelled execution stops, even
+    # if it doesn't stop when interrupted
+    clear()
+    insert(0, 0, "import time\nfor i in xrange(0, 5):\n    try: time.sleep(0.1)\n    except KeyboardInterrupt: pass\nb = 2\nb")
+    worksheet.calculate()
+    insert(5, 1, " + 1")
+    worksheet.calculate()
+    worksheet.calculate(end_line=4)
+    assert_equals(worksheet.state, NotebookFile.NEEDS_EXECUTE)
+    run_main_loop(1000)
+    assert_equals(worksheet.state, NotebookFile.EXECUTE_SUCCESS)
+    expect_results([[], [], [], ['3']])
+
+    # Output is shown while the statement is still executing
+    clear()
+    insert(0, 0, "import time\nprint 'a'; time.sleep(0.5)")
+    worksheet.calculate()
+    run_main_loop(300)
+    assert_equals(worksheet.get_chunk(1).live_output, ['a'])
+    assert_equals(worksheet.get_chunk(1).results, None)
+    run_main_loop(500)
+    assert_equals(worksheet.state, NotebookFile.EXECUTE_SUCCESS)
+    assert_equals(worksheet.get_chunk(1).live_output, None)
+    expect_results([[], ['a']])
+
+    # A statement that takes too long is interrupted
+    clear()
+    worksheet.statement_timeout = 0.2
+    insert(0, 0, "import time\ntime.sleep(5)\nb = 2")
+    calculate()
+    assert_equals(worksheet.get_chunk(1).error_message, "Timed out after 0.2 seconds")
+    assert worksheet.get_chunk(2).needs_execute
+    worksheet.statement_timeout = None
+
+    # Statements that complete together are reported in a batch, rather
+    # than a status change for each time the executor reports on a statement
+    clear()
+    insert(0, 0, "\n".join("x%d = %d" % (i, i) for i in xrange(0, 100)) + "\nx99")
+    clear_log()
+    calculate()
+    expect_results([[]] * 100 + [['99']])
+    assert len([entry for entry in log if isinstance(entry, CSC)]) < 200
+
+    #
+    # Tests of releasing result scopes to save memory
+    #
+    clear()
+    worksheet.max_retained_scopes = 1
+
+    insert(0, 0, "a = [1]\nb = a + [2]\nc = b + [3]\nc")
+    calculate()
+    expect_results([[], [], [], ['[1, 2, 3]']])
+    assert_equals(worksheet.get_chunk(0).statement.result_scope, None)
+    assert_equals(worksheet.get_chunk(2).statement.result_scope, None)
+    # The retained scope still sees the names bound by the released statements
+    assert_equals(worksheet.get_chunk(3).statement.result_scope['a'], [1])
+
+    # Completion restores a released scope from disk
+    assert 'c' in [completion[0] for completion in worksheet.find_completions(3, 1)]
+    assert_equals(worksheet.get_chunk(2).statement.result_scope['c'], [1, 2, 3])
+
+    # Later statements are rebased on released scopes restored from disk
+    insert(1, 11, " + [4]")
+    calculate()
+    expect_results([[], [], [], ['[1, 2, 4, 3]']])
+
+    # Saved scopes are removed when they are replaced, or the statement is deleted
+    spill_directory = worksheet._Worksheet__spill.directory
+    def get_spill_keys():
+        return [chunk.statement.spill_key for chunk in worksheet.iterate_chunks()
+                if isinstance(chunk, StatementChunk) and chunk.statement.spill_key is not None]
+    for i in xrange(0, 6):
+        insert(1, 11, " + [%d]" % i)
+        calculate()
+    assert_equals(len(get_spill_keys()), 3)
+    assert_equals(len(os.listdir(spill_directory)), 3)
+    delete(1, 0, 3, 0)
+    delete(1, 0, 1, 1)
+    insert(1, 0, "a")
+    calculate()
+    expect_results([[], ['[1]']])
+    assert_equals(len(get_spill_keys()), 1)
+    assert_equals(len(os.listdir(spill_directory)), 1)
+
+    # Without saving to disk, released statements have to be reexecuted
+    worksheet.spill_scopes = False
+    calls = []
+    def count():
+        calls.append(1)
+    worksheet.global_scope['count'] = count
+
+    clear()
+    insert(0, 0, "count(); a = 1\nb = 2\nb")
+    calculate()
+    assert_equals(len(calls), 1)
+    insert(2, 1, " + a")
+    calculate()
+    assert_equals(len(calls), 2)
+    expect_results([[], [], ['3']])
+
+    # A budget in bytes releases the large scopes
+    worksheet.max_retained_scopes = None
+    worksheet.max_retained_bytes = 1000
+    worksheet.spill_scopes = True
+
+    clear()
+    insert(0, 0, "a = 'x' * 10000\nb = 1\nlen(a) + b")
+    calculate()
+    expect_results([[], [], ['10001']])
+    assert_equals(worksheet.get_chunk(0).statement.result_scope, None)
+    assert_equals(worksheet.get_chunk(1).statement.result_scope['b'], 1)
+    obj, _, _, _, _ = worksheet.get_object_at_location(0, 0)
+    assert_equals(len(obj), 10000)
+
+    worksheet.max_retained_bytes = None
+
+    #
+    # Tests of modifying objects in place rather than copying them
+    #
+    clear()
+    worksheet.elide_copies = True
+    calls[:] = []
+
+    insert(0, 0, "count(); l = []\nl.append(1)\nl.append(2)\nl")
+    calculate()
+    expect_results([[], [], [], ['[1, 2]']])
+    assert_equals(worksheet.get_chunk(1).statement.metrics.copies, [('l', 'elided')])
+    assert_equals(worksheet.get_chunk(0).statement.scope_consumed, True)
+    assert_equals(worksheet.get_chunk(2).statement.scope_consumed, False)
+
+    # The statements whose scopes were consumed are reexecuted when needed
+    delete(2, 9, 2, 10)
+    insert(2, 9, "3")
+    calculate()
+    expect_results([[], [], [], ['[1, 3]']])
+    assert_equals(len(calls), 2)
+
+    # Completion and help don't use a consumed scope
+    assert_equals(worksheet.get_object_at_location(2, 0)[0], None)
+    assert_equals(worksheet.get_object_at_location(3, 0)[0], [1, 3])
+
+    # An object that something else refers to is copied
+    clear()
+    insert(0, 0, "l = []; m = l\nl.append(1)\nm")
+    calculate()
+    expect_results([[], [], ['[]']])
+
+    # ... even if it's inside a container
+    clear()
+    insert(0, 0, "l = []; d = {'l': l}\nl.append(1)\nd")
+    calculate()
+    expect_results([[], [], ["{'l': []}"]])
+
+    # Statements executed at the same time may read the parent's scope, so its
+    # objects aren't taken over
+    clear()
+    worksheet.max_workers = 2
+    insert(0, 0, "import time; l = [1, 2, 3]\ntime.sleep(0.3); l[-1]\nl.append(4)\nl")
+    calculate()
+    expect_results([[], ['3'], [], ['[1, 2, 3, 4]']])
+    assert_equals(worksheet.get_chunk(2).statement.metrics.copies, [('l', 'copy')])
+    worksheet.max_workers = 1
+
+    # An object bound by an earlier statement doesn't show through the consumed scope
+    clear()
+    insert(0, 0, "l = [0]\nl = []\nl.append(1)\nl")
+    calculate()
+    expect_results([[], [], [], ['[1]']])
+    assert worksheet.get_chunk(1).statement.scope_consumed
+    assert 'l' not in worksheet.get_chunk(1).statement.result_scope
+
+    worksheet.elide_copies = False
+
     #
     # Try writing to a file, and reading it back
     #
@@ -1465,3 +2283,58 @@ b = 2"""
 
     clear()
     expect([B(0,1)])
+
+    #
+    # Test that the results survive closing and reopening the worksheet
+    # when checkpointing is enabled
+    #
+    import shutil
+
+    folder = tempfile.mkdtemp("", "reinteract_notebook")
+    try:
+        checkpoint_notebook = Notebook(folder)
+        checkpoint_notebook.info.checkpoint_results = True
+        fname = os.path.join(folder, "Worksheet.rws")
+
+        calls = []
+        def count():
+            calls.append(1)
+
+        def open_worksheet():
+            w = Worksheet(checkpoint_notebook)
+            w.global_scope['count'] = count
+            return w
+
+        w = open_worksheet()
+        w.insert(0, 0, "a = 1\ncount(); b = a + 1\nb")
+        w.calculate(wait=True)
+        w.save(fname)
+        assert_equals(len(calls), 1)
+
+        w = open_worksheet()
+        w.load(fname)
+        w.calculate(wait=True)
+        assert_equals(len(calls), 1)
+        assert_equals(w.get_chunk(2).results, ['2'])
+
+        # Changing a statement invalidates the entries for it and the following statements
+        w.begin_user_action()
+        w.delete_range(0, 4, 0, 5)
+        w.insert(0, 4, "2")
+        w.end_user_action()
+        w.calculate(wait=True)
+        assert_equals(len(calls), 2)
+        # Nothing is stored until the worksheet is saved
+        assert_equals(len(os.listdir(checkpoint.get_directory(fname))), 3)
+        w.save()
+
+        w = open_worksheet()
+        w.load(fname)
+        w.calculate(wait=True)
+        assert_equals(len(calls), 2)
+        assert_equals(w.get_chunk(2).results, ['3'])
+
+        # Entries for the old text were removed when saving
+        assert_equals(len(os.listdir(checkpoint.get_directory(fname))), 3)
+    finally:
+        shutil.rmtree(folder)
@@ -15,8 +15,10 @@ import pango
 from application import application
 from editor import Editor
 from global_settings import global_settings
+from process_executor import ProcessExecutor
 from shell_buffer import ShellBuffer
 from shell_view import ShellView
+from thread_executor import ThreadExecutor
 
 class WorksheetEditor(Editor):
     DISCARD_FORMAT = 'Discard unsaved changes to worksheet "%s"?'
@@ -32,6 +34,33 @@ class WorksheetEditor(Editor):
         self.__font_name_connection = global_settings.connect('notify::editor-font-name', self.__update_font)
         self.__update_font()
 
+        self.__process_executor_connection = global_settings.connect('notify::process-executor', self.__update_executor)
+        self.__max_workers_connection = global_settings.connect('notify::max-workers', self.__update_executor)
+        self.__update_executor()
+
+        self.__lazy_copy_connection = global_settings.connect('notify::lazy-copy', self.__update_copying)
+        self.__elide_copies_connection = global_settings.connect('notify::elide-copies', self.__update_copying)
+        self.__update_copying()
+
+        self.__live_execution_connection = global_settings.connect('notify::live-execution', self.__update_live_delay)
+        self.__live_delay_connection = global_settings.connect('notify::live-delay', self.__update_live_delay)
+        self.__update_live_delay()
+
+        self.__show_statement_times_connection = global_settings.connect('notify::show-statement-times', self.__update_show_statement_times)
+        self.__update_show_statement_times()
+
+        self.__retained_scopes_connection = global_settings.connect('notify::retained-scopes', self.__update_retention)
+        self.__retained_scopes_memory_connection = global_settings.connect('notify::retained-scopes-memory', self.__update_retention)
+        self.__spill_scopes_connection = global_settings.connect('notify::spill-scopes', self.__update_retention)
+        self.__update_retention()
+
+        self.__max_output_lines_connection = global_settings.connect('notify::max-output-lines', self.__update_max_output_lines)
+        self.__update_max_output_lines()
+
+        self.__statement_timeout_connection = global_settings.connect('notify::statement-timeout', self.__update_timeouts)
+        self.__execution_timeout_connection = global_settings.connect('notify::execution-timeout', self.__update_timeouts)
+        self.__update_timeouts()
+
         self.widget = gtk.ScrolledWindow()
         self.widget.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
 
@@ -55,6 +84,55 @@ class WorksheetEditor(Editor):
 
         self.view.modify_font(pango.FontDescription(font_name))
 
+    def __update_executor(self, *args):
+        if global_settings.process_executor and ProcessExecutor.is_supported():
+            self.buf.worksheet.executor_class = ProcessExecutor
+        else:
+            self.buf.worksheet.executor_class = ThreadExecutor
+        self.buf.worksheet.max_workers = global_settings.max_workers
+
+    def __update_copying(self, *args):
+        self.buf.worksheet.lazy_copy = global_settings.lazy_copy
+        self.buf.worksheet.elide_copies = global_settings.elide_copies
+
+    def __update_live_delay(self, *args):
+        if global_settings.live_execution:
+            self.buf.worksheet.live_delay = global_settings.live_delay
+        else:
+            self.buf.worksheet.live_delay = None
+
+    def __update_show_statement_times(self, *args):
+        self.view.set_show_statement_times(global_settings.show_statement_times)
+
+    def __update_retention(self, *args):
+        worksheet = self.buf.worksheet
+        if global_settings.retained_scopes > 0:
+            worksheet.max_retained_scopes = global_settings.retained_scopes
+        else:
+            worksheet.max_retained_scopes = None
+        if global_settings.retained_scopes_memory > 0:
+            worksheet.max_retained_bytes = global_settings.retained_scopes_memory * 1024 * 1024
+        else:
+            worksheet.max_retained_bytes = None
+        worksheet.spill_scopes = global_settings.spill_scopes
+
+    def __update_max_output_lines(self, *args):
+        if global_settings.max_output_lines > 0:
+            self.buf.worksheet.max_output_lines = global_settings.max_output_lines
+        else:
+            self.buf.worksheet.max_output_lines = None
+
+    def __update_timeouts(self, *args):
+        worksheet = self.buf.worksheet
+        if global_settings.statement_timeout > 0:
+            worksheet.statement_timeout = global_settings.statement_timeout
+        else:
+            worksheet.statement_timeout = None
+        if global_settings.execution_timeout > 0:
+            worksheet.execution_timeout = global_settings.execution_timeout
+        else:
+            worksheet.execution_timeout = None
+
     #######################################################
     # Overrides
     #######################################################
@@ -92,6 +170,19 @@ class WorksheetEditor(Editor):
         self.buf.worksheet.close()
         global_settings.disconnect(self.__font_is_custom_connection)
         global_settings.disconnect(self.__font_name_connection)
+        global_settings.disconnect(self.__process_executor_connection)
+        global_settings.disconnect(self.__max_workers_connection)
+        global_settings.disconnect(self.__lazy_copy_connection)
+        global_settings.disconnect(self.__elide_copies_connection)
+        global_settings.disconnect(self.__live_execution_connection)
+        global_settings.disconnect(self.__live_delay_connection)
+        global_settings.disconnect(self.__show_statement_times_connection)
+        global_settings.disconnect(self.__retained_scopes_connection)
+        global_settings.disconnect(self.__retained_scopes_memory_connection)
+        global_settings.disconnect(self.__spill_scopes_connection)
+        global_settings.disconnect(self.__max_output_lines_connection)
+        global_settings.disconnect(self.__statement_timeout_connection)
+        global_settings.disconnect(self.__execution_timeout_connection)
 
     def load(self, filename, escape=False):
         self.buf.worksheet.load(filename, escape=escape)
@@ -100,6 +191,9 @@ class WorksheetEditor(Editor):
     def calculate(self, end_at_insert=False):
         self.view.calculate(end_at_insert)
 
+    def profile_statement(self, mode):
+        self.view.profile_statement(mode)
+
     def undo(self):
         self.buf.worksheet.undo()
 
@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+#
+# Copyright 2009 Owen Taylor
+#
+# This file is part of Reinteract and distributed under the terms
+# of the BSD license. See the file COPYING in the Reinteract
+# distribution for full details.
+#
+########################################################################
+
+#
+# Benchmarks of the parts of Reinteract that run on every edit and every
+# calculation. Run from the top of the source tree:
+#
+#   tools/benchmark.py run -o before.json
+#   ... make changes ...
+#   tools/benchmark.py run -o after.json --compare before.json
+#
+# or compare two saved runs with:
+#
+#   tools/benchmark.py compare before.json after.json
+#
+# Each benchmark is run for a range of sizes (lines of a worksheet, items
+# of a list, ...); the operation is timed separately each time it is
+# called, and the minimum and median times are recorded. Runs are compared
+# by the minimum time, which is the least affected by other activity on the
+# machine.
+#
+
+import json
+from optparse import OptionParser
+import os
+import platform
+import sys
+import time
+import timeit
+
+script_path = os.path.realpath(os.path.abspath(sys.argv[0]))
+topdir = os.path.dirname(os.path.dirname(script_path))
+sys.path[0:0] = [os.path.join(topdir, 'lib', 'reinteract')]
+
+import gobject
+import stdout_capture
+
+import data_format
+from notebook import Notebook
+import retokenize
+from rewrite import Rewriter
+from statement import Statement
+from tokenized_statement import TokenizedStatement
+from worksheet import Worksheet
+
+# Version of the format of the saved results
+FORMAT_VERSION = 1
+
+# Each operation is timed at least this many times...
+_MIN_CALLS = 3
+# ... and then repeatedly until this many seconds have passed
+_MIN_TIME = 0.5
+# ... but no more than this many times
+_MAX_CALLS = 1000
+
+# Sizes of generated worksheets, in lines
+_WORKSHEET_SIZES = [100, 1000, 10000, 100000]
+# Sizes of single statements, in lines
+_STATEMENT_SIZES = [10, 100, 1000]
+# Number of items in the values that are copied and formatted
+_VALUE_SIZES = [100, 1000, 10000, 100000]
+
+# List of (name, function, sizes). The function takes a size, and returns
+# a tuple of (run, setup, teardown); run is the operation timed, while
+# setup and teardown (if not None) are called before and after each call
+# to run, untimed.
+_benchmarks = []
+
+def benchmark(name, sizes):
+    def decorator(func):
+        _benchmarks.append((name, func, sizes))
+        return func
+
+    return decorator
+
+def generate_worksheet(lines):
+    # A mix of comments, simple statements, compound statements and blank lines
+    # like that in a real worksheet
+    template = ["# Section %(i)d",
+                "a%(i)d = [x * 2 for x in xrange(10)]",
+                "b%(i)d = dict(x=a%(i)d, y=%(i)d)",
+                "def f%(i)d(x):",
+                "    return x + %(i)d",
+                "b%(i)d['x'][0]",
+                ""]
+
+    result = []
+    i = 0
+    while len(result) < lines:
+        result.extend(line % { 'i': i } for line in template)
+        i += 1
+
+    return "\n".join(result[0:lines])
+
+def generate_statement(lines):
+    result = ["def f(a, b):"]
+    for i in xrange(0, lines - 2):
+        result.append("    a.x%d = b[%d] + len('%d') # comment" % (i, i, i))
+    result.append("f(obj, l)")
+
+    return "\n".join(result[0:lines])
+
+def time_benchmark(run, setup, teardown):
+    """Time an operation
+
+    @returns: a dictionary of 'calls', 'min' and 'median'; the times are in seconds
+
+    """
+
+    timer = timeit.default_timer
+    times = []
+    start = timer()
+    while len(times) < _MIN_CALLS or (timer() - start < _MIN_TIME and len(times) < _MAX_CALLS):
+        if setup is not None:
+            setup()
+        t = timer()
+        run()
+        times.append(timer() - t)
+        if teardown is not None:
+            teardown()
+
+    times.sort()
+    return { 'calls': len(times), 'min': times[0], 'median': times[len(times) // 2] }
+
+######################################################################
+
+@benchmark('worksheet.load', _WORKSHEET_SIZES)
+def bench_worksheet_load(size):
+    text = generate_worksheet(size)
+    state = {}
+
+    def setup():
+        state['worksheet'] = Worksheet(Notebook())
+
+    def run():
+        state['worksheet'].insert(0, 0, text)
+
+    def teardown():
+        state['worksheet'].close()
+
+    return run, setup, teardown
+
+def create_worksheet(size):
+    worksheet = Worksheet(Notebook())
+    worksheet.insert(0, 0, generate_worksheet(size))
+    return worksheet
+
+@benchmark('worksheet.insert', _WORKSHEET_SIZES)
+def bench_worksheet_insert(size):
+    worksheet = create_worksheet(size)
+    middle = size // 2
+
+    def run():
+        worksheet.insert(middle, 0, "z = 1\n")
+
+    def teardown():
+        worksheet.delete_range(middle, 0, middle + 1, 0)
+
+    return run, None, teardown
+
+@benchmark('worksheet.delete_range', _WORKSHEET_SIZES)
+def bench_worksheet_delete_range(size):
+    worksheet = create_worksheet(size)
+    middle = size // 2
+
+    def setup():
+        worksheet.insert(middle, 0, "z = 1\n")
+
+    def run():
+        worksheet.delete_range(middle, 0, middle + 1, 0)
+
+    return run, setup, None
+
+@benchmark('worksheet.rescan', _WORKSHEET_SIZES)
+def bench_worksheet_rescan(size):
+    worksheet = create_worksheet(size)
+    middle = size // 2
+
+    # Within a user action, the chunks aren't updated until the end; we
+    # time just the rescan after an edit that joins two statements
+    def setup():
+        worksheet.begin_user_action()
+        worksheet.insert(middle, 0, "(\n")
+
+    def run():
+        worksheet.rescan()
+
+    def teardown():
+        worksheet.delete_range(middle, 0, middle + 1, 0)
+        worksheet.end_user_action()
+
+    return run, setup, teardown
+
+@benchmark('tokenized_statement.set_lines', _STATEMENT_SIZES)
+def bench_set_lines(size):
+    lines = generate_statement(size).split("\n")
+    state = {}
+
+    def setup():
+        state['tokenized'] = TokenizedStatement()
+
+    def run():
+        state['tokenized'].set_lines(lines)
+
+    return run, setup, None
+
+@benchmark('tokenized_statement.set_lines.edit', _STATEMENT_SIZES)
+def bench_set_lines_edit(size):
+    lines = generate_statement(size).split("\n")
+    edited = list(lines)
+    edited[len(lines) // 2] += " + 1"
+    tokenized = TokenizedStatement()
+    tokenized.set_lines(lines)
+
+    def run():
+        tokenized.set_lines(edited)
+
+    def teardown():
+        tokenized.set_lines(lines)
+
+    return run, None, teardown
+
+@benchmark('retokenize.tokenize_line', _STATEMENT_SIZES)
+def bench_tokenize_line(size):
+    lines = generate_worksheet(size).split("\n")
+
+    def run():
+        for line in lines:
+            retokenize.tokenize_line(line)
+
+    return run, None, None
+
+def _bench_rewrite_and_compile(size, use_ast):
+    code = generate_statement(size)
+
+    # The arguments are the ones used by Statement.compile()
+    def run():
+        rewriter = Rewriter(code, use_ast=use_ast)
+        rewriter.rewrite_and_compile(output_func_name='reinteract_output',
+                                     copy_func_name="__reinteract_copy",
+                                     mutate_func_name='reinteract_copy_mutated')
+
+    return run, None, None
+
+@benchmark('rewrite.rewrite_and_compile', _STATEMENT_SIZES)
+def bench_rewrite_and_compile(size):
+    return _bench_rewrite_and_compile(size, True)
+
+# Rewriting without the ast module, as on Python 2.5
+@benchmark('rewrite.rewrite_and_compile.tuples', _STATEMENT_SIZES)
+def bench_rewrite_and_compile_tuples(size):
+    return _bench_rewrite_and_compile(size, False)
+
+@benchmark('statement.execute.copy', _VALUE_SIZES)
+def bench_statement_execute_copy(size):
+    worksheet = Worksheet(Notebook())
+    parent = Statement("l = range(%d)\nd = dict.fromkeys(l)" % size, worksheet)
+    parent.compile()
+    parent.execute()
+
+    # Each statement modifies both objects, so both are copied each time
+    statement = Statement("l.append(1)\nd[-1] = 1", worksheet, parent=parent)
+    statement.compile()
+
+    def run():
+        statement.execute()
+
+    def teardown():
+        statement.mark_for_execute()
+
+    return run, None, teardown
+
+@benchmark('data_format.format', _VALUE_SIZES)
+def bench_data_format(size):
+    value = [range(size), dict((str(i), (i, float(i))) for i in xrange(size))]
+
+    def run():
+        data_format.format(value)
+
+    return run, None, None
+
+@benchmark('worksheet.find_completions', [100, 1000])
+def bench_find_completions(size):
+    worksheet = Worksheet(Notebook())
+    worksheet.insert(0, 0, "\n".join("name%d = %d" % (i, i) for i in xrange(size)) + "\nname")
+    worksheet.calculate(wait=True)
+
+    def run():
+        worksheet.find_completions(size, 4)
+
+    return run, None, None
+
+######################################################################
+
+def run_benchmarks(names=None, max_size=None, verbose=True):
+    """Run the benchmarks
+
+    @param names: if not None, only benchmarks whose name starts with one of these are run
+    @param max_size: if not None, sizes larger than this are skipped
+    @returns: the results, as a dictionary that can be saved as JSON
+
+    """
+
+    results = {}
+    for name, func, sizes in _benchmarks:
+        if names and not any(name.startswith(n) for n in names):
+            continue
+
+        results[name] = {}
+        for size in sizes:
+            if max_size is not None and size > max_size:
+                continue
+
+            run, setup, teardown = func(size)
+            result = time_benchmark(run, setup, teardown)
+            # JSON only allows strings as keys
+            results[name][str(size)] = result
+            if verbose:
+                print >>sys.stderr, "%-36s %7d %12s (%d calls)" % (name, size, format_time(result['min']), result['calls'])
+
+    return {
+        'format_version': FORMAT_VERSION,
+        'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+def format_time(t):
+    if t < 1e-3:
+        return "%.1fus" % (t * 1e6)
+    elif t < 1:
+        return "%.2fms" % (t * 1e3)
+    else:
+        return "%.3fs" % t
+
+def compare(old, new, threshold):
+    """Compare two sets of results
+
+    @param old: the baseline results
+    @param new: the results to check
+    @param threshold: a change in the minimum time by more than this fraction is
+      reported as a regression or improvement
+    @returns: a tuple of (lines of report, number of regressions)
+
+    """
+
+    lines = ["%-36s %7s %12s %12s %8s" % ("benchmark", "size", "old", "new", "change")]
+    regressions = 0
+    for name in sorted(new['results']):
+        old_sizes = old['results'].get(name, {})
+        new_sizes = new['results'][name]
+        for size in sorted(new_sizes, key=int):
+            if size not in old_sizes:
+                continue
+
+            old_time = old_sizes[size]['min']
+            new_time = new_sizes[size]['min']
+            change = (new_time - old_time) / old_time
+            if change > threshold:
+                note = "  REGRESSION"
+                regressions += 1
+            elif change < -threshold:
+                note = "  improved"
+            else:
+                note = ""
+
+            lines.append("%-36s %7s %12s %12s %+7.1f%%%s" % (name, size, format_time(old_time), format_time(new_time),
+                                                            change * 100, note))
+
+    return lines, regressions
+
+def load_results(filename):
+    f = open(filename)
+    try:
+        results = json.load(f)
+    finally:
+        f.close()
+
+    if results.get('format_version') != FORMAT_VERSION:
+        raise SystemExit("%s: results saved by an incompatible version of the benchmarks" % filename)
+
+    return results
+
+def report_comparison(old, new, threshold):
+    lines, regressions = compare(old, new, threshold / 100.)
+    for line in lines:
+        print line
+
+    if regressions > 0:
+        print "Slower by more than %g%%: %d" % (threshold, regressions)
+        return 1
+
+    return 0
+
+def main():
+    parser = OptionParser(usage="""%prog run [options] [BENCHMARK...]
+       %prog compare [options] OLD.json NEW.json
+       %prog list""")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="save the results of run to FILE")
+    parser.add_option("-c", "--compare", metavar="FILE",
+                      help="compare the results of run to those saved in FILE")
+    parser.add_option("-m", "--max-size", type="int",
+                      help="skip sizes larger than MAX_SIZE")
+    parser.add_option("-t", "--threshold", type="float", default=10,
+                      help="percentage by which a benchmark can get slower before it is a regression [default: %default]")
+
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        parser.error("no command given")
+
+    command = args[0]
+    if command == "list":
+        for name, func, sizes in _benchmarks:
+            print "%-36s %s" % (name, " ".join(str(size) for size in sizes))
+        return 0
+    elif command == "compare":
+        if len(args) != 3:
+            parser.error("compare needs two files of results")
+        return report_comparison(load_results(args[1]), load_results(args[2]), options.threshold)
+    elif command != "run":
+        parser.error("unknown command '%s'" % command)
+
+    if options.compare is not None:
+        baseline = load_results(options.compare)
+
+    gobject.threads_init()
+    stdout_capture.init()
+
+    results = run_benchmarks(args[1:], options.max_size)
+
+    if options.output is not None:
+        f = open(options.output, "w")
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if options.compare is not None:
+        return report_comparison(baseline, results, options.threshold)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())